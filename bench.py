@@ -0,0 +1,1149 @@
+#!/usr/bin/env python3
+"""Бенчмарки файлового менеджера (index.py)
+
+Сервер запускается отдельным процессом во временной директории,
+клиенты работают в потоках этого процесса.
+
+    python3 bench.py concurrency --clients 1,8,32,64 --slow 4
+    python3 bench.py download --sizes 1,64,512 --parallel 4
+    python3 bench.py upload --sizes 1,64,512 --parallel 4
+    python3 bench.py listing --entries 1000,10000,100000
+    python3 bench.py render --baseline HEAD~1
+    python3 bench.py keepalive --requests 500
+    python3 bench.py idle --workers 4 --idle 4,64 --streams 8
+    python3 bench.py search --files 200000
+    python3 bench.py grep --mb 256 --workers 1,2,4
+    python3 bench.py copy --file-mb 1024 --tree-mb 512
+    python3 bench.py editor --mb 1024
+    python3 bench.py thumbs --images 200
+    python3 bench.py archive --mb 2048
+    python3 bench.py extract --mb 512 --workers 1,4
+    python3 bench.py auth --sessions 1,10000,1000000
+    python3 bench.py quota --files 10000,100000
+    python3 bench.py paths --entries 10000 --depth 8
+    python3 bench.py traversal
+"""
+import argparse
+import http.client
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'pass123'
+# Cookie сессии; выставляет Server после входа
+COOKIE = ''
+
+def free_port():
+    """Возвращает свободный порт на 127.0.0.1"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Server:
+    """index.py в отдельном процессе"""
+
+    def __init__(self, root, engine='threaded', extra=(), script=None):
+        self.root = root
+        self.port = free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, script or os.path.join(HERE, 'index.py'), '--host', '127.0.0.1',
+             '--port', str(self.port), '--engine', engine, *extra],
+            cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.2).close()
+                self.login()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError(f'server ({engine}) did not start')
+
+    def login(self):
+        """Входит по паролю и запоминает cookie сессии для всех запросов"""
+        global COOKIE
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request('POST', '/', body=f'password={PASSWORD}',
+                         headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            resp = conn.getresponse()
+            resp.read()
+            COOKIE = resp.getheader('Set-Cookie', '').split(';')[0]
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait(5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+def request(port, path, headers=None):
+    """GET запрос, возвращает (статус, длина тела)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', path, headers={'Cookie': COOKIE, **(headers or {})})
+        resp = conn.getresponse()
+        size = 0
+        while True:
+            chunk = resp.read(65536)
+            if not chunk:
+                break
+            size += len(chunk)
+        return resp.status, size
+    finally:
+        conn.close()
+
+def make_tree(root, files=200):
+    """Создаёт небольшую директорию для листинга"""
+    for i in range(files):
+        with open(os.path.join(root, f'file_{i:04}.txt'), 'w') as f:
+            f.write('x' * i)
+    os.makedirs(os.path.join(root, 'sub'), exist_ok=True)
+
+def run_clients(port, path, clients, seconds):
+    """Гоняет clients потоков по path, возвращает запросов в секунду"""
+    stop = time.time() + seconds
+    counts = [0] * clients
+    errors = [0] * clients
+
+    def worker(i):
+        while time.time() < stop:
+            try:
+                status, _ = request(port, path)
+                if status == 200:
+                    counts[i] += 1
+                else:
+                    errors[i] += 1
+            except OSError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.time() - start), sum(errors)
+
+def stall_connections(port, count):
+    """Открывает соединения, которые так и не дописывают запрос (медленный телефон)"""
+    socks = []
+    for _ in range(count):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n')
+        socks.append(s)
+    return socks
+
+def rss_kb(pid):
+    """Текущий RSS процесса в КБ"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+class RssSampler(threading.Thread):
+    """Следит за пиковым RSS процесса"""
+
+    def __init__(self, pid, interval=0.01):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = rss_kb(pid)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_kb(self.pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+def bench_download(args):
+    sizes = [int(s) for s in args.sizes.split(',')]
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        for mb in sizes:
+            with open(os.path.join(root, f'{mb}mb.bin'), 'wb') as f:
+                f.truncate(mb * 1024 * 1024)
+        print(f'{"size MB":>8} {"parallel":>8} {"MB/s":>10} {"base RSS MB":>12} {"peak RSS MB":>12}')
+        with Server(root, args.engine) as server:
+            request(server.port, '/')
+            base = rss_kb(server.proc.pid)
+            for mb in sizes:
+                path = f'/?preview={os.path.join(root, f"{mb}mb.bin")}'
+                sampler = RssSampler(server.proc.pid)
+                sampler.start()
+                start = time.time()
+                threads = [threading.Thread(target=request, args=(server.port, path))
+                           for _ in range(args.parallel)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.time() - start
+                peak = sampler.stop()
+                print(f'{mb:>8} {args.parallel:>8} {mb * args.parallel / elapsed:>10.1f} '
+                      f'{base / 1024:>12.1f} {peak / 1024:>12.1f}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def upload(port, directory, name, size):
+    """Загружает size байт нулей как multipart/form-data, не держа тело в памяти"""
+    boundary = 'benchboundary'
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="current_dir"\r\n\r\n{directory}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def body():
+        yield head
+        block = bytes(1024 * 1024)
+        left = size
+        while left > 0:
+            yield block[:min(left, len(block))]
+            left -= len(block)
+        yield tail
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('POST', '/', body=body(), headers={
+            'Cookie': COOKIE,
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + size + len(tail))})
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status
+    finally:
+        conn.close()
+
+def bench_upload(args):
+    sizes = [int(s) for s in args.sizes.split(',')]
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        print(f'{"size MB":>8} {"parallel":>8} {"MB/s":>10} {"base RSS MB":>12} {"peak RSS MB":>12}')
+        with Server(root, args.engine) as server:
+            request(server.port, '/')
+            base = rss_kb(server.proc.pid)
+            for mb in sizes:
+                sampler = RssSampler(server.proc.pid)
+                sampler.start()
+                start = time.time()
+                threads = [threading.Thread(target=upload, args=(server.port, root, f'{mb}mb_{i}.bin', mb * 1024 * 1024))
+                           for i in range(args.parallel)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.time() - start
+                peak = sampler.stop()
+                print(f'{mb:>8} {args.parallel:>8} {mb * args.parallel / elapsed:>10.1f} '
+                      f'{base / 1024:>12.1f} {peak / 1024:>12.1f}')
+                for i in range(args.parallel):
+                    os.unlink(os.path.join(root, f'{mb}mb_{i}.bin'))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def legacy_read_directory(current_dir):
+    """Листинг в том виде, как он был до os.scandir: listdir + stat + два isdir"""
+    from index import FileManagerHandler as H
+
+    def get_file_icon(filename):
+        if os.path.isdir(filename):
+            return H.ICONS['folder']
+        if filename.startswith('.'):
+            return H.ICONS['hidden']
+        ext = os.path.splitext(filename)[1].lower()
+        for file_type, extensions in H.FILE_TYPES.items():
+            if ext in extensions:
+                return H.ICONS[file_type]
+        return H.ICONS['default']
+
+    files = []
+    for item in os.listdir(current_dir):
+        item_path = os.path.join(current_dir, item)
+        try:
+            stats = os.stat(item_path)
+            files.append({
+                'name': item,
+                'path': item_path,
+                'is_dir': os.path.isdir(item_path),
+                'size': stats.st_size,
+                'modified': stats.st_mtime,
+                'icon': get_file_icon(item_path),
+                'is_hidden': item.startswith('.')
+            })
+        except OSError:
+            continue
+    files.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    return files
+
+def make_flat_dir(path, entries):
+    """Директория из entries пустых файлов разных типов и 5% поддиректорий"""
+    exts = ['.txt', '.jpg', '.mp4', '.py', '.log', '.bin', '.zip', '']
+    os.makedirs(path)
+    for i in range(entries):
+        name = os.path.join(path, f'item_{i:06}{exts[i % len(exts)]}')
+        if i % 20 == 0:
+            os.mkdir(name)
+        else:
+            open(name, 'w').close()
+
+def best_time(func, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_listing(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        print(f'{"entries":>8} {"legacy ms":>10} {"scandir ms":>11} {"speedup":>8}')
+        for n in [int(e) for e in args.entries.split(',')]:
+            path = os.path.join(root, str(n))
+            make_flat_dir(path, n)
+            assert [f['name'] for f in legacy_read_directory(path)] == \
+                [f['name'] for f in index.FileManagerHandler.read_directory(path)]
+            old = best_time(legacy_read_directory, path, args.repeat)
+            new = best_time(index.FileManagerHandler.read_directory, path, args.repeat)
+            print(f'{n:>8} {old * 1000:>10.1f} {new * 1000:>11.1f} {old / new:>7.1f}x')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def timed_get(port, path):
+    """GET по сырому сокету: (время до первого байта, полное время, байт)"""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        start = time.perf_counter()
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: bench\r\nCookie: {COOKIE}\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        first = None
+        size = 0
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            if first is None:
+                first = time.perf_counter() - start
+            size += len(data)
+        return first, time.perf_counter() - start, size
+
+def bench_render(args):
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        baseline = os.path.join(root, 'baseline_index.py')
+        with open(baseline, 'wb') as f:
+            f.write(subprocess.check_output(['git', 'show', f'{args.baseline}:index.py'], cwd=HERE))
+        data = os.path.join(root, 'data')
+        make_flat_dir(data, args.entries)
+        # Старый mtime, чтобы кеш листингов работал с первого запроса у обоих серверов
+        os.utime(data, (time.time() - 3600, time.time() - 3600))
+        with open(os.path.join(root, 'text.txt'), 'w') as f:
+            f.write('line of text <with> & markup\n' * 10000)
+        pages = {'listing': f'/?dir={data}', 'editor': f'/?view={os.path.join(root, "text.txt")}'}
+
+        print(f'{"server":<10} {"page":<8} {"TTFB ms":>8} {"total ms":>9} {"KB":>8}')
+        for label, script in (('baseline', baseline), ('current', None)):
+            with Server(root, script=script) as server:
+                for page, path in pages.items():
+                    timed_get(server.port, path)
+                    samples = [timed_get(server.port, path) for _ in range(args.repeat)]
+                    ttfb = sorted(s[0] for s in samples)[len(samples) // 2]
+                    total = sorted(s[1] for s in samples)[len(samples) // 2]
+                    print(f'{label:<10} {page:<8} {ttfb * 1000:>8.2f} {total * 1000:>9.2f} '
+                          f'{samples[0][2] / 1024:>8.1f}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def keepalive_latencies(port, paths, count, reuse):
+    """Задержки count запросов подряд: в одном соединении или каждый в новом"""
+    latencies = []
+    conn = None
+    try:
+        for i in range(count):
+            start = time.perf_counter()
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', paths[i % len(paths)], headers={'Cookie': COOKIE})
+            resp = conn.getresponse()
+            resp.read()
+            if not reuse or resp.will_close:
+                conn.close()
+                conn = None
+            latencies.append(time.perf_counter() - start)
+    finally:
+        if conn is not None:
+            conn.close()
+    return sorted(latencies)
+
+def bench_keepalive(args):
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        make_tree(root)
+        with open(os.path.join(root, 'note.txt'), 'w') as f:
+            f.write('keep-alive\n' * 100)
+        print(f'{"engine":<10} {"mode":<12} {"mean ms":>8} {"p50 ms":>8} {"p95 ms":>8}')
+        for engine in args.engines.split(','):
+            with Server(root, engine) as server:
+                # Страница, превью и её css/js - как при открытии в браузере
+                conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+                conn.request('GET', '/', headers={'Cookie': COOKIE})
+                body = conn.getresponse().read().decode()
+                conn.close()
+                assets = sorted(set(re.findall(r'/__assets/[^"]+', body)))
+                paths = ['/', '/?preview=note.txt', *assets]
+                for mode, reuse in (('per-request', False), ('keep-alive', True)):
+                    keepalive_latencies(server.port, paths, len(paths), reuse)
+                    lat = keepalive_latencies(server.port, paths, args.requests, reuse)
+                    print(f'{engine:<10} {mode:<12} {sum(lat) / len(lat) * 1000:>8.3f} '
+                          f'{lat[len(lat) // 2] * 1000:>8.3f} {lat[len(lat) * 95 // 100] * 1000:>8.3f}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_idle(args):
+    """Задержка нового запроса, пока простаивающие keep-alive соединения
+    и потоки событий держат сервер с --workers потоками"""
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        with open(os.path.join(root, 'note.txt'), 'w') as f:
+            f.write('idle\n')
+        print(f'{"engine":<10} {"idle":>6} {"streams":>8} {"mean ms":>8} {"max ms":>8}')
+        for engine in args.engines.split(','):
+            for idle in map(int, args.idle.split(',')):
+                with Server(root, engine, extra=('--workers', str(args.workers))) as server:
+                    held = []
+                    for _ in range(idle):
+                        conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=60)
+                        conn.request('GET', '/?preview=note.txt', headers={'Cookie': COOKIE})
+                        conn.getresponse().read()
+                        held.append(conn)
+                    for _ in range(args.streams):
+                        sock = socket.create_connection(('127.0.0.1', server.port))
+                        sock.sendall(f'GET /?events={root} HTTP/1.1\r\nHost: bench\r\n'
+                                     f'Cookie: {COOKIE}\r\n\r\n'.encode())
+                        held.append(sock)
+                    time.sleep(0.2)
+                    lat = keepalive_latencies(server.port, ['/?preview=note.txt'], args.requests, False)
+                    print(f'{engine:<10} {idle:>6} {args.streams:>8} {sum(lat) / len(lat) * 1000:>8.2f} '
+                          f'{max(lat) * 1000:>8.2f}')
+                    for conn in held:
+                        conn.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def make_deep_tree(root, files, per_dir=500):
+    """Дерево из files файлов по per_dir в директории, с разными расширениями"""
+    exts = ('.txt', '.py', '.jpg', '.log', '.json')
+    for i in range(files):
+        if i % per_dir == 0:
+            d = os.path.join(root, f'group{i // (per_dir * 50)}', f'dir{i // per_dir}')
+            os.makedirs(d)
+        open(os.path.join(d, f'file_{i:07d}_item{exts[i % len(exts)]}'), 'w').close()
+
+def bench_search(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        tree = os.path.join(root, 'tree')
+        os.makedirs(tree)
+        started = time.perf_counter()
+        make_deep_tree(tree, args.files)
+        print(f'tree of {args.files} files created in {time.perf_counter() - started:.1f} s')
+
+        file_index = index.FileIndex(tree, os.path.join(root, 'index.sqlite3'))
+        started = time.perf_counter()
+        file_index.start()
+        while not file_index.ready:
+            time.sleep(0.05)
+        stats = file_index.stats()
+        print(f'full scan: {time.perf_counter() - started:.2f} s, {stats["entries"]} entries, '
+              f'fts={stats["fts"]}, db {os.path.getsize(file_index.db_path) / 2**20:.1f} MB')
+
+        queries = [('substring', '0012345'), ('substring', 'item.py'), ('substring', 'zzz'),
+                   ('substring', '_1'), ('prefix', 'file_00999'), ('glob', '*99?_item.json'),
+                   ('glob', 'file_[0-9]*5_item.log')]
+        print(f'{"mode":<10} {"query":<24} {"hits":>6} {"p50 ms":>8} {"max ms":>8}')
+        for mode, query in queries:
+            times = []
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                hits = len(file_index.search(query, mode))
+                times.append(time.perf_counter() - t)
+            times.sort()
+            print(f'{mode:<10} {query:<24} {hits:>6} {times[len(times) // 2] * 1000:>8.2f} '
+                  f'{times[-1] * 1000:>8.2f}')
+
+        started = time.perf_counter()
+        file_index.rescan(file_index.connect())
+        print(f'incremental rescan without changes: {time.perf_counter() - started:.2f} s')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def make_text_files(root, total_mb, file_mb=4):
+    """Текстовые файлы общим объёмом total_mb, плюс немного бинарных"""
+    line = b'2024-01-01 12:00:00 INFO request handled in 12 ms path=/api/items/42 status=200\n'
+    block = line * (1024 * 1024 // len(line))
+    for i in range(max(total_mb // file_mb, 1)):
+        with open(os.path.join(root, f'app{i}.log'), 'wb') as f:
+            for _ in range(file_mb):
+                f.write(block)
+            f.write(b'needle ERROR 500 in the last line\n')
+        with open(os.path.join(root, f'blob{i}.bin'), 'wb') as f:
+            f.write(b'\0' * 65536)
+
+def bench_grep(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        make_text_files(root, args.mb)
+        print(f'{"workers":>7} {"query":<12} {"matches":>7} {"seconds":>8} {"MB/s":>8} {"MB/s/core":>10}')
+        for workers in [int(w) for w in args.workers.split(',')]:
+            search = index.ContentSearch(workers)
+            search.get_pool().submit(int).result()
+            for label, pattern, flags in (('literal', b'needle', 0),
+                                          ('ignorecase', b'NEEDLE', index.re.IGNORECASE),
+                                          ('regex', rb'ERROR \d{3}', 0)):
+                events = list(search.search(root, pattern, flags, 1, index.threading.Event()))
+                done = events[-1]
+                mb = done['bytes'] / 2**20
+                print(f'{workers:>7} {label:<12} {done["matches"]:>7} {done["seconds"]:>8.2f} '
+                      f'{mb / done["seconds"]:>8.0f} {mb / done["seconds"] / workers:>10.0f}')
+            search.pool.shutdown()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+# Копирование в отдельном процессе: время и пиковый RSS именно этого способа
+COPY_SCRIPT = """
+import os, resource, shutil, sys, time
+sys.path.insert(0, {here!r})
+import index
+method, src, dst = sys.argv[1:]
+start = time.perf_counter()
+if method == 'legacy' and os.path.isdir(src):
+    shutil.copytree(src, dst)
+elif method == 'legacy':
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fdst.write(fsrc.read())
+elif os.path.isdir(src):
+    index.copy_tree(src, dst)
+else:
+    index.copy_file(src, dst)
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def bench_copy(args):
+    root = tempfile.mkdtemp(prefix='fm-bench-', dir=args.dir)
+    try:
+        big = os.path.join(root, 'big.bin')
+        with open(big, 'wb') as f:
+            for _ in range(args.file_mb):
+                f.write(os.urandom(1024 * 1024))
+        tree = os.path.join(root, 'tree')
+        per_file = 256 * 1024
+        for i in range(args.tree_mb * 1024 * 1024 // per_file):
+            d = os.path.join(tree, f'd{i // 100}')
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f'f{i}'), 'wb') as f:
+                f.write(os.urandom(per_file))
+        script = COPY_SCRIPT.format(here=HERE)
+
+        print(f'{"source":<8} {"method":<8} {"seconds":>8} {"GB/s":>7} {"peak RSS MB":>12}')
+        for label, src, mb in (('file', big, args.file_mb), ('tree', tree, args.tree_mb)):
+            for method in ('legacy', 'current'):
+                dst = os.path.join(root, f'{label}-{method}')
+                seconds, rss = subprocess.check_output(
+                    [sys.executable, '-c', script, method, src, dst]).split()
+                seconds = float(seconds)
+                print(f'{label:<8} {method:<8} {seconds:>8.2f} {mb / 1024 / seconds:>7.2f} '
+                      f'{int(rss) / 1024:>12.1f}')
+                if os.path.isdir(dst):
+                    shutil.rmtree(dst)
+                else:
+                    os.remove(dst)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def json_request(port, method, path, body=None):
+    """Запрос с JSON ответом, возвращает (секунды, данные)"""
+    import json
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        headers = {'Cookie': COOKIE}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        start = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        data = json.loads(conn.getresponse().read())
+        return time.perf_counter() - start, data
+    finally:
+        conn.close()
+
+def bench_editor(args):
+    import random
+    import urllib.parse
+    root = tempfile.mkdtemp(prefix='fm-bench-', dir=args.dir)
+    try:
+        path = os.path.join(root, 'big.log')
+        make_text_files(root, args.mb, file_mb=args.mb)
+        os.rename(os.path.join(root, 'app0.log'), path)
+        lines_url = f'/?lines={urllib.parse.quote(path)}'
+        with Server(root) as server:
+            request(server.port, '/')
+            base = rss_kb(server.proc.pid)
+            sampler = RssSampler(server.proc.pid)
+            sampler.start()
+
+            seconds, window = json_request(server.port, 'GET', lines_url + '&start=0')
+            print(f'index build:    {seconds:8.3f} s  ({window["lines"]} lines, '
+                  f'{args.mb / seconds:.0f} MB/s)')
+            times = []
+            for _ in range(args.windows):
+                start = random.randrange(window['lines'])
+                times.append(json_request(server.port, 'GET', f'{lines_url}&start={start}')[0])
+            times.sort()
+            print(f'random window:  {times[len(times) // 2] * 1000:8.2f} ms p50, '
+                  f'{times[int(len(times) * 0.99)] * 1000:.2f} ms p99')
+
+            seconds, tail = json_request(server.port, 'GET', lines_url + '&start=-500')
+            with open(path, 'ab') as f:
+                f.write(b'appended line\n' * 1000)
+            seconds, follow = json_request(
+                server.port, 'GET', f'{lines_url}&since={tail["end"]}&inode={tail["inode"]}')
+            print(f'tail follow:    {seconds * 1000:8.2f} ms  (+{follow["text"].count(chr(10))} lines)')
+
+            window = json_request(server.port, 'GET', f'{lines_url}&start={window["lines"] // 2}')[1]
+            body = urllib.parse.urlencode({
+                'action': 'patch', 'path': path, 'etag': window['etag'],
+                'offset': window['offset'], 'end': window['end'],
+                'content': window['text'].upper()})
+            seconds, result = json_request(server.port, 'POST', '/', body)
+            print(f'window patch:   {seconds:8.3f} s  ({args.mb / seconds:.0f} MB/s rewritten)')
+            peak = sampler.stop()
+            print(f'server RSS:     {base / 1024:8.1f} MB base, {peak / 1024:.1f} MB peak')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_thumbs(args):
+    try:
+        from PIL import Image
+    except ImportError:
+        sys.exit('thumbs: нужен Pillow')
+    import random
+    import urllib.parse
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        for i in range(args.images):
+            # Шум, чтобы JPEG весил как фотография, а не как заливка
+            noise = Image.effect_noise((args.width, args.width * 3 // 4), 64).convert('RGB')
+            noise.save(os.path.join(root, f'photo{i:04}.jpg'), quality=90)
+        originals = sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root))
+        names = sorted(os.listdir(root))
+        with Server(root) as server:
+            request(server.port, '/')
+            for label in ('cold', 'warm'):
+                random.shuffle(names)
+                total = 0
+                start = time.perf_counter()
+                for name in names:
+                    status, size = request(server.port, '/?thumb=' + urllib.parse.quote(os.path.join(root, name)))
+                    total += size
+                elapsed = time.perf_counter() - start
+                print(f'{label}: {len(names) / elapsed:8.1f} thumbs/s, {elapsed / len(names) * 1000:6.2f} ms each, '
+                      f'{total / 1024:.0f} KB of thumbnails vs {originals / 2**20:.1f} MB of originals')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_archive(args):
+    import urllib.parse
+    root = tempfile.mkdtemp(prefix='fm-bench-', dir=args.dir)
+    try:
+        data = os.path.join(root, 'data')
+        os.mkdir(data)
+        make_text_files(data, args.mb // 2)
+        with open(os.path.join(data, 'video.mp4'), 'wb') as f:
+            for _ in range(args.mb // 2):
+                f.write(os.urandom(1024 * 1024))
+        print(f'{"format":<10} {"MB/s":>8} {"archive MB":>11} {"base RSS MB":>12} {"peak RSS MB":>12}')
+        with Server(root) as server:
+            request(server.port, '/')
+            base = rss_kb(server.proc.pid)
+            for fmt in ('zip-store', 'zip', 'tar.gz'):
+                sampler = RssSampler(server.proc.pid)
+                sampler.start()
+                start = time.perf_counter()
+                status, size = request(server.port, '/?' + urllib.parse.urlencode(
+                    {'archive': data, 'format': fmt}))
+                elapsed = time.perf_counter() - start
+                peak = sampler.stop()
+                print(f'{fmt:<10} {args.mb / elapsed:>8.0f} {size / 2**20:>11.0f} '
+                      f'{base / 1024:>12.1f} {peak / 1024:>12.1f}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_extract(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-', dir=args.dir)
+    try:
+        data = os.path.join(root, 'data')
+        os.mkdir(data)
+        make_text_files(data, args.mb, file_mb=1)
+        for fmt in ('zip', 'gztar'):
+            path = shutil.make_archive(os.path.join(root, 'bench'), fmt, root, 'data')
+            start = time.perf_counter()
+            archive = index.ArchiveIndex(path)
+            print(f'{os.path.basename(path)}: {len(archive.members)} members, '
+                  f'index {time.perf_counter() - start:.3f} s')
+            for workers in [int(w) for w in args.workers.split(',')]:
+                if archive.kind == 'tar' and workers > 1:
+                    continue
+                job = {'files_done': 0, 'bytes_done': 0, 'current': None, 'paths': [path]}
+                dest = os.path.join(root, 'out')
+                start = time.perf_counter()
+                index.run_extract(archive, '', [], dest, workers)(job, index.threading.Event())
+                elapsed = time.perf_counter() - start
+                print(f'  extract, {workers} workers: {elapsed:.2f} s, '
+                      f'{job["bytes_done"] / 2**20 / elapsed:.0f} MB/s')
+                shutil.rmtree(dest)
+            os.remove(path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_auth(args):
+    import email.message
+    import hashlib
+    sys.path.insert(0, HERE)
+    import index
+
+    def handler(cookie):
+        h = index.FileManagerHandler.__new__(index.FileManagerHandler)
+        h.headers = email.message.Message()
+        h.headers['Cookie'] = f'theme=dark; lang=ru; {cookie}'
+        h.session = None
+        return h
+
+    def legacy_check_auth(self):
+        # Проверка до сессий: пароль открытым текстом в cookie
+        if 'Cookie' in self.headers:
+            for cookie in self.headers['Cookie'].split(';'):
+                if 'filemanager_auth' in cookie:
+                    return cookie.split('=')[1].strip() == PASSWORD
+        return False
+
+    def per_call(func, h, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            h.session = None
+            func(h)
+        return (time.perf_counter() - start) / count
+
+    print(f'{"scrypt N":>9} {"login ms":>9}')
+    for n in (2 ** 12, 2 ** 14, 2 ** 16):
+        password_hash = index.hash_password(PASSWORD, n=n)
+        start = time.perf_counter()
+        assert index.verify_password(PASSWORD, password_hash)
+        print(f'{n:>9} {(time.perf_counter() - start) * 1000:>9.1f}')
+
+    store = index.SESSIONS = index.SessionStore()
+    store.set_password(password_hash=index.hash_password(PASSWORD))
+    token = store.login(PASSWORD, '127.0.0.1')
+    legacy = handler(f'filemanager_auth={PASSWORD}')
+    current = handler(f'{index.SESSION_COOKIE}={token}')
+    forged = handler(f'{index.SESSION_COOKIE}={token[:-4]}AAAA')
+    print(f'{"sessions":>9} {"legacy us":>10} {"session us":>11} {"forged us":>10}')
+    for n in [int(c) for c in args.sessions.split(',')]:
+        expires = time.time() + 3600
+        secret_hash = hashlib.sha256(b'x').hexdigest()
+        for i in range(len(store.sessions), n):
+            store.sessions[f'bench{i}'] = (secret_hash, expires, None)
+        assert current.check_auth() and not forged.check_auth()
+        old = per_call(legacy_check_auth, legacy, args.count)
+        new = per_call(index.FileManagerHandler.check_auth, current, args.count)
+        bad = per_call(index.FileManagerHandler.check_auth, forged, args.count)
+        print(f'{len(store.sessions):>9} {old * 1e6:>10.2f} {new * 1e6:>11.2f} {bad * 1e6:>10.2f}')
+
+def bench_quota(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        print(f'{"files":>8} {"walk ms":>8} {"rewalk ms":>10} {"charge us":>10}')
+        for n in [int(f) for f in args.files.split(',')]:
+            tree = os.path.join(root, str(n))
+            os.mkdir(tree)
+            make_deep_tree(tree, n)
+            # Полный обход с нуля и повторный по кешу DIR_SIZES - столько стоила бы
+            # проверка квоты без учёта приращениями
+            index.DIR_SIZES = index.DirectorySizes()
+            start = time.perf_counter()
+            index.DIR_SIZES.usage(tree, limit=0)
+            walk = time.perf_counter() - start
+            start = time.perf_counter()
+            index.DIR_SIZES.usage(tree, limit=0)
+            rewalk = time.perf_counter() - start
+
+            quotas = index.DiskQuotas()
+            quotas.track(tree, 2 ** 60)
+            path = os.path.join(tree, 'group0', 'dir0', 'new.bin')
+            quotas.charge(path, 1)
+            start = time.perf_counter()
+            for _ in range(args.count):
+                quotas.charge(path, 4096)
+                quotas.release(path, 4096)
+            charge = (time.perf_counter() - start) / args.count / 2
+            print(f'{n:>8} {walk * 1000:>8.1f} {rewalk * 1000:>10.1f} {charge * 1e6:>10.2f}')
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_paths(args):
+    sys.path.insert(0, HERE)
+    import index
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        data = os.path.join(root, *[f'level{i}' for i in range(args.depth)], 'data')
+        os.makedirs(os.path.dirname(data))
+        make_flat_dir(data, args.entries)
+        paths = [os.path.join(data, name) for name in os.listdir(data)]
+
+        def legacy(path):
+            # Проверка до общего резолвера: префикс abspath без раскрытия ссылок
+            return os.path.abspath(path).startswith(root)
+
+        uncached = index.PathResolver(max_entries=0)
+        cached = index.PathResolver(max_entries=max(args.entries * 2, 1))
+        print(f'{args.entries} paths, depth {args.depth + 2}')
+        print(f'{"check":<10} {"us/path":>8}')
+        for label, check in (('abspath', legacy),
+                             ('realpath', lambda path: uncached.inside(path, root)),
+                             ('cached', lambda path: cached.inside(path, root))):
+            assert all(map(check, paths))
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for path in paths:
+                    check(path)
+            elapsed = (time.perf_counter() - start) / args.repeat / len(paths)
+            print(f'{label:<10} {elapsed * 1e6:>8.2f}')
+        print(f'cache: {cached.stats()}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def fetch(port, method, path, body=None, cookie=None, headers=None):
+    """Запрос с произвольным телом, возвращает (статус, тело)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        headers = {'Cookie': COOKIE if cookie is None else cookie, **(headers or {})}
+        if isinstance(body, dict):
+            import urllib.parse
+            body = urllib.parse.urlencode(body, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+def bench_traversal(args):
+    """Попытки выйти за корень пользователя через все маршруты и действия.
+
+    Тестов в репозитории нет, поэтому набор живёт здесь: каждый случай -
+    запрос, допустимые статусы и проверка, что секрет не утёк и за корнем
+    ничего не появилось. Код возврата 1, если хоть один случай не прошёл.
+    """
+    import urllib.parse
+    base = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        root = os.path.join(base, 'root')
+        outside = os.path.join(base, 'outside')
+        os.makedirs(root)
+        os.makedirs(outside)
+        secret = os.path.join(outside, 'secret.txt')
+        admin_secret = os.path.join(root, 'admin-secret.txt')
+        for path, text in ((secret, 'OUTSIDE-SECRET'), (admin_secret, 'ADMIN-SECRET')):
+            with open(path, 'w') as f:
+                f.write(text + '\n')
+
+        with Server(root, extra=('--allow-register', '--no-index')) as server:
+            admin = COOKIE
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+            conn.request('POST', '/', body='action=register&username=eve&password=eve-password',
+                         headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            eve = conn.getresponse().getheader('Set-Cookie', '').split(';')[0]
+            conn.close()
+
+            home = os.path.join(root, 'site', 'eve')
+            with open(os.path.join(home, 'own.txt'), 'w') as f:
+                f.write('EVE-OWN\n')
+            os.makedirs(os.path.join(home, 'dir'))
+            with open(os.path.join(home, 'dir', 'ok.txt'), 'w') as f:
+                f.write('EVE-DIR\n')
+            # Ссылки, которые мог оставить администратор или распаковка вне сервера
+            os.symlink(outside, os.path.join(home, 'link_out'))
+            os.symlink(secret, os.path.join(home, 'link_file'))
+            os.symlink(admin_secret, os.path.join(home, 'link_admin'))
+            os.symlink(secret, os.path.join(home, 'dir', 'inner_link'))
+
+            q = urllib.parse.quote
+            leaks = (b'OUTSIDE-SECRET', b'ADMIN-SECRET')
+            DENIED = (403, 404)
+            cases = [
+                # (описание, метод, путь, тело, cookie, допустимые статусы)
+                ('view outside', 'GET', f'/?view={q(secret)}', None, eve, DENIED),
+                ('view ../ from home', 'GET', f'/?view={q(home)}/../../../outside/secret.txt', None, eve, DENIED),
+                ('view relative ../', 'GET', '/?view=../outside/secret.txt', None, eve, DENIED),
+                ('view admin file', 'GET', f'/?view={q(admin_secret)}', None, eve, DENIED),
+                ('view file link', 'GET', f'/?view={q(home)}/link_file', None, eve, DENIED),
+                ('view via dir link', 'GET', f'/?view={q(home)}/link_out/secret.txt', None, eve, DENIED),
+                ('view null byte', 'GET', f'/?view={q(home)}/own.txt%00', None, eve, DENIED),
+                ('preview link', 'GET', f'/?preview={q(home)}/link_admin', None, eve, DENIED),
+                ('lines outside', 'GET', f'/?lines={q(secret)}', None, eve, DENIED),
+                ('thumb outside', 'GET', f'/?thumb={q(secret)}', None, eve, DENIED),
+                ('browse outside', 'GET', f'/?browse={q(secret)}', None, eve, DENIED),
+                ('member outside', 'GET', f'/?member={q(secret)}&name=x', None, eve, DENIED),
+                ('archive dir link', 'GET', f'/?archive={q(home)}/link_out&format=zip-store', None, eve, DENIED),
+                ('archive skips inner link', 'GET', f'/?archive={q(home)}/dir&format=zip-store', None, eve, (200,)),
+                ('grep skips links', 'GET', f'/?grep=SECRET&scope={q(home)}', None, eve, (200,)),
+                ('grep outside scope', 'GET', f'/?grep=SECRET&scope={q(root)}', None, eve, DENIED),
+                ('dir outside', 'GET', f'/?dir={q(outside)}', None, eve, (200,)),
+                ('dir via link', 'GET', f'/?dir={q(home)}/link_out', None, eve, (200,)),
+                ('list outside', 'GET', f'/?list={q(outside)}', None, eve, (200,)),
+                ('static ../', 'GET', '/../../outside/secret.txt', None, eve, DENIED),
+                ('static %2e%2e', 'GET', '/%2e%2e/%2e%2e/outside/secret.txt', None, eve, DENIED),
+                ('static link', 'GET', '/link_file', None, eve, DENIED),
+                ('create ../', 'POST', '/', {'action': 'create_file', 'current_dir': home,
+                                             'name': '../../pwned'}, eve, DENIED),
+                ('create in dir link', 'POST', '/', {'action': 'create_file',
+                                                     'current_dir': os.path.join(home, 'link_out'),
+                                                     'name': 'pwned'}, eve, DENIED),
+                ('folder ../', 'POST', '/', {'action': 'create_folder', 'current_dir': home,
+                                             'name': '../../../outside/pwned'}, eve, DENIED),
+                ('rename out', 'POST', '/', {'action': 'rename', 'path': os.path.join(home, 'own.txt'),
+                                             'new_name': '../../pwned'}, eve, DENIED),
+                ('rename root', 'POST', '/', {'action': 'rename', 'path': home, 'new_name': 'x'}, eve, DENIED),
+                ('delete root', 'POST', '/', {'action': 'delete', 'path': home}, eve, DENIED),
+                ('delete admin file', 'POST', '/', {'action': 'delete', 'path': admin_secret}, eve, DENIED),
+                ('clone dir link', 'POST', '/', {'action': 'clone', 'path': os.path.join(home, 'link_out')},
+                 eve, DENIED),
+                ('save file link', 'POST', '/', {'action': 'save', 'path': os.path.join(home, 'link_file'),
+                                                 'content': 'pwned'}, eve, DENIED),
+                ('save outside', 'POST', '/', {'action': 'save', 'path': secret, 'content': 'pwned'}, eve, DENIED),
+                ('patch file link', 'POST', '/', {'action': 'patch', 'path': os.path.join(home, 'link_file'),
+                                                  'offset': 0, 'end': 0, 'etag': 'x', 'content': 'pwned'},
+                 eve, DENIED),
+                ('download link', 'POST', '/', {'action': 'download', 'path': os.path.join(home, 'link_out'),
+                                                'format': 'zip-store'}, eve, DENIED),
+                ('extract outside', 'POST', '/', {'action': 'extract', 'path': os.path.join(home, 'own.txt'),
+                                                  'dest': outside}, eve, DENIED),
+                ('upload init outside', 'POST', '/', {'action': 'upload_init', 'current_dir': outside,
+                                                      'name': 'pwned', 'size': 1}, eve, DENIED),
+                ('head anonymous', 'HEAD', '/admin-secret.txt', None, '', DENIED),
+                ('head accounts', 'HEAD', '/.filemanager/users.json', None, '', DENIED),
+                ('head other root', 'HEAD', '/admin-secret.txt', None, eve, DENIED),
+                ('head file link', 'HEAD', '/link_file', None, eve, DENIED),
+                ('head query route', 'HEAD', f'/?view={q(secret)}', None, eve, DENIED + (405,)),
+                ('admin view outside', 'GET', f'/?view={q(secret)}', None, admin, DENIED),
+                ('admin view via ../', 'GET', f'/?view={q(root)}/../outside/secret.txt', None, admin, DENIED),
+            ]
+            boundary = 'travers4l'
+            upload = (f'--{boundary}\r\nContent-Disposition: form-data; name="current_dir"\r\n\r\n'
+                      f'{home}/link_out\r\n--{boundary}\r\nContent-Disposition: form-data; name="f"; '
+                      f'filename="pwned"\r\n\r\nPWNED\r\n--{boundary}--\r\n').encode()
+
+            failures = 0
+            print(f'{"case":<26} {"status":>6}  result')
+            for name, method, path, body, cookie, allowed in cases:
+                try:
+                    status, data = fetch(server.port, method, path, body, cookie)
+                except (OSError, http.client.HTTPException):
+                    status, data = 0, b''
+                ok = status in allowed and not any(leak in data for leak in leaks)
+                failures += not ok
+                print(f'{name:<26} {status:>6}  {"ok" if ok else "FAIL"}')
+            status, data = fetch(server.port, 'POST', '/', upload, eve,
+                                 {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+            ok = status in DENIED
+            failures += not ok
+            print(f'{"upload into dir link":<26} {status:>6}  {"ok" if ok else "FAIL"}')
+
+            # Удаляется сама ссылка, файл за корнем остаётся
+            status, _ = fetch(server.port, 'POST', '/', {'action': 'delete', 'format': 'json',
+                                                         'path': os.path.join(home, 'link_file')}, eve)
+            deadline = time.time() + 10
+            while os.path.lexists(os.path.join(home, 'link_file')) and time.time() < deadline:
+                time.sleep(0.05)
+            ok = status == 200 and not os.path.lexists(os.path.join(home, 'link_file'))
+            failures += not ok
+            print(f'{"delete link itself":<26} {status:>6}  {"ok" if ok else "FAIL"}')
+
+            # Свои файлы по-прежнему доступны
+            for name, path, cookie, text in (('own file', f'/?view={q(home)}/own.txt', eve, b'EVE-OWN'),
+                                             ('admin own file', f'/?view={q(admin_secret)}', admin,
+                                              b'ADMIN-SECRET')):
+                status, data = fetch(server.port, 'GET', path, cookie=cookie)
+                ok = status == 200 and text in data
+                failures += not ok
+                print(f'{name:<26} {status:>6}  {"ok" if ok else "FAIL"}')
+
+        with open(secret) as f:
+            intact = f.read() == 'OUTSIDE-SECRET\n'
+        created = [os.path.join(dirpath, name) for dirpath, dirs, names in os.walk(base)
+                   for name in dirs + names if 'pwned' in name]
+        ok = intact and os.path.exists(admin_secret) and not created
+        failures += not ok
+        print(f'{"files outside untouched":<26} {"":>6}  {"ok" if ok else "FAIL " + str(created)}')
+        print(f'{failures} failed')
+        if failures:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+def bench_concurrency(args):
+    engines = args.engines.split(',')
+    clients = [int(c) for c in args.clients.split(',')]
+    root = tempfile.mkdtemp(prefix='fm-bench-')
+    try:
+        make_tree(root)
+        print(f'{"engine":<10} {"clients":>7} {"req/s":>10} {"errors":>7}   (stalled: {args.slow})')
+        for engine in engines:
+            with Server(root, engine) as server:
+                socks = stall_connections(server.port, args.slow)
+                try:
+                    for n in clients:
+                        rps, errors = run_clients(server.port, '/', n, args.seconds)
+                        print(f'{engine:<10} {n:>7} {rps:>10.1f} {errors:>7}')
+                finally:
+                    for s in socks:
+                        s.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('concurrency', help='req/s в зависимости от числа клиентов')
+    p.add_argument('--engines', default='single,threaded,asyncio')
+    p.add_argument('--clients', default='1,4,16,64')
+    p.add_argument('--seconds', type=float, default=3)
+    p.add_argument('--slow', type=int, default=0, help='Зависших соединений во время замера')
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser('download', help='скорость и RSS сервера при отдаче файлов')
+    p.add_argument('--engine', default='threaded')
+    p.add_argument('--sizes', default='1,64,512', help='Размеры файлов, МБ')
+    p.add_argument('--parallel', type=int, default=4)
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser('upload', help='скорость и RSS сервера при загрузке файлов')
+    p.add_argument('--engine', default='threaded')
+    p.add_argument('--sizes', default='1,64,512', help='Размеры файлов, МБ')
+    p.add_argument('--parallel', type=int, default=4)
+    p.set_defaults(func=bench_upload)
+
+    p = sub.add_parser('listing', help='чтение директории: listdir+stat против scandir')
+    p.add_argument('--entries', default='1000,10000,100000')
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_listing)
+
+    p = sub.add_parser('render', help='TTFB и время отрисовки страниц против другой ревизии')
+    p.add_argument('--baseline', default='HEAD~1',
+                   help='git ревизия для сравнения (с поддержкой --engine)')
+    p.add_argument('--entries', type=int, default=5000)
+    p.add_argument('--repeat', type=int, default=30)
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser('keepalive', help='задержка запросов: keep-alive против соединения на запрос')
+    p.add_argument('--engines', default='threaded,asyncio')
+    p.add_argument('--requests', type=int, default=500)
+    p.set_defaults(func=bench_keepalive)
+
+    p = sub.add_parser('idle', help='новый запрос при простаивающих соединениях и потоках событий')
+    p.add_argument('--engines', default='threaded,asyncio')
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--idle', default='4,64', help='Простаивающих keep-alive соединений')
+    p.add_argument('--streams', type=int, default=8, help='Открытых потоков событий (SSE)')
+    p.add_argument('--requests', type=int, default=20)
+    p.set_defaults(func=bench_idle)
+
+    p = sub.add_parser('search', help='время индексации и поиска по имени')
+    p.add_argument('--files', type=int, default=200000)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser('grep', help='скорость поиска по содержимому, МБ/с на ядро')
+    p.add_argument('--mb', type=int, default=256, help='Объём текстовых файлов')
+    p.add_argument('--workers', default='1,2,4')
+    p.set_defaults(func=bench_grep)
+
+    p = sub.add_parser('copy', help='скорость и RSS копирования файла и дерева')
+    p.add_argument('--file-mb', type=int, default=1024)
+    p.add_argument('--tree-mb', type=int, default=512)
+    p.add_argument('--dir', default=None, help='Где создавать данные (файловая система важна)')
+    p.set_defaults(func=bench_copy)
+
+    p = sub.add_parser('editor', help='постраничный редактор: индекс строк, окна, tail, правка')
+    p.add_argument('--mb', type=int, default=1024, help='Размер файла')
+    p.add_argument('--windows', type=int, default=200, help='Случайных окон для замера')
+    p.add_argument('--dir', default=None, help='Где создавать данные')
+    p.set_defaults(func=bench_editor)
+
+    p = sub.add_parser('thumbs', help='миниатюры: построение, кеш и объём против оригиналов')
+    p.add_argument('--images', type=int, default=200)
+    p.add_argument('--width', type=int, default=4000, help='Ширина фотографии, px')
+    p.set_defaults(func=bench_thumbs)
+
+    p = sub.add_parser('archive', help='скачивание папки архивом: скорость и RSS сервера')
+    p.add_argument('--mb', type=int, default=2048, help='Объём папки (половина - текст, половина - видео)')
+    p.add_argument('--dir', default=None, help='Где создавать данные')
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser('extract', help='оглавление архива и распаковка в несколько потоков')
+    p.add_argument('--mb', type=int, default=512, help='Объём данных в архиве')
+    p.add_argument('--workers', default='1,4')
+    p.add_argument('--dir', default=None, help='Где создавать данные')
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser('auth', help='стоимость входа (scrypt) и проверки сессии в запросе')
+    p.add_argument('--sessions', default='1,10000,1000000', help='Активных сессий в словаре')
+    p.add_argument('--count', type=int, default=200000, help='Проверок на замер')
+    p.set_defaults(func=bench_auth)
+
+    p = sub.add_parser('quota', help='проверка квоты: учёт приращениями против обхода дерева')
+    p.add_argument('--files', default='10000,100000', help='Файлов в корне пользователя')
+    p.add_argument('--count', type=int, default=100000, help='Резервирований на замер')
+    p.set_defaults(func=bench_quota)
+
+    p = sub.add_parser('paths', help='проверка пути: abspath против realpath с кешем и без')
+    p.add_argument('--entries', type=int, default=10000, help='Разных путей (как файлов в листинге)')
+    p.add_argument('--depth', type=int, default=8, help='Вложенность директории с файлами')
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_paths)
+
+    p = sub.add_parser('traversal', help='набор попыток выйти за корень пользователя (код 1 при провале)')
+    p.set_defaults(func=bench_traversal)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
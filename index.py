@@ -7,12 +7,4715 @@ import urllib.parse
 import html
 import time
 import mimetypes
+import socket
+import asyncio
+import threading
+import argparse
+import getpass
+import secrets
+import email.utils
+import email.message
+import tempfile
+import re
+import hashlib
+import hmac
+import base64
+import stat
+import zlib
+import queue
+import shutil
+import sqlite3
+import select
+import selectors
+import itertools
+import struct
+import ctypes
+import ctypes.util
+import mmap
+import errno
+import fcntl
+import fnmatch
+import heapq
+import multiprocessing
+import bisect
+import zipfile
+import tarfile
+import gzip
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Необязательные алгоритмы сжатия
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Миниатюры картинок делает Pillow, без него в листинге остаются иконки
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:
+    Image = None
+
+# Настройки сервера
+SERVER_ENGINE = 'threaded'      # threaded | asyncio | single
+MAX_WORKERS = 32                # Потоков на обработку запросов
+MAX_PENDING = 128               # Соединений в очереди сверх MAX_WORKERS
+REQUEST_TIMEOUT = 60            # Таймаут чтения запроса, сек
+KEEPALIVE_TIMEOUT = 15          # Ожидание следующего запроса в соединении, сек
+KEEPALIVE_MAX_REQUESTS = 100    # Запросов в одном соединении, потом оно закрывается
+CHUNK_SIZE = 256 * 1024         # Размер куска при потоковой отдаче файлов
+MAX_RANGES = 16                 # Максимум диапазонов в одном Range запросе
+UPLOAD_PARALLEL = 3             # Одновременных загрузок файлов из браузера
+MAX_FIELD_SIZE = 1024 * 1024    # Максимальный размер обычного поля формы
+MAX_PART_HEADERS = 16 * 1024    # Максимальный размер заголовков части multipart
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024     # Кусок докачиваемой загрузки
+UPLOAD_SESSION_TTL = 7 * 24 * 3600      # Сколько хранить незавершённую загрузку, сек
+SESSION_COOKIE = 'filemanager_session'  # Cookie с токеном сессии входа
+SESSION_TTL = 7 * 24 * 3600             # Время жизни сессии входа, сек
+SESSION_PERSIST = True                  # Сохранять сессии в DATA_DIR, чтобы пережить перезапуск
+AUTH_SCRYPT_N = 2 ** 14                 # Стоимость scrypt для хеша пароля (память 128*N*r байт)
+AUTH_SCRYPT_R = 8                       # Размер блока scrypt
+LOGIN_PARALLEL = 2                      # Одновременных проверок пароля (каждая ест память scrypt)
+LOGIN_MAX_FAILURES = 5                  # Неудачных входов с одного адреса за окно
+LOGIN_WINDOW = 60                       # Окно ограничения попыток входа, сек
+LOGIN_TRACK_ADDRESSES = 10000           # Адресов в учёте попыток входа
+ALLOW_REGISTRATION = False              # Регистрация новых пользователей из формы входа
+DEFAULT_QUOTA = 1024 * 1024 * 1024      # Квота нового пользователя, байт (0 - без ограничения)
+QUOTA_RECOUNT_INTERVAL = 3600           # Пересчитывать занятое место с диска не реже, сек
+
+LISTING_CACHE_BYTES = 64 * 1024 * 1024  # Память под кеш листингов директорий
+LISTING_CACHE_TTL = 30                  # Перечитывать закешированный листинг не реже, сек
+LISTING_PAGE_SIZE = 200                 # Строк листинга за одну порцию
+LISTING_MAX_PAGE = 2000                 # Максимальный limit в ?list=
+ROWS_PER_CHUNK = 50                     # Строк листинга в одном куске chunked ответа
+COMPRESS_MIN_SIZE = 1024                # Меньшие ответы не сжимаем
+COMPRESS_CACHE_BYTES = 64 * 1024 * 1024 # Память под сжатые копии файлов
+COMPRESS_CACHE_MAX_FILE = 4 * 1024 * 1024   # Файлы крупнее сжимаются потоком без кеша
+INDEX_RESCAN_INTERVAL = 300             # Период досканирования индекса файлов, сек
+INDEX_COMMIT_ROWS = 5000                # Строк индекса в одной транзакции при сканировании
+SEARCH_LIMIT = 200                      # Результатов поиска по умолчанию
+SEARCH_MAX_LIMIT = 2000                 # Максимальный limit в ?search=
+SEARCH_RANK_CANDIDATES = 5              # Кандидатов для ранжирования поиска, во столько раз больше limit
+WATCH_POLL_INTERVAL = 2                 # Опрос директорий, если inotify недоступен, сек
+WATCH_COALESCE = 0.2                    # Склеивание пачки событий файловой системы, сек
+WATCH_MAX_DELAY = 1.0                   # Дольше событие в пачке не задерживается, сек
+WATCH_MAX_STREAMS = 16                  # Открытых потоков событий (у каждого свой поток вне пула)
+WATCH_PING_INTERVAL = 15                # Пинг в пустом потоке событий, сек
+GREP_WORKERS = os.cpu_count() or 1      # Процессов для поиска по содержимому
+GREP_BATCH_BYTES = 8 * 1024 * 1024      # Объём файлов в одном задании процесса
+GREP_BATCH_FILES = 256                  # И число файлов в нём
+GREP_SNIFF_BYTES = 8192                 # По стольким первым байтам отличаем бинарный файл
+GREP_MAX_MATCHES = 1000                 # Совпадений в одном ответе
+GREP_MAX_FILE_MATCHES = 100             # Совпадений в одном файле
+GREP_MAX_LINE = 400                     # Длина строки в результате, символов
+GREP_MAX_CONTEXT = 5                    # Строк контекста до и после совпадения
+DU_WORKERS = 8                          # Потоков для подсчёта размеров директорий
+DU_CACHE_DIRS = 200000                  # Директорий в кеше размеров
+DU_CACHE_TTL = 300                      # Перечитывать закешированную директорию не реже, сек
+DU_TOP_FILES = 50                       # Крупнейших файлов в отчёте
+DU_MAX_ITEMS = 2000                     # Максимальный limit в ?du=
+JOB_WORKERS = 2                         # Одновременно выполняемых фоновых заданий
+JOB_KEEP = 3600                         # Сколько помнить завершённые задания, сек
+COPY_WORKERS = 4                        # Потоков для копирования файлов дерева
+COPY_CHUNK = 16 * 1024 * 1024           # Копирование ядром порциями (для прогресса и отмены)
+EDITOR_INLINE_MAX = 1024 * 1024         # Файлы крупнее открываются в постраничном редакторе
+EDITOR_WINDOW_LINES = 500               # Строк в окне постраничного редактора
+EDITOR_MAX_WINDOW = 5000                # Максимальный count в ?lines=
+EDITOR_WINDOW_BYTES = 1024 * 1024       # Максимальный объём одного окна
+EDITOR_FOLLOW_INTERVAL = 2              # Опрос дописываемого файла в режиме tail, сек
+LINE_INDEX_BLOCK = 64 * 1024            # Шаг разреженного индекса строк, байт
+LINE_INDEX_READ = 1024 * 1024           # Чтение при построении индекса строк
+LINE_INDEX_FILES = 32                   # Файлов в кеше индексов строк
+THUMB_SIZE = 160                        # Сторона миниатюры картинки, px
+THUMB_QUALITY = 75                      # Качество WebP/JPEG миниатюр
+THUMB_WORKERS = os.cpu_count() or 1     # Потоков для построения миниатюр
+THUMB_CACHE_BYTES = 256 * 1024 * 1024   # Место на диске под кеш миниатюр
+THUMB_PASSTHROUGH = 256 * 1024          # SVG и (без Pillow) небольшие картинки идут в листинг как есть
+ARCHIVE_CACHE_FILES = 16                # Архивов с оглавлением в памяти
+PATH_CACHE_SIZE = 16384                 # Путей в кеше realpath
+PATH_CACHE_TTL = 5                      # Перепроверять закешированный путь не реже, сек
+PATH_CACHE_MAX_LEN = 4096               # Более длинные пути не кешируются
+
+# Служебные данные сервера (сессии загрузок и т.п.)
+DATA_DIR = os.path.join(os.getcwd(), '.filemanager')
+# Корни пользователей: site/<имя>, как в index.php
+USER_ROOTS_DIR = os.path.join(os.getcwd(), 'site')
+
+# Права для новых файлов берём из umask процесса (mkstemp создаёт 0600)
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def file_etag(st):
+    """Строит ETag файла по данным os.stat"""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def header_params(value):
+    """Разбирает параметры заголовка вида 'form-data; name="x"; filename="y"'"""
+    msg = email.message.Message()
+    msg['X'] = value
+    return dict(msg.get_params([], header='X')[1:])
+
+class MultipartPart:
+    """Часть multipart тела: заголовки и потоковое чтение данных"""
+    
+    def __init__(self, reader, headers):
+        self.reader = reader
+        self.headers = headers
+        params = header_params(headers.get('content-disposition', ''))
+        self.name = params.get('name', '')
+        self.filename = params.get('filename')
+        self.done = False
+    
+    def iter_chunks(self):
+        """Отдаёт данные части кусками до следующей границы"""
+        if self.done:
+            return
+        yield from self.reader.iter_data()
+        self.done = True
+    
+    def read_value(self, limit=MAX_FIELD_SIZE):
+        """Читает значение обычного поля целиком"""
+        data = bytearray()
+        for chunk in self.iter_chunks():
+            data += chunk
+            if len(data) > limit:
+                raise ValueError(f"Form field '{self.name}' is too large")
+        return data.decode('utf-8', errors='replace')
+
+class MultipartReader:
+    """Потоковый разбор multipart/form-data из rfile.
+    
+    В памяти держится не больше пары кусков CHUNK_SIZE, сколько бы ни весило тело.
+    Каждую часть нужно дочитать до конца, прежде чем переходить к следующей.
+    """
+    
+    def __init__(self, rfile, boundary, length):
+        self.rfile = rfile
+        self.remaining = length
+        self.delimiter = b'\r\n--' + boundary
+        # Первой границе не предшествует CRLF, добавляем его для единообразия
+        self.buf = bytearray(b'\r\n')
+        self.part = None
+    
+    def fill(self):
+        """Дочитывает следующий кусок тела в буфер"""
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise ValueError("Request body ended unexpectedly")
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+    
+    def iter_data(self):
+        """Отдаёт данные до следующей границы и съедает саму границу"""
+        delimiter = self.delimiter
+        while True:
+            index = self.buf.find(delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buf[:index])
+                del self.buf[:index + len(delimiter)]
+                return
+            # Хвост может оказаться началом границы, его оставляем в буфере
+            safe = len(self.buf) - len(delimiter) + 1
+            if safe > 0:
+                yield bytes(self.buf[:safe])
+                del self.buf[:safe]
+            if not self.fill():
+                raise ValueError("Multipart boundary not found")
+    
+    def parts(self):
+        """Перебирает части тела по очереди"""
+        # Преамбулу до первой границы пропускаем
+        for _ in self.iter_data():
+            pass
+        while True:
+            if self.part is not None:
+                for _ in self.part.iter_chunks():
+                    pass
+            while len(self.buf) < 2:
+                if not self.fill():
+                    raise ValueError("Multipart body ended unexpectedly")
+            if self.buf[:2] == b'--':
+                # Последняя граница, остаток тела (эпилог) выбрасываем
+                while self.fill():
+                    del self.buf[:]
+                return
+            
+            while True:
+                end = self.buf.find(b'\r\n\r\n')
+                if end >= 0:
+                    break
+                if len(self.buf) > MAX_PART_HEADERS or not self.fill():
+                    raise ValueError("Invalid multipart headers")
+            lines = self.buf[:end].decode('utf-8', errors='replace').split('\r\n')
+            del self.buf[:end + 4]
+            # Первая строка - остаток строки с границей
+            headers = {}
+            for line in lines[1:]:
+                key, sep, value = line.partition(':')
+                if sep:
+                    headers[key.strip().lower()] = value.strip()
+            self.part = MultipartPart(self, headers)
+            yield self.part
+
+class FormReader:
+    """Потоковый разбор application/x-www-form-urlencoded из rfile.
+    
+    Значение поля можно читать кусками через iter_value, поэтому большое
+    содержимое из редактора не собирается в памяти целиком.
+    """
+    
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+        self.buf = bytearray()
+        self.value_done = True
+    
+    def fill(self):
+        """Дочитывает следующий кусок тела в буфер"""
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise ValueError("Request body ended unexpectedly")
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+    
+    @staticmethod
+    def decode(data):
+        """Раскодирует кусок значения: '+' и %XX"""
+        return urllib.parse.unquote_to_bytes(bytes(data).replace(b'+', b' '))
+    
+    def next_name(self):
+        """Возвращает имя следующего поля или None в конце тела"""
+        # Недочитанное значение предыдущего поля пропускаем
+        for _ in self.iter_value():
+            pass
+        while True:
+            eq = self.buf.find(b'=')
+            amp = self.buf.find(b'&')
+            if amp >= 0 and (eq < 0 or amp < eq):
+                # Поле без '=' - пустое значение
+                name = self.buf[:amp]
+                del self.buf[:amp + 1]
+            elif eq >= 0:
+                name = self.buf[:eq]
+                del self.buf[:eq + 1]
+                self.value_done = False
+            elif len(self.buf) > MAX_PART_HEADERS:
+                raise ValueError("Form field name is too long")
+            elif self.fill():
+                continue
+            elif self.buf:
+                name = self.buf[:]
+                del self.buf[:]
+            else:
+                return None
+            if name:
+                return self.decode(name).decode('utf-8', errors='replace')
+    
+    def iter_value(self):
+        """Отдаёт раскодированное значение текущего поля кусками"""
+        while not self.value_done:
+            amp = self.buf.find(b'&')
+            if amp >= 0:
+                data = self.buf[:amp]
+                del self.buf[:amp + 1]
+                self.value_done = True
+            elif self.remaining <= 0:
+                data = self.buf[:]
+                del self.buf[:]
+                self.value_done = True
+            else:
+                # Обрывок %XX на границе куска оставляем до следующего чтения
+                keep = 2 if self.buf[-2:-1] == b'%' else 1 if self.buf[-1:] == b'%' else 0
+                data = self.buf[:len(self.buf) - keep]
+                del self.buf[:len(self.buf) - keep]
+                self.fill()
+            if data:
+                yield self.decode(data)
+    
+    def read_value(self, limit=MAX_FIELD_SIZE):
+        """Читает значение обычного поля целиком"""
+        data = bytearray()
+        for chunk in self.iter_value():
+            data += chunk
+            if len(data) > limit:
+                raise ValueError("Form field is too large")
+        return data.decode('utf-8', errors='replace')
+
+class SaveConflict(Exception):
+    """Файл изменился с момента открытия в редакторе"""
+
+# Проверка ETag и подмена файла при сохранении должны идти без перерыва
+SAVE_LOCK = threading.Lock()
+
+class AtomicWriter:
+    """Временный файл рядом с целевым, который целиком подменяет его через os.replace.
+    
+    Пока commit не вызван, исходный файл не тронут: оборванный запрос
+    или ошибка записи оставляют его как был.
+    """
+    
+    def __init__(self, directory, reserved=0):
+        self.directory = directory
+        # Квота, заранее занятая под файл; возвращается в discard
+        self.reserved = reserved
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.save-', suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+    
+    def write(self, data):
+        self.file.write(data)
+    
+    def commit(self, path, st=None):
+        """Сбрасывает данные на диск и ставит файл на место path"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if st is not None:
+            # Сохраняем права и владельца заменяемого файла
+            os.fchmod(self.file.fileno(), stat.S_IMODE(st.st_mode))
+            try:
+                os.fchown(self.file.fileno(), st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        else:
+            os.fchmod(self.file.fileno(), 0o666 & ~UMASK)
+        self.file.close()
+        os.replace(self.tmp_path, path)
+        self.tmp_path = None
+        # Запись в директории о переименовании тоже должна пережить сбой
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    
+    def discard(self):
+        """Удаляет временный файл, если он не был поставлен на место"""
+        self.file.close()
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+            self.tmp_path = None
+        QUOTAS.release(self.directory, self.reserved)
+        self.reserved = 0
+    
+    # Как и у обычного временного файла, close выбрасывает недописанное
+    close = discard
+
+class UploadSessions:
+    """Сессии докачиваемых загрузок.
+    
+    Данные пишутся в скрытый .part файл в целевой директории через pwrite,
+    поэтому куски могут приходить в любом порядке. Состояние сессии лежит
+    в DATA_DIR/uploads/<id>.json и переживает перезапуск сервера.
+    """
+    
+    ID_RE = re.compile(r'[0-9a-f]{32}')
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    def state_path(self, upload_id):
+        return os.path.join(self.directory, upload_id + '.json')
+    
+    def part_path(self, session):
+        return os.path.join(session['directory'], f".upload-{session['id']}.part")
+    
+    def save(self, session):
+        """Атомарно сохраняет состояние сессии на диск"""
+        session['updated'] = time.time()
+        path = self.state_path(session['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(session, f)
+        os.replace(path + '.tmp', path)
+    
+    def create(self, directory, name, size):
+        """Начинает новую загрузку"""
+        self.expire()
+        os.makedirs(self.directory, exist_ok=True)
+        session = {
+            'id': secrets.token_hex(16),
+            'directory': directory,
+            'name': name,
+            'size': size,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'received': [],
+        }
+        # Место под весь файл резервируется в квоте сразу
+        QUOTAS.charge(directory, size)
+        try:
+            fd = os.open(self.part_path(session), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+        except BaseException:
+            QUOTAS.release(directory, size)
+            raise
+        with self.lock:
+            self.save(session)
+            self.sessions[session['id']] = session
+        return session
+    
+    def get(self, upload_id):
+        """Ищет сессию в памяти, затем на диске"""
+        if not self.ID_RE.fullmatch(upload_id):
+            return None
+        with self.lock:
+            session = self.sessions.get(upload_id)
+            if session is None:
+                try:
+                    with open(self.state_path(upload_id)) as f:
+                        session = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                self.sessions[upload_id] = session
+            return session
+    
+    def chunk_count(self, session):
+        return -(-session['size'] // session['chunk_size'])
+    
+    def status(self, session):
+        """Что уже получено: номера кусков и байтовые диапазоны [start, end)"""
+        chunk_size = session['chunk_size']
+        ranges = []
+        for index in session['received']:
+            start = index * chunk_size
+            end = min(start + chunk_size, session['size'])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return {
+            'id': session['id'],
+            'name': session['name'],
+            'size': session['size'],
+            'chunk_size': chunk_size,
+            'chunks': self.chunk_count(session),
+            'received': session['received'],
+            'ranges': ranges,
+        }
+    
+    def write_chunk(self, session, index, rfile, length):
+        """Пишет кусок с номером index из rfile на его место в .part файле"""
+        if not 0 <= index < self.chunk_count(session):
+            raise ValueError("Chunk index out of range")
+        offset = index * session['chunk_size']
+        if length != min(session['chunk_size'], session['size'] - offset):
+            raise ValueError("Wrong chunk length")
+        
+        fd = os.open(self.part_path(session), os.O_WRONLY)
+        try:
+            while length > 0:
+                data = rfile.read(min(CHUNK_SIZE, length))
+                if not data:
+                    raise ValueError("Chunk body ended unexpectedly")
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+                length -= len(data)
+            # Кусок считается полученным только после того, как он на диске
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        
+        with self.lock:
+            if index not in session['received']:
+                session['received'].append(index)
+                session['received'].sort()
+                self.save(session)
+    
+    def finish(self, session):
+        """Переносит собранный файл на место, если получены все куски"""
+        with self.lock:
+            if len(session['received']) != self.chunk_count(session):
+                raise ValueError("Upload is not complete")
+            path = os.path.join(session['directory'], session['name'])
+            try:
+                replaced = os.lstat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(self.part_path(session), path)
+            QUOTAS.release(path, replaced)
+            self.forget(session['id'])
+        return path
+    
+    def abort(self, session):
+        """Отменяет загрузку и удаляет частичные данные"""
+        with self.lock:
+            try:
+                os.unlink(self.part_path(session))
+            except OSError:
+                pass
+            else:
+                QUOTAS.release(session['directory'], session['size'])
+            self.forget(session['id'])
+    
+    def forget(self, upload_id):
+        self.sessions.pop(upload_id, None)
+        try:
+            os.unlink(self.state_path(upload_id))
+        except OSError:
+            pass
+    
+    def expire(self):
+        """Удаляет брошенные загрузки старше UPLOAD_SESSION_TTL"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        deadline = time.time() - UPLOAD_SESSION_TTL
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            try:
+                if os.path.getmtime(self.state_path(upload_id)) >= deadline:
+                    continue
+            except OSError:
+                continue
+            session = self.get(upload_id)
+            if session is not None:
+                self.abort(session)
+
+UPLOADS = UploadSessions(os.path.join(DATA_DIR, 'uploads'))
+
+def hash_password(password, n=AUTH_SCRYPT_N, r=AUTH_SCRYPT_R, p=1):
+    """Хеш пароля в виде строки scrypt$n$r$p$соль$хеш"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                            maxmem=256 * n * r * p, dklen=32)
+    return f'scrypt${n}${r}${p}${salt.hex()}${digest.hex()}'
+
+def verify_password(password, password_hash):
+    """Сверяет пароль с хешем hash_password"""
+    try:
+        scheme, n, r, p, salt, digest = password_hash.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, digest = bytes.fromhex(salt), bytes.fromhex(digest)
+    except ValueError:
+        return False
+    if scheme != 'scrypt':
+        return False
+    candidate = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                               maxmem=256 * n * r * p, dklen=len(digest))
+    return hmac.compare_digest(candidate, digest)
+
+class OutsideRoot(Exception):
+    """Путь за пределами корня пользователя"""
+
+class UserAccounts:
+    """Учётные записи пользователей.
+    
+    Как в index.php, у каждого пользователя свой корень USER_ROOTS_DIR/<имя>,
+    выйти за который он не может, и квота на место в нём. Записи (хеш пароля
+    и квота) хранятся в DATA_DIR/users.json. Вход одним паролем без имени -
+    администратор с корнем os.getcwd() и без квоты.
+    """
+    
+    NAME_RE = re.compile(r'[A-Za-z0-9_][A-Za-z0-9_.-]{0,31}')
+    
+    def __init__(self, path, roots_dir):
+        self.path = path
+        self.roots_dir = roots_dir
+        self.admin_root = os.getcwd()
+        self.users = {}
+        self.registration = ALLOW_REGISTRATION
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """Читает учётные записи и ставит их корни на учёт квот"""
+        try:
+            with open(self.path) as f:
+                users = json.load(f)
+        except FileNotFoundError:
+            users = {}
+        with self.lock:
+            self.users = users
+        for name, account in users.items():
+            QUOTAS.track(self.root(name), account.get('quota', 0))
+    
+    def save(self):
+        """Атомарно сохраняет записи (под self.lock)"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(self.users, f, indent=1)
+        os.replace(tmp_path, self.path)
+    
+    def get(self, name):
+        return self.users.get(name)
+    
+    def root(self, name):
+        """Корень пользователя; None - администратор"""
+        if name is None:
+            return self.admin_root
+        return os.path.join(self.roots_dir, name)
+    
+    def create(self, name, password, quota=DEFAULT_QUOTA):
+        """Заводит пользователя с пустым корнем"""
+        if not self.NAME_RE.fullmatch(name or ''):
+            raise ValueError("Username may contain only letters, digits, '_', '.' and '-'")
+        if not password:
+            raise ValueError("Password is required")
+        # scrypt регистрации делит ограничение параллельных KDF со входом
+        with SESSIONS.kdf_slots:
+            password_hash = hash_password(password)
+        account = {'password_hash': password_hash, 'quota': quota, 'created': time.time()}
+        with self.lock:
+            if name in self.users:
+                raise ValueError("User already exists")
+            os.makedirs(self.root(name), exist_ok=True)
+            self.users[name] = account
+            self.save()
+        QUOTAS.track(self.root(name), quota)
+        return account
+    
+    def set_quota(self, name, quota):
+        with self.lock:
+            self.users[name]['quota'] = quota
+            self.save()
+        QUOTAS.track(self.root(name), quota)
+    
+    def stats(self):
+        return {'users': len(self.users), 'registration': self.registration}
+
+ACCOUNTS = UserAccounts(os.path.join(DATA_DIR, 'users.json'), USER_ROOTS_DIR)
+
+class SessionStore:
+    """Сессии входа.
+    
+    Пароль проверяется через scrypt один раз при входе, дальше клиент
+    предъявляет токен '<id>.<секрет>' из cookie. Проверка запроса - поиск
+    id в словаре и сравнение SHA-256 секрета через hmac.compare_digest;
+    сам секрет сервер не хранит ни в памяти, ни на диске. Просроченные
+    сессии удаляются при обращении и при следующем входе.
+    """
+    
+    def __init__(self, path=None, ttl=SESSION_TTL):
+        self.path = path            # None - сессии только в памяти
+        self.ttl = ttl
+        self.password_hash = None
+        self.sessions = {}          # id -> (sha256 секрета, истекает, пользователь)
+        self.attempts = OrderedDict()   # адрес -> deque времён попыток входа
+        self.kdf_slots = threading.BoundedSemaphore(LOGIN_PARALLEL)
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.failures = 0
+        self.throttled = 0
+    
+    def set_password(self, password=None, password_hash=None):
+        """Задаёт пароль или его готовый хеш и поднимает сессии, сохранённые под ним"""
+        state = {}
+        if self.path is not None:
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                pass
+        stored_hash = state.get('password_hash')
+        if password_hash is None:
+            # Тот же пароль - тот же хеш (соль случайная), иначе сессии пропали бы при перезапуске
+            if stored_hash and verify_password(password, stored_hash):
+                password_hash = stored_hash
+            else:
+                password_hash = hash_password(password)
+        now = time.time()
+        with self.lock:
+            self.password_hash = password_hash
+            self.sessions.clear()
+            # Смена пароля администратора не выкидывает пользователей
+            for session_id, (secret_hash, expires, user) in state.get('sessions', {}).items():
+                if expires > now and (user is not None or stored_hash == password_hash):
+                    self.sessions[session_id] = (secret_hash, expires, user)
+    
+    def save(self):
+        """Атомарно сохраняет сессии (под self.lock)"""
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump({'password_hash': self.password_hash, 'sessions': self.sessions}, f)
+        os.replace(tmp_path, self.path)
+    
+    def retry_after(self, address):
+        """Через сколько секунд адресу можно снова пробовать войти (0 - можно сейчас)"""
+        with self.lock:
+            attempts = self.attempts.get(address)
+            if attempts is None:
+                return 0
+            deadline = time.time() - LOGIN_WINDOW
+            while attempts and attempts[0] < deadline:
+                attempts.popleft()
+            if len(attempts) < LOGIN_MAX_FAILURES:
+                return 0
+            self.throttled += 1
+            return int(attempts[0] - deadline) + 1
+    
+    def attempt(self, address):
+        """Засчитывает адресу попытку входа или регистрации"""
+        with self.lock:
+            attempts = self.attempts.pop(address, None) or deque(maxlen=LOGIN_MAX_FAILURES)
+            attempts.append(time.time())
+            self.attempts[address] = attempts
+            while len(self.attempts) > LOGIN_TRACK_ADDRESSES:
+                self.attempts.popitem(last=False)
+    
+    def login(self, password, address, user=None):
+        """Проверяет пароль (пользователя или администратора) и выдаёт токен новой сессии или None"""
+        # Попытка засчитывается заранее, чтобы параллельные запросы не обходили лимит
+        self.attempt(address)
+        account = ACCOUNTS.get(user) if user is not None else None
+        password_hash = self.password_hash if user is None else account and account['password_hash']
+        with self.kdf_slots:
+            # Для несуществующего пользователя хеш тоже считается: по времени
+            # ответа нельзя узнать, есть ли такое имя
+            valid = verify_password(password, password_hash or self.password_hash or '')
+        if not valid or not password_hash:
+            with self.lock:
+                self.failures += 1
+            return None
+        with self.lock:
+            self.attempts.pop(address, None)
+        return self.issue(user)
+    
+    def issue(self, user=None):
+        """Выдаёт токен новой сессии пользователя"""
+        session_id, secret = secrets.token_urlsafe(12), secrets.token_urlsafe(32)
+        now = time.time()
+        with self.lock:
+            for expired in [key for key, session in self.sessions.items() if session[1] <= now]:
+                del self.sessions[expired]
+            self.sessions[session_id] = (hashlib.sha256(secret.encode()).hexdigest(), now + self.ttl, user)
+            self.logins += 1
+            self.save()
+        return f'{session_id}.{secret}'
+    
+    def check(self, token):
+        """Сессия по токену из cookie или None"""
+        session_id, _, secret = token.partition('.')
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        if not hmac.compare_digest(session[0], hashlib.sha256(secret.encode()).hexdigest()):
+            return None
+        if session[1] <= time.time():
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            return None
+        return session
+    
+    def logout(self, token):
+        """Завершает сессию токена"""
+        if self.check(token) is None:
+            return
+        with self.lock:
+            self.sessions.pop(token.partition('.')[0], None)
+            self.save()
+    
+    def cookie(self, token):
+        """Заголовок Set-Cookie для токена (пустой токен удаляет cookie)"""
+        max_age = self.ttl if token else 0
+        return f'{SESSION_COOKIE}={token}; Path=/; Max-Age={max_age}; HttpOnly; SameSite=Lax'
+    
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'logins': self.logins,
+            'failures': self.failures,
+            'throttled': self.throttled,
+            'tracked_addresses': len(self.attempts),
+            'persistent': self.path is not None,
+        }
+
+SESSIONS = SessionStore(os.path.join(DATA_DIR, 'sessions.json') if SESSION_PERSIST else None)
+
+class ListingCache:
+    """LRU кеш листингов директорий.
+    
+    Запись действительна, пока не изменились inode и mtime директории
+    и не истёк LISTING_CACHE_TTL (размеры файлов меняются без смены mtime
+    директории). Собственные изменения сервер сбрасывает через invalidate().
+    """
+    
+    # Примерный расход памяти на одну запись листинга помимо строк
+    ENTRY_OVERHEAD = 600
+    # И на одну запись в каждом дополнительном порядке сортировки
+    VIEW_OVERHEAD = 120
+    
+    def __init__(self, max_bytes=LISTING_CACHE_BYTES, max_age=LISTING_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, path, loader):
+        """Возвращает листинг path из кеша или загружает его через loader(path)"""
+        path = os.path.normpath(os.path.abspath(path))
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == key and now - entry[2] < self.max_age:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        files = loader(path)
+        # Директорию, изменённую только что, не кешируем: следующее изменение
+        # в ту же секунду может не сдвинуть mtime
+        if now - st.st_mtime < 2:
+            return files
+        
+        size = sum(self.ENTRY_OVERHEAD + 2 * (len(f['name']) + len(f['path'])) for f in files)
+        if size > self.max_bytes:
+            return files
+        with self.lock:
+            self.drop(path)
+            self.entries[path] = [key, files, now, size, {}]
+            self.bytes += size
+            self.evict()
+        return files
+    
+    def get_view(self, path, loader, order):
+        """Листинг в порядке order = (sort, desc, dirs_first), отсортированный один раз"""
+        files = self.get(path, loader)
+        path = os.path.normpath(os.path.abspath(path))
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[1] is files and order in entry[4]:
+                return entry[4][order]
+        
+        view = ListingView(sort_listing(files, *order))
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[1] is files and order not in entry[4]:
+                entry[4][order] = view
+                size = self.VIEW_OVERHEAD * len(files)
+                entry[3] += size
+                self.bytes += size
+                self.evict()
+        return view
+    
+    def evict(self):
+        while self.bytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old[3]
+            self.evictions += 1
+    
+    def drop(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+        return entry is not None
+    
+    def invalidate(self, *paths):
+        """Сбрасывает листинги изменённых путей и их родительских директорий"""
+        with self.lock:
+            for path in paths:
+                path = os.path.normpath(os.path.abspath(path))
+                for key in (path, os.path.dirname(path)):
+                    if self.drop(key):
+                        self.invalidations += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+# Ключи сортировки листинга; имя в конце делает порядок однозначным
+SORT_KEYS = {
+    'name': lambda f: (f['name'].lower(), f['name']),
+    'size': lambda f: (f['size'], f['name'].lower(), f['name']),
+    'mtime': lambda f: (f['modified'], f['name'].lower(), f['name']),
+}
+
+def sort_listing(files, sort='name', desc=False, dirs_first=True):
+    """Сортирует листинг; папки остаются сверху при любом направлении"""
+    key = SORT_KEYS[sort]
+    if not dirs_first:
+        return sorted(files, key=key, reverse=desc)
+    dirs = sorted((f for f in files if f['is_dir']), key=key, reverse=desc)
+    others = sorted((f for f in files if not f['is_dir']), key=key, reverse=desc)
+    return dirs + others
+
+class ListingView:
+    """Отсортированный листинг с постраничной выдачей по курсору.
+    
+    Курсор - позиция и имя последней отданной записи. Если листинг
+    успел измениться, продолжение ищется по имени, а не по позиции,
+    поэтому записи не теряются и не дублируются.
+    """
+    
+    def __init__(self, files):
+        self.files = files
+        self.positions = None
+    
+    def page(self, cursor, limit):
+        """Возвращает (записи, курсор следующей страницы или None)"""
+        start = self.position_after(*self.decode_cursor(cursor)) if cursor else 0
+        items = self.files[start:start + limit]
+        end = start + len(items)
+        if end >= len(self.files) or not items:
+            return items, None
+        return items, self.encode_cursor(end - 1, items[-1]['name'])
+    
+    def position_after(self, index, name):
+        if 0 <= index < len(self.files) and self.files[index]['name'] == name:
+            return index + 1
+        if self.positions is None:
+            self.positions = {f['name']: i for i, f in enumerate(self.files)}
+        position = self.positions.get(name)
+        if position is None:
+            return min(index + 1, len(self.files))
+        return position + 1
+    
+    @staticmethod
+    def encode_cursor(index, name):
+        return base64.urlsafe_b64encode(json.dumps([index, name]).encode()).decode()
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            index, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return int(index), str(name)
+        except (ValueError, TypeError):
+            raise ValueError("Bad cursor")
+
+LISTING_CACHE = ListingCache()
+
+class FileIndex:
+    """Индекс всех файлов под корнем в SQLite для поиска по имени.
+    
+    Пишет в базу только фоновый поток: первый раз обходит всё дерево, потом
+    раз в INDEX_RESCAN_INTERVAL перечитывает директории со сменившимся mtime
+    и сразу применяет изменения, о которых сообщил сам сервер (changed()).
+    Поиск читает из своих соединений (WAL) и сканирования не ждёт.
+    Подстроки ищутся через FTS5 с токенизатором trigram, если sqlite3 его
+    поддерживает, иначе перебором таблицы.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            UNIQUE (parent, name)
+        );
+        CREATE INDEX IF NOT EXISTS files_name ON files (name COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL
+        );
+    """
+    
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE files_fts USING fts5(
+            name, content='files', content_rowid='id', tokenize='trigram');
+        CREATE TRIGGER files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, name) VALUES (new.id, new.name);
+        END;
+        CREATE TRIGGER files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        END;
+        INSERT INTO files_fts (files_fts) VALUES ('rebuild');
+    """
+    
+    def __init__(self, root, db_path):
+        self.root = root
+        self.db_path = db_path
+        self.changes = queue.Queue()
+        self.local = threading.local()
+        self.thread = None
+        self.fts = False
+        self.ready = False
+        self.scanning = False
+        self.last_scan = None
+        self.last_scan_seconds = None
+    
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
+    def reader(self):
+        """Соединение для чтения, своё у каждого потока"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+    
+    def start(self):
+        """Создаёт базу и запускает фоновый индексатор"""
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self.connect()
+        conn.executescript(self.SCHEMA)
+        self.fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone() is not None
+        if not self.fts:
+            try:
+                conn.executescript(f'BEGIN; {self.FTS_SCHEMA} COMMIT;')
+                self.fts = True
+            except sqlite3.OperationalError:
+                # Нет FTS5 или trigram (SQLite < 3.34): поиск перебором
+                conn.rollback()
+        # Индекс от прошлого запуска сразу доступен для поиска
+        self.ready = conn.execute('SELECT 1 FROM dirs LIMIT 1').fetchone() is not None
+        conn.close()
+        self.thread = threading.Thread(target=self.run, name='fm-indexer', daemon=True)
+        self.thread.start()
+    
+    def changed(self, *paths):
+        """Сообщает индексатору об изменённых путях"""
+        if self.thread is not None:
+            for path in paths:
+                self.changes.put(path)
+    
+    def run(self):
+        conn = self.connect()
+        while True:
+            try:
+                self.rescan(conn, full=not self.ready)
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️  Ошибка индексации: {e}")
+            deadline = time.monotonic() + INDEX_RESCAN_INTERVAL
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    path = self.changes.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                try:
+                    self.apply_change(conn, path)
+                    self.apply_pending(conn)
+                    conn.commit()
+                except (OSError, sqlite3.Error) as e:
+                    conn.rollback()
+                    print(f"⚠️  Ошибка индексации {path}: {e}")
+    
+    def apply_pending(self, conn):
+        """Применяет изменения, накопившиеся в очереди"""
+        while True:
+            try:
+                path = self.changes.get_nowait()
+            except queue.Empty:
+                return
+            self.apply_change(conn, path)
+    
+    def apply_change(self, conn, path):
+        """Обновляет в индексе один путь, а для директории - всё её дерево"""
+        path = os.path.abspath(path)
+        if not path.startswith(os.path.join(self.root, '')) or self.excluded(path):
+            return
+        parent, name = os.path.split(path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            conn.execute('DELETE FROM files WHERE parent = ? AND name = ?', (parent, name))
+            self.remove_tree(conn, path)
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        self.store(conn, [(parent, name, is_dir, 0 if is_dir else st.st_size, st.st_mtime)])
+        if is_dir:
+            self.walk(conn, path, full=True)
+    
+    def excluded(self, path):
+        """Служебную директорию сервера не индексируем"""
+        return path == DATA_DIR or path.startswith(os.path.join(DATA_DIR, ''))
+    
+    def store(self, conn, rows):
+        conn.executemany(
+            'INSERT INTO files (parent, name, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (parent, name) DO UPDATE SET '
+            'is_dir = excluded.is_dir, size = excluded.size, mtime = excluded.mtime', rows)
+    
+    def remove_tree(self, conn, path):
+        """Удаляет из индекса содержимое директории на любой глубине"""
+        prefix = os.path.join(path, '')
+        # Все пути внутри prefix лежат в диапазоне [prefix, prefix с последним символом + 1)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        conn.execute('DELETE FROM files WHERE parent = ?', (path,))
+        conn.execute('DELETE FROM files WHERE parent >= ? AND parent < ?', (prefix, upper))
+        conn.execute('DELETE FROM dirs WHERE path = ?', (path,))
+        conn.execute('DELETE FROM dirs WHERE path >= ? AND path < ?', (prefix, upper))
+    
+    def sync_dir(self, conn, path, mtime_ns):
+        """Перечитывает одну директорию, возвращает (поддиректории, число строк)"""
+        rows = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if self.excluded(entry.path):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                # По ссылкам на директории не ходим, иначе возможны циклы
+                is_dir = stat.S_ISDIR(st.st_mode)
+                rows.append((path, entry.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime))
+                if is_dir:
+                    subdirs.append(entry.path)
+        
+        names = {row[1] for row in rows}
+        for name, was_dir in conn.execute('SELECT name, is_dir FROM files WHERE parent = ?', (path,)).fetchall():
+            if name not in names:
+                conn.execute('DELETE FROM files WHERE parent = ? AND name = ?', (path, name))
+                if was_dir:
+                    self.remove_tree(conn, os.path.join(path, name))
+        self.store(conn, rows)
+        conn.execute('INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)', (path, mtime_ns))
+        return subdirs, len(rows)
+    
+    def walk(self, conn, top, full):
+        """Обходит дерево; без full перечитывает только директории со сменившимся mtime"""
+        stack = [top]
+        pending_rows = 0
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                self.remove_tree(conn, path)
+                continue
+            known = None if full else conn.execute(
+                'SELECT mtime_ns FROM dirs WHERE path = ?', (path,)).fetchone()
+            if known is not None and known[0] == mtime_ns:
+                stack.extend(os.path.join(path, name) for name, in conn.execute(
+                    'SELECT name FROM files WHERE parent = ? AND is_dir', (path,)))
+                continue
+            try:
+                subdirs, count = self.sync_dir(conn, path, mtime_ns)
+            except OSError:
+                continue
+            stack.extend(subdirs)
+            pending_rows += count
+            if pending_rows >= INDEX_COMMIT_ROWS:
+                # Изменения от сервера не ждут конца долгого сканирования
+                self.apply_pending(conn)
+                conn.commit()
+                pending_rows = 0
+    
+    def rescan(self, conn, full=False):
+        """Полное или инкрементальное сканирование всего дерева"""
+        self.scanning = True
+        started = time.monotonic()
+        try:
+            self.walk(conn, self.root, full)
+            conn.commit()
+        finally:
+            self.scanning = False
+        self.ready = True
+        self.last_scan = time.time()
+        self.last_scan_seconds = time.monotonic() - started
+    
+    def search(self, query, mode='auto', limit=SEARCH_LIMIT, root=None):
+        """Ищет по имени: substring, prefix или glob (* ? [...]); root ограничивает поддеревом"""
+        if mode == 'auto':
+            mode = 'glob' if any(c in query for c in '*?[') else 'substring'
+        columns = 'f.parent, f.name, f.is_dir, f.size, f.mtime'
+        # Поддерево - диапазон путей: сам root и всё, что начинается с root + '/'
+        scope, scope_args = '', []
+        if root is not None:
+            scope = ' AND (f.parent = ? OR f.parent >= ? AND f.parent < ?)'
+            scope_args = [root, root + os.sep, root + chr(ord(os.sep) + 1)]
+        if mode == 'prefix':
+            sql = (f'SELECT {columns} FROM files f '
+                   f'WHERE f.name >= ? COLLATE NOCASE AND f.name < ? COLLATE NOCASE{scope}')
+            args = [query, query + '\U0010ffff', *scope_args]
+        elif mode in ('substring', 'glob'):
+            if mode == 'substring':
+                literals = [query]
+                where, pattern = "f.name LIKE ? ESCAPE '\\'", '%' + like_escape(query) + '%'
+            elif '[' in query:
+                # Классы символов понимает только GLOB (с учётом регистра)
+                literals = re.split(r'\[[^\]]*\]?|[*?]', query)
+                where, pattern = 'f.name GLOB ?', query
+            else:
+                literals = re.split(r'[*?]', query)
+                pattern = ''.join({'*': '%', '?': '_'}.get(c, like_escape(c)) for c in query)
+                where = "f.name LIKE ? ESCAPE '\\'"
+            # Триграммы отсеивают кандидатов, точная проверка - по самой таблице
+            phrases = ['"' + s.replace('"', '""') + '"' for s in literals if len(s) >= 3]
+            if self.fts and phrases:
+                sql = (f'SELECT {columns} FROM files_fts JOIN files f ON f.id = files_fts.rowid '
+                       f'WHERE files_fts MATCH ? AND {where}{scope}')
+                args = [' AND '.join(phrases), pattern, *scope_args]
+            else:
+                sql = f'SELECT {columns} FROM files f WHERE {where}{scope}'
+                args = [pattern, *scope_args]
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+        # Сортировка всех совпадений в SQL медленна на широких запросах, поэтому
+        # ранжируются первые limit * SEARCH_RANK_CANDIDATES кандидатов и все
+        # точные совпадения имени (по индексу files_name)
+        queries = [(sql + ' LIMIT ?', [*args, limit * SEARCH_RANK_CANDIDATES])]
+        if mode != 'glob':
+            queries.append((f'SELECT {columns} FROM files f WHERE f.name = ? COLLATE NOCASE{scope} LIMIT ?',
+                            [query, *scope_args, limit]))
+        
+        found = {}
+        reader = self.reader()
+        for sql, args in queries:
+            for parent, name, is_dir, size, mtime in reader.execute(sql, args):
+                found[parent, name] = {
+                    'path': os.path.join(parent, name),
+                    'name': name,
+                    'is_dir': bool(is_dir),
+                    'size': size,
+                    'modified': mtime,
+                }
+        # Точные совпадения имени и короткие пути выше
+        lowered = query.lower()
+        results = sorted(found.values(), key=lambda r: (r['name'].lower() != lowered, len(r['path']), r['path']))
+        return results[:limit]
+    
+    def stats(self):
+        files, dirs = self.reader().execute(
+            'SELECT count(*), coalesce(sum(is_dir), 0) FROM files').fetchone()
+        return {
+            'ready': self.ready,
+            'scanning': self.scanning,
+            'fts': self.fts,
+            'entries': files,
+            'dirs': dirs,
+            'last_scan': self.last_scan,
+            'last_scan_seconds': self.last_scan_seconds,
+            'pending_changes': self.changes.qsize(),
+        }
+
+def like_escape(text):
+    """Экранирует спецсимволы LIKE (ESCAPE '\\')"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+FILE_INDEX = FileIndex(os.getcwd(), os.path.join(DATA_DIR, 'index.sqlite3'))
+
+class PathResolver:
+    """Канонические пути (realpath) с LRU кешем.
+    
+    Через него проходят все проверки «путь внутри корня»: пути сравниваются
+    после раскрытия симлинков и '..', поэтому ни ../ в параметре, ни ссылка
+    внутри корня на чужую директорию за корень не выводят. realpath делает
+    lstat на каждый компонент пути, поэтому результат кешируется. Запись
+    живёт PATH_CACHE_TTL (симлинки могут поменять в обход сервера), а
+    изменения через сервер сбрасывают кеш целиком: переименование директории
+    меняет пути всего поддерева, а заполняется кеш заново дёшево.
+    """
+    
+    def __init__(self, max_entries=PATH_CACHE_SIZE, ttl=PATH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()    # путь как пришёл -> (realpath, время)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def resolve(self, path):
+        """realpath из кеша или с диска"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        real = os.path.realpath(path)
+        if len(path) <= PATH_CACHE_MAX_LEN:
+            with self.lock:
+                self.entries[path] = (real, now)
+                self.entries.move_to_end(path)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return real
+    
+    def resolve_link(self, path):
+        """Канонический путь самой записи: раскрывается только директория (удаление, переименование ссылки)"""
+        head, tail = os.path.split(os.path.abspath(path))
+        return os.path.join(self.resolve(head), tail) if tail else self.resolve(head)
+    
+    def inside(self, path, root, follow=True, strict=False):
+        """Лежит ли path в root после раскрытия симлинков (follow=False - кроме последнего).
+        
+        strict - сам root не подходит, только то, что в нём.
+        """
+        try:
+            real = self.resolve(path) if follow else self.resolve_link(path)
+        except (ValueError, OSError):
+            # Нулевой байт в пути и т.п.
+            return False
+        root = self.resolve(root)
+        return (real == root and not strict) or real.startswith(os.path.join(root, ''))
+    
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+RESOLVER = PathResolver()
+
+def paths_changed(*paths):
+    """Сообщает кешам и индексу, что сервер изменил эти пути"""
+    RESOLVER.invalidate()
+    LISTING_CACHE.invalidate(*paths)
+    FILE_INDEX.changed(*paths)
+
+class DirectoryWatcher:
+    """Следит за директориями, открытыми в браузере, и рассылает изменения подписчикам.
+    
+    Использует inotify через ctypes; если он недоступен (не Linux, кончился
+    лимит max_user_watches), директория опрашивается раз в WATCH_POLL_INTERVAL.
+    События одного файла за WATCH_COALESCE склеиваются, чтобы запись большого
+    файла не порождала поток modify. Все изменения заодно сбрасывают кеш
+    листингов и обновляют индекс файлов.
+    """
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Путь (realpath) -> {'subscribers': set очередей, 'wd': дескриптор inotify, 'snapshot': ...}
+        self.watches = {}
+        self.wds = {}
+        self.libc = None
+        self.fd = None
+        self.thread = None
+        self.streams = 0
+        self.events = 0
+    
+    def start(self):
+        """Открывает inotify и запускает поток наблюдения (при первой подписке)"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd >= 0:
+            self.libc, self.fd = libc, fd
+        self.thread = threading.Thread(target=self.run, name='fm-watcher', daemon=True)
+        self.thread.start()
+    
+    def subscribe(self, path):
+        """Подписка на изменения в директории, возвращает очередь событий"""
+        key = os.path.realpath(path)
+        events = queue.Queue(maxsize=1000)
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            watch = self.watches.get(key)
+            if watch is None:
+                watch = self.watches[key] = {'subscribers': set(), 'wd': None, 'snapshot': None}
+                wd = -1
+                if self.fd is not None:
+                    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(key), self.MASK)
+                if wd >= 0:
+                    watch['wd'] = wd
+                    self.wds[wd] = key
+                else:
+                    watch['snapshot'] = self.snapshot(key)
+            watch['subscribers'].add(events)
+            self.streams += 1
+        return events
+    
+    def unsubscribe(self, path, events):
+        key = os.path.realpath(path)
+        with self.lock:
+            watch = self.watches.get(key)
+            if watch is None or events not in watch['subscribers']:
+                return
+            watch['subscribers'].discard(events)
+            self.streams -= 1
+            if not watch['subscribers']:
+                del self.watches[key]
+                if watch['wd'] is not None and self.wds.pop(watch['wd'], None) is not None:
+                    self.libc.inotify_rm_watch(self.fd, watch['wd'])
+    
+    def run(self):
+        pending = {}
+        batch_started = 0
+        next_poll = 0
+        while True:
+            timeout = WATCH_COALESCE if pending else 1.0
+            quiet = True
+            if self.fd is not None:
+                if select.select([self.fd], [], [], timeout)[0]:
+                    self.read_inotify(pending)
+                    quiet = False
+            else:
+                time.sleep(timeout)
+            
+            now = time.monotonic()
+            if now >= next_poll:
+                self.poll(pending)
+                next_poll = now + WATCH_POLL_INTERVAL
+            if pending and not batch_started:
+                batch_started = now
+            if pending and (quiet or now - batch_started >= WATCH_MAX_DELAY):
+                self.dispatch(pending)
+                pending = {}
+                batch_started = 0
+    
+    def read_inotify(self, pending):
+        """Читает накопившиеся события inotify в pending"""
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        moves = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            
+            if mask & self.IN_Q_OVERFLOW:
+                # Очередь ядра переполнена, события потеряны: пусть страницы перечитают листинг
+                with self.lock:
+                    for key in self.watches:
+                        pending[(key, None)] = {'event': 'reset'}
+                continue
+            with self.lock:
+                key = self.wds.get(wd)
+                if mask & self.IN_IGNORED:
+                    self.wds.pop(wd, None)
+            if key is None:
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                pending[(key, None)] = {'event': 'gone'}
+            elif mask & self.IN_MOVED_FROM:
+                moves[cookie] = (key, name)
+                self.merge(pending, key, name, 'delete')
+            elif mask & self.IN_MOVED_TO:
+                source = moves.pop(cookie, None)
+                if source is not None and source[0] == key:
+                    pending.pop(source, None)
+                    self.merge(pending, key, name, 'move', source[1])
+                else:
+                    self.merge(pending, key, name, 'create')
+            elif mask & self.IN_CREATE:
+                self.merge(pending, key, name, 'create')
+            elif mask & self.IN_DELETE:
+                self.merge(pending, key, name, 'delete')
+            elif mask & (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE):
+                self.merge(pending, key, name, 'modify')
+    
+    def merge(self, pending, key, name, kind, old_name=None):
+        """Добавляет событие в пачку, склеивая его с предыдущим для того же файла"""
+        previous = pending.get((key, name))
+        if previous is not None:
+            if kind == 'modify' and previous['event'] in ('create', 'move'):
+                return
+            if kind == 'delete' and previous['event'] == 'create':
+                del pending[(key, name)]
+                return
+        event = {'event': kind, 'name': name}
+        if old_name is not None:
+            event['from'] = old_name
+        pending[(key, name)] = event
+    
+    def snapshot(self, key):
+        """Состояние директории для опроса: имя -> (inode, размер, mtime)"""
+        result = {}
+        try:
+            with os.scandir(key) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    result[entry.name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+        return result
+    
+    def poll(self, pending):
+        """Сравнивает опрашиваемые директории с прошлым состоянием"""
+        with self.lock:
+            targets = [(key, watch) for key, watch in self.watches.items() if watch['wd'] is None]
+        for key, watch in targets:
+            old, new = watch['snapshot'], self.snapshot(key)
+            watch['snapshot'] = new
+            if new is None:
+                if old is not None:
+                    pending[(key, None)] = {'event': 'gone'}
+                continue
+            if old is None:
+                continue
+            for name in old.keys() - new.keys():
+                self.merge(pending, key, name, 'delete')
+            for name, signature in new.items():
+                if name not in old:
+                    self.merge(pending, key, name, 'create')
+                elif old[name] != signature:
+                    self.merge(pending, key, name, 'modify')
+    
+    def dispatch(self, pending):
+        """Рассылает пачку событий подписчикам"""
+        changed = []
+        with self.lock:
+            for (key, name), event in pending.items():
+                self.events += 1
+                if name is not None:
+                    changed.append(os.path.join(key, name))
+                    if 'from' in event:
+                        changed.append(os.path.join(key, event['from']))
+                watch = self.watches.get(key)
+                if watch is None:
+                    continue
+                for events in watch['subscribers']:
+                    try:
+                        events.put_nowait(event)
+                    except queue.Full:
+                        # Клиент не успевает читать: пусть перечитает листинг целиком
+                        while not events.empty():
+                            events.get_nowait()
+                        events.put_nowait({'event': 'reset'})
+        paths_changed(*changed)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'inotify' if self.fd is not None else 'polling',
+                'watched': len(self.watches),
+                'polled': sum(1 for watch in self.watches.values() if watch['wd'] is None),
+                'streams': self.streams,
+                'events': self.events,
+            }
+
+WATCHER = DirectoryWatcher()
+
+def grep_line(data, start, end):
+    """Строка файла для результата поиска"""
+    return bytes(data[start:end]).rstrip(b'\r').decode('utf-8', errors='replace')[:GREP_MAX_LINE]
+
+def grep_buffer(data, path, regex, context):
+    """Совпадения в содержимом файла (bytes или mmap), по одному на строку"""
+    found = []
+    line = 1
+    counted = 0
+    pos = 0
+    size = len(data)
+    while pos <= size and len(found) < GREP_MAX_FILE_MATCHES:
+        match = regex.search(data, pos)
+        if match is None:
+            break
+        start = data.rfind(b'\n', 0, match.start()) + 1
+        end = data.find(b'\n', match.start())
+        if end < 0:
+            end = size
+        line += data[counted:start].count(b'\n')
+        counted = start
+        
+        before = []
+        cursor = start
+        while len(before) < context and cursor > 0:
+            prev = data.rfind(b'\n', 0, cursor - 1) + 1
+            before.insert(0, grep_line(data, prev, cursor - 1))
+            cursor = prev
+        after = []
+        cursor = end
+        while len(after) < context and cursor < size:
+            nxt = data.find(b'\n', cursor + 1)
+            if nxt < 0:
+                nxt = size
+            after.append(grep_line(data, cursor + 1, nxt))
+            cursor = nxt
+        
+        found.append({
+            'path': path,
+            'line': line,
+            'text': grep_line(data, start, end),
+            'before': before,
+            'after': after,
+        })
+        pos = end + 1
+    return found
+
+def grep_files(paths, pattern, flags, context):
+    """Ищет выражение в файлах; выполняется в процессе пула.
+    
+    Возвращает (совпадения, просмотрено байт, пропущено бинарных файлов).
+    """
+    regex = re.compile(pattern, flags)
+    matches = []
+    scanned = 0
+    binary = 0
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    continue
+                # Нулевой байт в начале - почти наверняка не текст
+                if b'\0' in f.read(GREP_SNIFF_BYTES):
+                    binary += 1
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    matches += grep_buffer(data, path, regex, context)
+                scanned += size
+        except (OSError, ValueError):
+            continue
+    return matches, scanned, binary
+
+class ContentSearch:
+    """Поиск по содержимому файлов: обход дерева в потоке запроса,
+    сканирование пачками файлов в пуле процессов"""
+    
+    def __init__(self, workers=GREP_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.scanned_bytes = 0
+    
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # fork из многопоточного сервера небезопасен
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.pool
+    
+    def register(self):
+        """Новый поиск: (id, событие отмены)"""
+        job_id = secrets.token_hex(8)
+        cancelled = threading.Event()
+        with self.lock:
+            self.jobs[job_id] = cancelled
+        return job_id, cancelled
+    
+    def cancel(self, job_id):
+        with self.lock:
+            cancelled = self.jobs.get(job_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+    
+    def forget(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+    
+    def iter_files(self, top, name_glob=None, allowed=None):
+        """Обычные файлы дерева: (путь, размер); ссылки - если allowed(путь) их пропускает"""
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.path != DATA_DIR:
+                                    stack.append(entry.path)
+                            elif (entry.is_file() and (not name_glob or fnmatch.fnmatch(entry.name, name_glob))
+                                  and (allowed is None or not entry.is_symlink() or allowed(entry.path))):
+                                yield entry.path, entry.stat().st_size
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+    
+    def batches(self, files):
+        """Группирует файлы в задания примерно по GREP_BATCH_BYTES"""
+        batch = []
+        size = 0
+        for path, file_size in files:
+            batch.append(path)
+            size += file_size
+            if size >= GREP_BATCH_BYTES or len(batch) >= GREP_BATCH_FILES:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+    
+    def search(self, top, pattern, flags, context, cancelled, name_glob=None, allowed=None):
+        """Генератор событий поиска: match, progress и итоговое done"""
+        pool = self.get_pool()
+        batches = self.batches(self.iter_files(top, name_glob, allowed))
+        running = set()
+        exhausted = False
+        totals = {'files': 0, 'bytes': 0, 'binary': 0, 'matches': 0}
+        started = time.monotonic()
+        try:
+            while not cancelled.is_set():
+                # Держим в работе не больше двух заданий на процесс
+                while not exhausted and len(running) < self.workers * 2:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                        break
+                    running.add(pool.submit(grep_files, batch, pattern, flags, context))
+                    totals['files'] += len(batch)
+                if not running:
+                    break
+                done, running = wait(running, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, scanned, binary = future.result()
+                    totals['bytes'] += scanned
+                    totals['binary'] += binary
+                    for match in found[:GREP_MAX_MATCHES - totals['matches']]:
+                        totals['matches'] += 1
+                        yield {'type': 'match', **match}
+                    if totals['matches'] >= GREP_MAX_MATCHES:
+                        cancelled.set()
+                yield {'type': 'progress', **totals}
+        finally:
+            for future in running:
+                future.cancel()
+            with self.lock:
+                self.scanned_bytes += totals['bytes']
+        yield {
+            'type': 'done',
+            **totals,
+            'seconds': round(time.monotonic() - started, 3),
+            'cancelled': cancelled.is_set() and totals['matches'] < GREP_MAX_MATCHES,
+            'truncated': totals['matches'] >= GREP_MAX_MATCHES,
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'running': len(self.jobs),
+                'scanned_bytes': self.scanned_bytes,
+            }
+
+GREP = ContentSearch()
+
+class DirectorySizes:
+    """Рекурсивные размеры директорий (как du) с кешем по mtime.
+    
+    Кешируется только собственное содержимое каждой директории: сумма размеров
+    файлов, поддиректории и крупнейшие файлы. Запись действительна, пока не
+    изменились inode и mtime директории и не истёк DU_CACHE_TTL (размер файла
+    меняется без смены mtime директории), поэтому повторный подсчёт перечитывает
+    только изменившиеся директории. Директории читаются параллельно в пуле потоков.
+    """
+    
+    def __init__(self, workers=DU_WORKERS, max_dirs=DU_CACHE_DIRS, max_age=DU_CACHE_TTL):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fm-du')
+        self.max_dirs = max_dirs
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def own(self, path):
+        """Собственное содержимое директории: из кеша или с диска"""
+        st = os.stat(path)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if (entry is not None and entry['ino'] == st.st_ino
+                    and entry['mtime_ns'] == st.st_mtime_ns and now - entry['time'] < self.max_age):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        
+        size = disk = files = 0
+        subdirs = []
+        sizes = []
+        with os.scandir(path) as entries:
+            for item in entries:
+                try:
+                    item_st = item.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                disk += item_st.st_blocks * 512
+                if stat.S_ISDIR(item_st.st_mode):
+                    if item.path != DATA_DIR:
+                        subdirs.append(item.name)
+                else:
+                    size += item_st.st_size
+                    files += 1
+                    sizes.append((item_st.st_size, item.name))
+        entry = {
+            'ino': st.st_ino,
+            'mtime_ns': st.st_mtime_ns,
+            'time': now,
+            'size': size,
+            'disk': disk,
+            'files': files,
+            'subdirs': subdirs,
+            'top': heapq.nlargest(DU_TOP_FILES, sizes),
+        }
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_dirs:
+                self.entries.popitem(last=False)
+        return entry
+    
+    def usage(self, path, limit=DU_TOP_FILES):
+        """Размеры элементов директории по убыванию и крупнейшие файлы всего дерева"""
+        started = time.monotonic()
+        root = self.own(path)
+        totals = {name: {'size': 0, 'disk': 0, 'files': 0, 'dirs': 0} for name in root['subdirs']}
+        largest = []
+        
+        def add_top(entry, directory):
+            for size, name in entry['top']:
+                item = (size, os.path.join(directory, name))
+                if len(largest) < DU_TOP_FILES:
+                    heapq.heappush(largest, item)
+                elif item > largest[0]:
+                    heapq.heapreplace(largest, item)
+        
+        add_top(root, path)
+        # Обход в ширину: потоки читают директории, этот поток только суммирует.
+        # В работе держим ограниченное число заданий, остальные ждут в backlog
+        backlog = [(os.path.join(path, name), name) for name in root['subdirs']]
+        running = {}
+        errors = 0
+        while backlog or running:
+            while backlog and len(running) < self.workers * 4:
+                directory, child = backlog.pop()
+                running[self.executor.submit(self.own, directory)] = (directory, child)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory, child = running.pop(future)
+                try:
+                    entry = future.result()
+                except OSError:
+                    errors += 1
+                    continue
+                total = totals[child]
+                total['size'] += entry['size']
+                total['disk'] += entry['disk']
+                total['files'] += entry['files']
+                total['dirs'] += 1
+                add_top(entry, directory)
+                backlog.extend((os.path.join(directory, name), child) for name in entry['subdirs'])
+        
+        items = [{'name': name, 'path': os.path.join(path, name), 'is_dir': True, **total}
+                 for name, total in totals.items()]
+        items += [{'name': name, 'path': os.path.join(path, name), 'is_dir': False,
+                   'size': size, 'files': 1} for size, name in root['top']]
+        items.sort(key=lambda item: item['size'], reverse=True)
+        return {
+            'path': path,
+            'size': root['size'] + sum(t['size'] for t in totals.values()),
+            'disk': root['disk'] + sum(t['disk'] for t in totals.values()),
+            'files': root['files'] + sum(t['files'] for t in totals.values()),
+            'dirs': sum(t['dirs'] for t in totals.values()),
+            'errors': errors,
+            'seconds': round(time.monotonic() - started, 3),
+            'items': items[:limit],
+            'largest_files': [{'path': p, 'size': size} for size, p in sorted(largest, reverse=True)],
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'dirs': len(self.entries),
+                'max_dirs': self.max_dirs,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+DIR_SIZES = DirectorySizes()
+
+class QuotaExceeded(Exception):
+    """Запись не помещается в квоту пользователя"""
+
+class DiskQuotas:
+    """Квоты на место в корнях пользователей.
+    
+    Занятое место считается обходом дерева (DIR_SIZES) один раз, дальше
+    учёт ведётся приращениями: запись заранее резервирует байты через
+    charge(), удаление и неудачная запись возвращают их через release().
+    Учёт ведётся по пути, а не по пользователю, поэтому запись
+    администратора в чужой корень тоже учитывается. Заново дерево
+    обходится, только если учёт сброшен (stale) или старше
+    QUOTA_RECOUNT_INTERVAL - так подхватываются и изменения в обход сервера.
+    """
+    
+    def __init__(self):
+        self.roots = {}     # корень -> {'quota', 'used' (None - не посчитано), 'counted'}
+        self.lock = threading.Lock()
+        self.recounts = 0
+    
+    def track(self, root, quota):
+        """Ставит корень на учёт (quota 0 - снимает ограничение)"""
+        root = os.path.abspath(root)
+        with self.lock:
+            if quota:
+                entry = self.roots.setdefault(root, {'quota': quota, 'used': None, 'counted': 0})
+                entry['quota'] = quota
+            else:
+                self.roots.pop(root, None)
+    
+    def entries(self, path):
+        """Учитываемые корни, в которых лежит path"""
+        path = os.path.abspath(path)
+        return [(root, entry) for root, entry in list(self.roots.items())
+                if path == root or path.startswith(root + os.sep)]
+    
+    def count(self, root, entry):
+        """Пересчитывает занятое место, если учёт сброшен или устарел"""
+        if entry['used'] is not None and time.monotonic() - entry['counted'] < QUOTA_RECOUNT_INTERVAL:
+            return
+        try:
+            used = DIR_SIZES.usage(root, limit=0)['size']
+        except FileNotFoundError:
+            used = 0
+        with self.lock:
+            entry['used'] = used
+            entry['counted'] = time.monotonic()
+            self.recounts += 1
+    
+    def charge(self, path, size):
+        """Резервирует size байт под запись в path или бросает QuotaExceeded"""
+        if size <= 0:
+            self.release(path, -size)
+            return
+        entries = self.entries(path)
+        for root, entry in entries:
+            self.count(root, entry)
+        with self.lock:
+            # Учёт, сброшенный за это время, пересчитается при следующей записи
+            entries = [entry for root, entry in entries if entry['used'] is not None]
+            for entry in entries:
+                if entry['used'] + size > entry['quota']:
+                    raise QuotaExceeded(f"Disk quota exceeded: {entry['used'] + size} of "
+                                        f"{entry['quota']} bytes")
+            for entry in entries:
+                entry['used'] += size
+    
+    def undo(self, path, size):
+        """Откатывает charge(path, size), в том числе отрицательный, без проверки квоты"""
+        if size >= 0:
+            self.release(path, size)
+            return
+        with self.lock:
+            for root, entry in self.entries(path):
+                if entry['used'] is not None:
+                    entry['used'] -= size
+    
+    def release(self, path, size):
+        """Возвращает size байт (удаление, откат резерва)"""
+        if size <= 0:
+            return
+        with self.lock:
+            for root, entry in self.entries(path):
+                if entry['used'] is not None:
+                    entry['used'] = max(entry['used'] - size, 0)
+    
+    def stale(self, *paths):
+        """Сбрасывает учёт корней с этими путями: при следующей записи они пересчитаются"""
+        with self.lock:
+            for path in paths:
+                for root, entry in self.entries(path):
+                    entry['used'] = None
+    
+    def moved(self, src, dst):
+        """Перенос между корнями: размер неизвестен, такие корни пересчитаются"""
+        before, after = dict(self.entries(src)), dict(self.entries(dst))
+        with self.lock:
+            for root in before.keys() ^ after.keys():
+                (before.get(root) or after[root])['used'] = None
+    
+    def usage(self, root):
+        """(занято, квота) корня или None, если квоты нет"""
+        entry = self.roots.get(os.path.abspath(root))
+        if entry is None:
+            return None
+        self.count(root, entry)
+        return entry['used'], entry['quota']
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'roots': len(self.roots),
+                'recounts': self.recounts,
+                'used': sum(entry['used'] or 0 for entry in self.roots.values()),
+            }
+
+QUOTAS = DiskQuotas()
+
+class JobCancelled(Exception):
+    """Задание отменено пользователем"""
+
+class JobManager:
+    """Долгие операции с файлами (удаление, копирование) в фоновом пуле.
+    
+    Одновременно выполняется не больше JOB_WORKERS заданий, остальные ждут
+    в очереди. Задание обновляет счётчики прогресса (файлы и байты) и между
+    файлами и кусками данных проверяет, не отменили ли его.
+    """
+    
+    def __init__(self, workers=JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fm-job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def submit(self, kind, paths, func):
+        """Ставит задание в очередь; func(job, cancel) выполняет его в пуле"""
+        job = {
+            'id': secrets.token_hex(8),
+            'kind': kind,
+            'paths': list(paths),
+            'status': 'queued',
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'files_total': None,
+            'bytes_total': None,
+            'files_done': 0,
+            'bytes_done': 0,
+            'current': None,
+            'error': None,
+        }
+        control = {'cancel': threading.Event(), 'future': None}
+        with self.lock:
+            self.expire()
+            self.jobs[job['id']] = (job, control)
+            control['future'] = self.executor.submit(self.run, job, control['cancel'], func)
+        return dict(job)
+    
+    def run(self, job, cancel, func):
+        job['status'] = 'running'
+        job['started'] = time.time()
+        try:
+            func(job, cancel)
+            job['status'] = 'done'
+        except JobCancelled:
+            job['status'] = 'cancelled'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            job['current'] = None
+            job['finished'] = time.time()
+    
+    def cancel(self, job_id):
+        with self.lock:
+            item = self.jobs.get(job_id)
+        if item is None:
+            return False
+        job, control = item
+        control['cancel'].set()
+        # Ещё не начатое задание снимается с очереди сразу
+        if control['future'].cancel():
+            job['status'] = 'cancelled'
+            job['finished'] = time.time()
+        return True
+    
+    def get(self, job_id):
+        with self.lock:
+            item = self.jobs.get(job_id)
+        return dict(item[0]) if item else None
+    
+    def list(self):
+        with self.lock:
+            self.expire()
+            return [dict(job) for job, _ in self.jobs.values()]
+    
+    def expire(self):
+        """Забывает давно завершённые задания (вызывается под lock)"""
+        deadline = time.time() - JOB_KEEP
+        for job_id, (job, _) in list(self.jobs.items()):
+            if job['finished'] and job['finished'] < deadline:
+                del self.jobs[job_id]
+    
+    def stats(self):
+        with self.lock:
+            statuses = [job['status'] for job, _ in self.jobs.values()]
+        return {status: statuses.count(status) for status in set(statuses)}
+
+JOBS = JobManager()
+
+def check_cancel(cancel):
+    if cancel.is_set():
+        raise JobCancelled()
+
+def count_tree(job, paths, cancel):
+    """Заполняет в задании общее число файлов и байт"""
+    files = size = 0
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, names in os.walk(path):
+                check_cancel(cancel)
+                # Ссылки на директории обходятся как файлы
+                links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+                for name in names + links:
+                    try:
+                        size += os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        pass
+                    files += 1
+        elif os.path.lexists(path):
+            files += 1
+            size += os.lstat(path).st_size
+    job['files_total'] = files
+    job['bytes_total'] = size
+
+def run_delete(job, cancel):
+    """Задание удаления файлов и директорий"""
+    paths = job['paths']
+    try:
+        count_tree(job, paths, cancel)
+        for path in paths:
+            done = job['bytes_done']
+            try:
+                delete_path(job, path, cancel)
+            finally:
+                # Освободившееся место возвращается в квоту
+                QUOTAS.release(path, job['bytes_done'] - done)
+    finally:
+        paths_changed(*paths)
+
+def delete_path(job, path, cancel):
+    """Удаляет файл или дерево, отмечая прогресс в задании"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        job['current'] = path
+        size = os.lstat(path).st_size
+        os.remove(path)
+        job['files_done'] += 1
+        job['bytes_done'] += size
+        return
+    for root, dirs, names in os.walk(path, topdown=False):
+        for name in names:
+            check_cancel(cancel)
+            file_path = os.path.join(root, name)
+            job['current'] = file_path
+            size = os.lstat(file_path).st_size
+            os.remove(file_path)
+            job['files_done'] += 1
+            job['bytes_done'] += size
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            # Ссылка на директорию попадает в dirs, но удаляется как файл
+            if os.path.islink(dir_path):
+                os.remove(dir_path)
+            else:
+                os.rmdir(dir_path)
+    os.rmdir(path)
+
+# ioctl FICLONE: копия-ссылка на те же блоки (btrfs, XFS с reflink, ...)
+FICLONE = 0x40049409
+# Ошибки, после которых способ копирования для этой пары файлов не подходит
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                        errno.ENOTTY, errno.EBADF, errno.EPERM)
+# Устройства, на которых reflink уже не удался - не пробуем снова
+NO_REFLINK_DEVICES = set()
+
+def open_regular(path, flags):
+    """Открывает обычный файл без блокировки на FIFO, иначе OSError"""
+    fd = os.open(path, flags | os.O_NONBLOCK, 0o666)
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", path)
+        return open(fd, 'rb' if flags & os.O_ACCMODE == os.O_RDONLY else 'wb')
+    except BaseException:
+        os.close(fd)
+        raise
+
+def copy_file(src, dst, progress=None, cancel=None):
+    """Копирует файл с метаданными, по возможности не гоняя данные через процесс.
+    
+    Сначала reflink (FICLONE), затем copy_file_range и sendfile, которые
+    копируют внутри ядра, и только потом чтение в буфер. progress(n)
+    получает число скопированных байт. Копируются только обычные файлы:
+    открытие FIFO или устройства повесило бы задание.
+    """
+    # O_NONBLOCK: open() на FIFO не ждёт другую сторону, тип проверяем по fstat
+    with open_regular(src, os.O_RDONLY) as fsrc, \
+            open_regular(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC) as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        st = os.fstat(src_fd)
+        devices = (st.st_dev, os.fstat(dst_fd).st_dev)
+        copied = 0
+        
+        if st.st_size and devices not in NO_REFLINK_DEVICES:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                copied = st.st_size
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRORS:
+                    raise
+                NO_REFLINK_DEVICES.add(devices)
+        if copied and progress:
+            progress(copied)
+        
+        for method in ('copy_file_range', 'sendfile'):
+            if copied >= st.st_size:
+                break
+            if not hasattr(os, method):
+                continue
+            try:
+                while True:
+                    if cancel is not None:
+                        check_cancel(cancel)
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK, copied, copied)
+                    else:
+                        sent = os.sendfile(dst_fd, src_fd, copied, COPY_CHUNK)
+                    if not sent:
+                        break
+                    copied += sent
+                    if progress:
+                        progress(sent)
+            except OSError as e:
+                # Ничего не скопировано - пробуем следующий способ
+                if e.errno not in COPY_FALLBACK_ERRORS or copied:
+                    raise
+                continue
+            break
+        else:
+            # Ни один способ ядра не подошёл
+            buf = bytearray(CHUNK_SIZE)
+            view = memoryview(buf)
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            while True:
+                if cancel is not None:
+                    check_cancel(cancel)
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                fdst.write(view[:n])
+                if progress:
+                    progress(n)
+    shutil.copystat(src, dst)
+
+def copy_tree(src, dst, progress=None, cancel=None, workers=COPY_WORKERS, on_file=None):
+    """Копирует дерево: директории и ссылки создаются по порядку, файлы - в пуле потоков.
+    
+    Как copytree: dst не должен существовать, ссылки копируются ссылками,
+    права и времена сохраняются (у директорий - после заполнения).
+    FIFO, сокеты и устройства пропускаются.
+    """
+    os.mkdir(dst)
+    dirs = [(src, dst)]
+    files = []
+    for root, subdirs, names in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        # Множество: на широких директориях поиск в списке дал бы O(n^2)
+        dir_names = set(subdirs)
+        for name in subdirs + names:
+            path = os.path.join(root, name)
+            mode = os.lstat(path).st_mode
+            if stat.S_ISLNK(mode):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                shutil.copystat(path, os.path.join(target, name), follow_symlinks=False)
+                if on_file:
+                    on_file(path)
+            elif name in dir_names:
+                os.mkdir(os.path.join(target, name))
+                dirs.append((path, os.path.join(target, name)))
+            elif stat.S_ISREG(mode):
+                files.append((path, os.path.join(target, name)))
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fm-copy') as pool:
+        futures = [pool.submit(copy_file, s, d, progress, cancel) for s, d in files]
+        try:
+            for future, (path, _) in zip(futures, files):
+                future.result()
+                if on_file:
+                    on_file(path)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    # Время изменения директорий ставим последним: создание файлов его сбивает
+    for path, target in reversed(dirs):
+        shutil.copystat(path, target)
+
+def run_clone(job, cancel):
+    """Задание копирования: рядом с каждым путём появляется <путь>_copy"""
+    created = []
+    lock = threading.Lock()
+    
+    def progress(count):
+        with lock:
+            job['bytes_done'] += count
+    
+    def on_file(path):
+        with lock:
+            job['files_done'] += 1
+            job['current'] = path
+    
+    # Место под копии резервируется в квоте заранее, по каждому пути отдельно
+    sizes = {}
+    reserved = []
+    try:
+        files = 0
+        for path in job['paths']:
+            count_tree(job, [path], cancel)
+            sizes[path] = job['bytes_total']
+            files += job['files_total']
+        job['files_total'], job['bytes_total'] = files, sum(sizes.values())
+        for path in job['paths']:
+            QUOTAS.charge(path, sizes[path])
+            reserved.append(path)
+        for path in job['paths']:
+            new_path = path + '_copy'
+            if os.path.isdir(path):
+                # Как copytree: существующая копия директории - ошибка
+                if os.path.lexists(new_path):
+                    raise FileExistsError(errno.EEXIST, 'File exists', new_path)
+                created.append(new_path)
+                copy_tree(path, new_path, progress, cancel, on_file=on_file)
+            else:
+                created.append(new_path)
+                job['current'] = path
+                copy_file(path, new_path, progress, cancel)
+                on_file(path)
+    except JobCancelled:
+        # Недоделанные копии не оставляем
+        for new_path in created:
+            if os.path.isdir(new_path) and not os.path.islink(new_path):
+                shutil.rmtree(new_path, ignore_errors=True)
+            elif os.path.lexists(new_path):
+                os.remove(new_path)
+        for path in reserved:
+            QUOTAS.release(path, sizes[path])
+        raise
+    except BaseException:
+        # Не начатые копии возвращают резерв, недоделанная пересчитается
+        for path in reserved[len(created):]:
+            QUOTAS.release(path, sizes[path])
+        QUOTAS.stale(*created[-1:])
+        raise
+    finally:
+        paths_changed(*created)
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    """Копирует length байт из src_fd в dst_fd по заданным смещениям.
+    
+    Сначала copy_file_range (данные не проходят через процесс), иначе
+    pread/pwrite кусками CHUNK_SIZE. Возвращает смещение в dst после копии.
+    """
+    end = src_offset + length
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while src_offset < end:
+                sent = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK, end - src_offset),
+                                          src_offset, dst_offset)
+                if not sent:
+                    break
+                src_offset += sent
+                dst_offset += sent
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    while src_offset < end:
+        data = os.pread(src_fd, min(CHUNK_SIZE, end - src_offset), src_offset)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(dst_fd, view, dst_offset)
+            view = view[written:]
+            dst_offset += written
+        src_offset += len(data)
+    if src_offset < end:
+        raise ValueError("File was truncated while copying")
+    return dst_offset
+
+class LineIndex:
+    """Разреженный индекс строк файла для постраничного редактора.
+    
+    Хранится только число переводов строк до начала каждого блока
+    LINE_INDEX_BLOCK байт, то есть 8 байт на блок, а не на строку: для
+    файла в 2 ГБ это около 250 КБ. Строка внутри блока ищется при чтении
+    окна. Строится за один проход чтения; если файл с тем же inode только
+    вырос (дописываемый лог), досчитывается с последнего неполного блока.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.counts = array('Q', [0])   # counts[i] - переводов строк в [0, i * LINE_INDEX_BLOCK)
+        self.tail_lines = 0             # Переводов строк в последнем неполном блоке
+        self.size = 0
+        self.last_byte = b''
+        self.lock = threading.Lock()
+        self.builds = 0
+    
+    def update(self, fd, st):
+        """Приводит индекс к текущей версии открытого файла (st - его fstat)"""
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if key == self.key:
+            return
+        block = LINE_INDEX_BLOCK
+        if self.key is None or key[:2] != self.key[:2] or st.st_size <= self.size:
+            self.counts = array('Q', [0])
+            self.builds += 1
+        pos = (len(self.counts) - 1) * block
+        self.tail_lines = 0
+        while pos < st.st_size:
+            data = os.pread(fd, min(LINE_INDEX_READ, st.st_size - pos), pos)
+            if not data:
+                break
+            for start in range(0, len(data), block):
+                lines = data.count(b'\n', start, start + block)
+                if start + block <= len(data):
+                    self.counts.append(self.counts[-1] + lines)
+                else:
+                    self.tail_lines = lines
+            pos += len(data)
+        self.size = pos
+        self.last_byte = os.pread(fd, 1, pos - 1) if pos else b''
+        self.key = key[:2] + (pos, st.st_mtime_ns)
+    
+    @property
+    def newlines(self):
+        return self.counts[-1] + self.tail_lines
+    
+    @property
+    def lines(self):
+        """Число строк; последняя строка может быть без перевода строки"""
+        return self.newlines + (1 if self.size and self.last_byte != b'\n' else 0)
+    
+    def line_offset(self, fd, n):
+        """Смещение начала строки n (с нуля); за последней строкой - размер файла"""
+        if n <= 0:
+            return 0
+        if n > self.newlines:
+            return self.size
+        # Блок, в котором лежит n-й перевод строки
+        block = bisect.bisect_left(self.counts, n) - 1
+        pos = block * LINE_INDEX_BLOCK
+        data = os.pread(fd, min(LINE_INDEX_BLOCK, self.size - pos), pos)
+        index = -1
+        for _ in range(n - self.counts[block]):
+            index = data.find(b'\n', index + 1)
+        return pos + index + 1
+    
+    def read_window(self, fd, start, count, max_bytes=EDITOR_WINDOW_BYTES):
+        """Читает строки [start, start + count), но не больше max_bytes.
+        
+        Окно, упёршееся в max_bytes, обрезается по последней целой строке.
+        Если не влезает даже одна строка, отдаётся её начало с truncated,
+        такое окно можно только смотреть.
+        """
+        start = min(max(start, 0), self.lines)
+        offset = self.line_offset(fd, start)
+        end = self.line_offset(fd, start + count)
+        truncated = False
+        if end - offset > max_bytes:
+            data = os.pread(fd, max_bytes, offset)
+            cut = data.rfind(b'\n')
+            if cut >= 0:
+                data = data[:cut + 1]
+            else:
+                truncated = True
+            end = offset + len(data)
+        else:
+            data = os.pread(fd, end - offset, offset)
+        lines = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+        return {
+            'start': start,
+            'count': lines,
+            'lines': self.lines,
+            'offset': offset,
+            'end': end,
+            'size': self.size,
+            'truncated': truncated,
+            'text': data.decode('utf-8', errors='replace'),
+        }
+    
+    def read_since(self, fd, offset, max_bytes=EDITOR_WINDOW_BYTES):
+        """Целые строки, дописанные после offset (режим tail)"""
+        data = os.pread(fd, min(max_bytes, self.size - offset), offset) if offset < self.size else b''
+        # Недописанная строка уйдёт в следующий раз, если не упёрлась в лимит
+        if len(data) < max_bytes:
+            data = data[:data.rfind(b'\n') + 1]
+        return {
+            'offset': offset,
+            'end': offset + len(data),
+            'lines': self.lines,
+            'size': self.size,
+            'text': data.decode('utf-8', errors='replace'),
+        }
+
+class LineIndexCache:
+    """LRU индексов строк открытых в редакторе файлов"""
+    
+    def __init__(self, max_files=LINE_INDEX_FILES):
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, path):
+        """Индекс файла path; строится или досчитывается при update"""
+        path = os.path.realpath(path)
+        with self.lock:
+            index = self.entries.get(path)
+            if index is None:
+                index = self.entries[path] = LineIndex(path)
+                while len(self.entries) > self.max_files:
+                    self.entries.popitem(last=False)
+            self.entries.move_to_end(path)
+            return index
+    
+    def stats(self):
+        with self.lock:
+            indexes = list(self.entries.values())
+        return {
+            'files': len(indexes),
+            'blocks': sum(len(index.counts) for index in indexes),
+            'builds': sum(index.builds for index in indexes),
+        }
+
+LINE_INDEXES = LineIndexCache()
+
+def patch_file(path, offset, end, content, expected_etag):
+    """Заменяет байты [offset, end) файла содержимым content (файловый объект).
+    
+    Файл собирается заново рядом с исходным: голова и хвост копируются
+    ядром, в памяти держится только кусок нового содержимого. Смещения
+    относятся к версии файла с ETag expected_etag, иначе SaveConflict.
+    Сборка идёт без SAVE_LOCK, он берётся только на повторную проверку
+    ETag и os.replace: копия многогигабайтного файла не держит остальные
+    сохранения.
+    """
+    if not expected_etag:
+        raise ValueError("ETag of the loaded window is required")
+    target = os.path.realpath(path)
+    with open(target, 'rb') as src:
+        st = os.fstat(src.fileno())
+        if file_etag(st) != expected_etag:
+            raise SaveConflict("File was changed after the window was loaded, reload it before saving")
+        if not 0 <= offset <= end <= st.st_size:
+            raise ValueError("Patch range is outside of the file")
+        writer = AtomicWriter(os.path.dirname(target))
+        try:
+            dst_fd = writer.file.fileno()
+            copy_range(src.fileno(), dst_fd, 0, 0, offset)
+            writer.file.seek(offset)
+            if content is not None:
+                content.seek(0)
+                shutil.copyfileobj(content, writer.file, CHUNK_SIZE)
+            new_end = writer.file.tell()
+            writer.file.flush()
+            copy_range(src.fileno(), dst_fd, end, new_end, st.st_size - end)
+            writer.file.seek(new_end + st.st_size - end)
+            # Долгий fsync - до блокировки, в commit он уже почти ничего не пишет
+            writer.file.flush()
+            os.fsync(dst_fd)
+            with SAVE_LOCK:
+                try:
+                    current = os.stat(target)
+                except FileNotFoundError:
+                    current = None
+                if current is None or file_etag(current) != expected_etag:
+                    raise SaveConflict("File was changed while the patch was applied, reload it before saving")
+                writer.commit(target, st)
+        finally:
+            writer.discard()
+    return new_end
+
+class Thumbnails:
+    """Миниатюры картинок для листинга с дисковым кешем.
+    
+    Имя файла миниатюры - хеш пути, mtime и размера картинки, поэтому
+    изменённая картинка просто получает новую запись, а старая уходит при
+    вытеснении. Кеш ограничен max_bytes, вытесняются давно не запрошенные
+    (при попадании mtime записи обновляется, так порядок переживает
+    перезапуск). Строятся в пуле потоков: Pillow отпускает GIL при
+    декодировании и масштабировании. Без Pillow миниатюр нет.
+    """
+    
+    def __init__(self, directory, max_bytes=THUMB_CACHE_BYTES, workers=THUMB_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.executor = None
+        self.format = None
+        if Image is not None:
+            self.format = 'WEBP' if pil_features.check('webp') else 'JPEG'
+        self.content_type = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}.get(self.format)
+        self.entries = None
+        self.bytes = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self):
+        return self.format is not None
+    
+    def supports(self, ext, size):
+        """Будет ли у картинки с таким расширением и размером миниатюра в листинге"""
+        if ext == '.svg' or not self.enabled:
+            # SVG и картинки без Pillow браузер уменьшает сам
+            return size <= THUMB_PASSTHROUGH
+        return True
+    
+    def load(self):
+        """Читает содержимое кеша с диска: от давно использованных к недавним"""
+        os.makedirs(self.directory, exist_ok=True)
+        items = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith('.tmp'):
+                        # Недописанная миниатюра с прошлого запуска
+                        os.remove(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                items.append((st.st_mtime, entry.name, st.st_size))
+        items.sort()
+        self.entries = OrderedDict((name, size) for _, name, size in items)
+        self.bytes = sum(self.entries.values())
+    
+    def get(self, path, st):
+        """Путь к файлу миниатюры path; при промахе она строится в пуле"""
+        key = f'{path}\0{st.st_mtime_ns}\0{st.st_size}\0{THUMB_SIZE}'
+        name = hashlib.sha1(key.encode()).hexdigest() + ('.webp' if self.format == 'WEBP' else '.jpg')
+        cached = os.path.join(self.directory, name)
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                future = None
+            else:
+                future = self.pending.get(name)
+                if future is None:
+                    self.misses += 1
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='fm-thumb')
+                    future = self.pending[name] = self.executor.submit(self.generate, path, name)
+        if future is not None:
+            future.result()
+            return cached
+        try:
+            os.utime(cached)
+        except FileNotFoundError:
+            # Файл удалили мимо кеша - строим заново
+            with self.lock:
+                self.bytes -= self.entries.pop(name, 0)
+            return self.get(path, st)
+        return cached
+    
+    def generate(self, path, name):
+        """Строит миниатюру (в потоке пула) и атомарно кладёт её в кеш"""
+        try:
+            with Image.open(path) as image:
+                # JPEG декодируется сразу в уменьшенном масштабе
+                image.draft('RGB', (THUMB_SIZE * 2, THUMB_SIZE * 2))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+                if has_alpha and self.format == 'JPEG':
+                    background = Image.new('RGB', image.size, (45, 55, 72))
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        image.save(f, self.format, quality=THUMB_QUALITY)
+                        size = f.tell()
+                    os.replace(tmp_path, os.path.join(self.directory, name))
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+        except BaseException:
+            with self.lock:
+                self.pending.pop(name, None)
+                self.errors += 1
+            raise
+        with self.lock:
+            self.entries[name] = size
+            self.bytes += size
+            self.pending.pop(name, None)
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except FileNotFoundError:
+                    pass
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'format': self.format,
+                'files': len(self.entries or ()),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'evictions': self.evictions,
+                'pending': len(self.pending),
+            }
+
+THUMBNAILS = Thumbnails(os.path.join(DATA_DIR, 'thumbs'))
+
+class ArchiveStream:
+    """Поток для zipfile/tarfile поверх ответа.
+    
+    Склеивает мелкие записи заголовков в куски CHUNK_SIZE и считает
+    записанные байты: zipfile без seek пишет архив с data descriptor,
+    а tell() нужен ему для смещений в central directory.
+    """
+    
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.buf = bytearray()
+        self.written = 0
+    
+    def write(self, data):
+        self.buf += data
+        self.written += len(data)
+        if len(self.buf) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+    
+    def tell(self):
+        return self.written
+    
+    def flush(self):
+        if self.buf:
+            self.wfile.write(bytes(self.buf))
+            del self.buf[:]
+
+# Формат скачивания: (расширение файла, Content-Type)
+ARCHIVE_FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'zip-store': ('.zip', 'application/zip'),
+    'tar.gz': ('.tar.gz', 'application/gzip'),
+}
+# Архивы, которые открываются в листинге как директории (длинные суффиксы раньше)
+BROWSABLE_ARCHIVES = ('.tar.gz', '.tgz', '.zip', '.tar', '.gz')
+
+def archive_entries(paths, allowed=None):
+    """Перебирает (путь, имя в архиве) выбранных путей и содержимого директорий.
+    
+    Ссылки внутри директорий, которые allowed(путь) не пропускает, опускаются.
+    """
+    for path in paths:
+        path = os.path.normpath(path)
+        base = os.path.basename(path)
+        yield path, base
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        for root, dirs, files in os.walk(path):
+            # Служебные данные сервера в архив не попадают
+            dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != DATA_DIR)
+            prefix = os.path.normpath(os.path.join(base, os.path.relpath(root, path)))
+            for name in dirs + sorted(files):
+                entry_path = os.path.join(root, name)
+                if allowed is not None and os.path.islink(entry_path) and not allowed(entry_path):
+                    continue
+                yield entry_path, os.path.join(prefix, name)
+
+def write_zip(stream, paths, compression=zipfile.ZIP_DEFLATED, stored_exts=(), allowed=None):
+    """Пишет ZIP архив путей в stream, читая файлы кусками.
+    
+    Уже сжатые форматы (stored_exts) кладутся без сжатия. Ссылки на файлы
+    разыменовываются (если allowed их пропускает), ссылки на директории и
+    специальные файлы пропускаются.
+    """
+    with zipfile.ZipFile(stream, 'w', compression) as archive:
+        for path, name in archive_entries(paths, allowed):
+            try:
+                st = os.stat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.islink(path):
+                        info = zipfile.ZipInfo.from_file(path, name, strict_timestamps=False)
+                        info.CRC = 0
+                        # ZipFile.mkdir есть только с Python 3.11
+                        archive.writestr(info, b'')
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                f = open(path, 'rb')
+            except OSError:
+                # Нечитаемый файл пропускаем, архив собирается дальше
+                continue
+            with f:
+                info = zipfile.ZipInfo.from_file(path, name, strict_timestamps=False)
+                info.compress_type = compression
+                if os.path.splitext(name)[1].lower() in stored_exts:
+                    info.compress_type = zipfile.ZIP_STORED
+                remaining = info.file_size
+                with archive.open(info, 'w') as dst:
+                    while remaining > 0:
+                        data = f.read(min(CHUNK_SIZE, remaining))
+                        if not data:
+                            break
+                        dst.write(data)
+                        remaining -= len(data)
+
+def write_tar(stream, paths):
+    """Пишет tar архив путей в stream (ссылки сохраняются ссылками)"""
+    with tarfile.open(fileobj=stream, mode='w|') as archive:
+        for path, name in archive_entries(paths):
+            try:
+                info = archive.gettarinfo(path, name)
+                if info is None:
+                    # Сокеты и прочие файлы, которых нет в tar
+                    continue
+                f = open(path, 'rb') if info.isreg() else None
+            except OSError:
+                continue
+            try:
+                archive.addfile(info, f)
+            finally:
+                if f is not None:
+                    f.close()
+
+def archive_name(name):
+    """Имя записи архива как путь 'a/b': без ведущего '/' и '.', с '/' вместо
+    '\\'. None для пустых имён и имён с '..'.
+    
+    Одно приведение и для оглавления, и для распаковки: иначе в архиве
+    можно было бы увидеть одно, а распаковать другое.
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return '/'.join(parts)
+
+class ArchiveIndex:
+    """Оглавление архива как дерево виртуальных директорий.
+    
+    ZIP читается по central directory, tar - по заголовкам записей (tar.gz
+    для этого распаковывается один раз целиком), одиночный .gz - как архив
+    из одного файла. Имена с '..' и абсолютные пути пропускаются.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.dirs = {'': {}}
+        self.members = {}
+        if zipfile.is_zipfile(path):
+            self.kind = 'zip'
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    self.add(info.filename, info.is_dir(), info.file_size,
+                             time.mktime(info.date_time + (0, 0, -1)), info)
+        elif tarfile.is_tarfile(path):
+            self.kind = 'tar'
+            with tarfile.open(path, 'r:*') as archive:
+                for info in archive:
+                    if info.isdir() or info.isreg():
+                        self.add(info.name, info.isdir(), info.size, info.mtime, info)
+        elif path.lower().endswith('.gz'):
+            self.kind = 'gzip'
+            with open(path, 'rb') as f:
+                header = f.read(10)
+                f.seek(-4, os.SEEK_END)
+                # Размер исходных данных из трейлера (по модулю 2**32)
+                size = struct.unpack('<I', f.read(4))[0]
+            if header[:2] != b'\x1f\x8b':
+                raise ValueError("Not a gzip file")
+            name = os.path.basename(path)[:-3] or 'data'
+            self.add(name, False, size, struct.unpack('<I', header[4:8])[0] or os.path.getmtime(path), None)
+        else:
+            raise ValueError("Unsupported archive format")
+    
+    def add(self, name, is_dir, size, modified, member):
+        """Добавляет запись и недостающие родительские директории"""
+        name = archive_name(name)
+        if name is None:
+            return
+        parts = name.split('/')
+        for depth in range(len(parts)):
+            parent = '/'.join(parts[:depth])
+            inner = '/'.join(parts[:depth + 1])
+            last = depth == len(parts) - 1
+            children = self.dirs.setdefault(parent, {})
+            if inner not in children or last:
+                entry_is_dir = is_dir or not last
+                children[inner] = {
+                    'name': parts[depth],
+                    'path': inner,
+                    'is_dir': entry_is_dir,
+                    'size': 0 if entry_is_dir else size,
+                    'modified': modified,
+                }
+            if not last or is_dir:
+                self.dirs.setdefault(inner, {})
+        if not is_dir:
+            self.members['/'.join(parts)] = (member, size)
+    
+    def listing(self, inner):
+        """Содержимое виртуальной директории, папки сначала"""
+        children = self.dirs.get(inner.strip('/'))
+        if children is None:
+            raise FileNotFoundError(f"No such directory in archive: {inner}")
+        return sorted(children.values(), key=lambda x: (not x['is_dir'], x['name'].lower()))
+    
+    def select(self, base, names, dirs=False):
+        """Файлы (или директории) под выбранными путями: [(путь в архиве, путь относительно base)]"""
+        base = base.strip('/')
+        prefixes = [name.strip('/') for name in names] or [base]
+        selected = []
+        for inner in (self.dirs if dirs else self.members):
+            if not inner or inner == base:
+                continue
+            for prefix in prefixes:
+                if not prefix or inner == prefix or inner.startswith(prefix + '/'):
+                    relative = inner[len(base) + 1:] if base else inner
+                    if not base or inner.startswith(base + '/'):
+                        selected.append((inner, relative))
+                    break
+        return selected
+
+class ArchiveCache:
+    """LRU оглавлений архивов; запись действительна, пока не изменился файл"""
+    
+    def __init__(self, max_files=ARCHIVE_CACHE_FILES):
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, path):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        index = ArchiveIndex(path)
+        with self.lock:
+            self.entries[path] = (key, index)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+        return index
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'archives': len(self.entries),
+                'members': sum(len(index.members) for _, index in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+ARCHIVES = ArchiveCache()
+
+def open_member(index, inner):
+    """Открывает файл из архива на чтение без распаковки остальных"""
+    if inner not in index.members:
+        raise FileNotFoundError(f"No such file in archive: {inner}")
+    if index.kind == 'zip':
+        archive = zipfile.ZipFile(index.path)
+        try:
+            return archive, archive.open(index.members[inner][0])
+        except BaseException:
+            archive.close()
+            raise
+    if index.kind == 'tar':
+        archive = tarfile.open(index.path, 'r:*')
+        return archive, archive.extractfile(index.members[inner][0])
+    f = gzip.open(index.path, 'rb')
+    return f, f
+
+def open_extract_dir(dest_fd, dest, parts, lock, created):
+    """Открывает директорию dest/parts, создавая недостающие.
+    
+    Каждый компонент открывается от дескриптора родителя с O_NOFOLLOW:
+    симлинк в уже существующих директориях не уведёт запись из dest.
+    Появившиеся директории добавляются в created.
+    """
+    fd = os.dup(dest_fd)
+    path = dest
+    try:
+        for part in parts:
+            path = os.path.join(path, part)
+            try:
+                os.mkdir(part, dir_fd=fd)
+            except FileExistsError:
+                pass
+            else:
+                with lock:
+                    created.append(path)
+            try:
+                inner_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            except OSError as e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    raise OSError(e.errno, "Not a directory (or a symlink)", path) from None
+                raise
+            os.close(fd)
+            fd = inner_fd
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+def extract_file(src, dir_fd, target, mtime, job, lock, cancel, written):
+    """Пишет распаковываемый файл кусками с прогрессом и проверкой отмены.
+    
+    Данные идут во временный файл в открытой директории dir_fd (O_EXCL,
+    без перехода по симлинку), на место target он ставится os.replace
+    только целиком: оборванная запись не трогает существующий файл, а
+    заменить можно только обычный файл. Квота списывается по мере записи:
+    размерам из оглавления (заголовки tar и zip, трейлер gzip) доверять
+    нельзя. В written попадают только созданные заданием файлы, чтобы
+    при ошибке их можно было удалить.
+    """
+    name = os.path.basename(target)
+    try:
+        replaced = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        replaced = None
+    if replaced is not None and not stat.S_ISREG(replaced.st_mode):
+        raise OSError(errno.EEXIST, "Not a regular file, refusing to overwrite", target)
+    tmp_name = f'.extract-{secrets.token_hex(8)}.part'
+    fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o666, dir_fd=dir_fd)
+    size = 0
+    try:
+        with open(fd, 'wb') as dst:
+            while True:
+                check_cancel(cancel)
+                data = src.read(CHUNK_SIZE)
+                if not data:
+                    break
+                QUOTAS.charge(target, len(data))
+                size += len(data)
+                dst.write(data)
+                with lock:
+                    job['bytes_done'] += len(data)
+            if mtime is not None:
+                dst.flush()
+                os.utime(dst.fileno(), (mtime, mtime))
+        os.replace(tmp_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except BaseException:
+        try:
+            os.unlink(tmp_name, dir_fd=dir_fd)
+        except OSError:
+            pass
+        QUOTAS.release(target, size)
+        raise
+    if replaced is None:
+        with lock:
+            written.append(target)
+    else:
+        QUOTAS.release(target, replaced.st_size)
+
+def run_extract(index, base, names, dest, workers=COPY_WORKERS):
+    """Задание распаковки выбранного из архива в dest.
+    
+    Записи ZIP распаковываются параллельно: у каждого потока свой
+    ZipFile, а zlib отпускает GIL. tar читается последовательно одним
+    проходом, как он устроен. Если задание упало или отменено, созданные
+    им файлы и директории удаляются, а их байты возвращаются в квоту;
+    уже заменённые существующие файлы остаются с новым содержимым.
+    """
+    def run(job, cancel):
+        selected = index.select(base, names)
+        job['files_total'] = len(selected)
+        # Заявленный архивом размер - только для прогресса
+        job['bytes_total'] = sum(index.members[inner][1] for inner, _ in selected)
+        lock = threading.Lock()
+        local = threading.local()
+        opened = []
+        relatives = dict(selected)
+        written = []
+        created = []
+        dest_fd = None
+        
+        def extract_to(src, inner, mtime=None):
+            parts = relatives[inner].split('/')
+            dir_fd = open_extract_dir(dest_fd, dest, parts[:-1], lock, created)
+            try:
+                extract_file(src, dir_fd, os.path.join(dest, *parts), mtime, job, lock, cancel, written)
+            finally:
+                os.close(dir_fd)
+        
+        def extract_zip(inner):
+            if not hasattr(local, 'archive'):
+                local.archive = zipfile.ZipFile(index.path)
+                opened.append(local.archive)
+            job['current'] = inner
+            info = index.members[inner][0]
+            with local.archive.open(info) as src:
+                extract_to(src, inner, time.mktime(info.date_time + (0, 0, -1)))
+            with lock:
+                job['files_done'] += 1
+        
+        try:
+            # Сама dest проверена по realpath, дальше - только без симлинков
+            missing = []
+            path = dest
+            while not os.path.isdir(path):
+                missing.append(path)
+                path = os.path.dirname(path)
+            for path in reversed(missing):
+                os.mkdir(path)
+                created.append(path)
+            dest_fd = os.open(dest, os.O_RDONLY | os.O_DIRECTORY)
+            # Пустые директории тоже должны появиться
+            for _, relative in index.select(base, names, dirs=True):
+                os.close(open_extract_dir(dest_fd, dest, relative.split('/'), lock, created))
+            if index.kind == 'zip':
+                try:
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fm-extract') as pool:
+                        futures = [pool.submit(extract_zip, inner) for inner, _ in selected]
+                        try:
+                            for future in futures:
+                                future.result()
+                        except BaseException:
+                            # Остальные потоки останавливаются на ближайшем куске
+                            cancel.set()
+                            for future in futures:
+                                future.cancel()
+                            raise
+                finally:
+                    for archive in opened:
+                        archive.close()
+            elif index.kind == 'tar':
+                with tarfile.open(index.path, 'r:*') as archive:
+                    for info in archive:
+                        check_cancel(cancel)
+                        # Имя приводится так же, как в оглавлении
+                        inner = archive_name(info.name)
+                        if inner not in relatives or not info.isreg():
+                            continue
+                        job['current'] = inner
+                        extract_to(archive.extractfile(info), inner, info.mtime)
+                        job['files_done'] += 1
+            else:
+                for inner, _ in selected:
+                    with gzip.open(index.path, 'rb') as src:
+                        extract_to(src, inner)
+                    job['files_done'] += 1
+        except BaseException:
+            # Недораспакованное не остаётся на диске и в квоте
+            for path in written:
+                try:
+                    size = os.lstat(path).st_size
+                    os.unlink(path)
+                except OSError:
+                    continue
+                QUOTAS.release(path, size)
+            for path in reversed(created):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            raise
+        finally:
+            if dest_fd is not None:
+                os.close(dest_fd)
+            paths_changed(dest)
+    return run
+
+class ChunkedWriter:
+    """Обёртка над wfile: пишет тело ответа в Transfer-Encoding: chunked"""
+    
+    def __init__(self, wfile):
+        self.wfile = wfile
+    
+    def write(self, data):
+        if data:
+            # Одним send(): с TCP_NODELAY каждый write уходит отдельным пакетом
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        return len(data)
+    
+    def flush(self):
+        self.wfile.flush()
+    
+    def close(self):
+        """Пишет завершающий пустой кусок"""
+        self.wfile.write(b'0\r\n\r\n')
+
+class GzipEncoder:
+    """Потоковое gzip сжатие"""
+    
+    def __init__(self):
+        self.obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+    
+    def compress(self, data):
+        return self.obj.compress(data)
+    
+    def flush(self):
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self):
+        return self.obj.flush()
+
+class BrotliEncoder:
+    """Потоковое brotli сжатие (модуль brotli)"""
+    
+    def __init__(self):
+        self.obj = brotli.Compressor(quality=5)
+    
+    def compress(self, data):
+        return self.obj.process(data)
+    
+    def flush(self):
+        return self.obj.flush()
+    
+    def finish(self):
+        return self.obj.finish()
+
+class ZstdEncoder:
+    """Потоковое zstd сжатие (модуль zstandard)"""
+    
+    def __init__(self):
+        self.obj = zstandard.ZstdCompressor(level=3).compressobj()
+    
+    def compress(self, data):
+        return self.obj.compress(data)
+    
+    def flush(self):
+        return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    
+    def finish(self):
+        return self.obj.flush()
+
+# Доступные алгоритмы в порядке предпочтения сервера
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS['zstd'] = ZstdEncoder
+ENCODERS['gzip'] = GzipEncoder
+
+def compress_bytes(data, encoding):
+    """Сжимает данные целиком"""
+    encoder = ENCODERS[encoding]()
+    return encoder.compress(data) + encoder.finish()
+
+def choose_encoding(accept_encoding):
+    """Выбирает сжатие по заголовку Accept-Encoding или None"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        key, _, value = params.strip().partition('=')
+        if key.strip() == 'q':
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODERS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+class CompressingWriter:
+    """Обёртка над wfile: сжимает тело ответа на лету"""
+    
+    def __init__(self, wfile, encoding):
+        self.wfile = wfile
+        self.encoder = ENCODERS[encoding]()
+    
+    def write(self, data):
+        out = self.encoder.compress(bytes(data))
+        if out:
+            self.wfile.write(out)
+        return len(data)
+    
+    def flush(self):
+        """Выталкивает уже сжатое, чтобы браузер мог начать отрисовку"""
+        out = self.encoder.flush()
+        if out:
+            self.wfile.write(out)
+        self.wfile.flush()
+    
+    def close(self):
+        self.wfile.write(self.encoder.finish())
+
+class CompressionCache:
+    """LRU кеш сжатых копий файлов.
+    
+    Ключ - устройство, inode, размер, mtime и алгоритм, так что изменённый
+    файл просто не найдётся в кеше, а старая копия уйдёт по LRU.
+    """
+    
+    def __init__(self, max_bytes=COMPRESS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, st, encoding, loader):
+        """Сжатое содержимое файла; loader() читает исходные байты при промахе"""
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, encoding)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        
+        data = compress_bytes(loader(), encoding)
+        with self.lock:
+            if key not in self.entries and len(data) <= self.max_bytes:
+                self.entries[key] = data
+                self.bytes += len(data)
+                while self.bytes > self.max_bytes:
+                    _, old = self.entries.popitem(last=False)
+                    self.bytes -= len(old)
+        return data
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'encodings': list(ENCODERS),
+            }
+
+COMPRESSION_CACHE = CompressionCache()
+
+class PageTemplate:
+    """HTML шаблон, разобранный один раз при запуске.
+    
+    Поля {{name}} подставляются при отрисовке; значения, известные заранее,
+    передаются в конструктор и вшиваются в шаблон сразу. Неизменные куски
+    хранятся уже закодированными в байты.
+    """
+    
+    FIELD_RE = re.compile(r'\{\{(\w+)\}\}')
+    
+    def __init__(self, text, **static):
+        self.parts = []
+        literal = ''
+        pos = 0
+        for match in self.FIELD_RE.finditer(text):
+            literal += text[pos:match.start()]
+            pos = match.end()
+            name = match.group(1)
+            if name in static:
+                literal += str(static[name])
+            else:
+                self.parts += [literal.encode(), name]
+                literal = ''
+        self.parts.append((literal + text[pos:]).encode())
+    
+    def render(self, **values):
+        """Собирает страницу; значения должны быть уже экранированы"""
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = str(values[parts[i]]).encode()
+        return b''.join(parts)
+
+# Статические CSS/JS отдаются отдельно и кешируются браузером
+ASSETS = {}
+ASSETS_MTIME = time.time()
+
+def register_asset(name, content_type, text):
+    """Регистрирует статический ресурс, возвращает его URL с версией"""
+    data = text.encode()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    ASSETS[name] = {
+        'type': content_type,
+        'data': data,
+        'etag': f'"{digest}"',
+        # Сжатые варианты готовятся один раз при запуске
+        'variants': {encoding: compress_bytes(data, encoding) for encoding in ENCODERS},
+    }
+    return f'/__assets/{name}?v={digest}'
+
+AUTH_CSS = register_asset('auth.css', 'text/css; charset=utf-8', """
+body { 
+    font-family: Arial, sans-serif; 
+    background: #2d3748;
+    height: 100vh;
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    margin: 0;
+}
+.auth-container {
+    background: #4a5568;
+    padding: 40px;
+    border-radius: 10px;
+    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
+    text-align: center;
+    max-width: 400px;
+    width: 90%;
+}
+h2 {
+    color: white;
+    margin-bottom: 30px;
+}
+.form-group {
+    margin-bottom: 20px;
+}
+input[type="password"], input[type="text"] {
+    width: 100%;
+    padding: 15px;
+    background: #718096;
+    border: 2px solid #a0aec0;
+    border-radius: 5px;
+    font-size: 16px;
+    box-sizing: border-box;
+    color: white;
+}
+input[type="password"]::placeholder, input[type="text"]::placeholder {
+    color: #cbd5e0;
+}
+button {
+    width: 100%;
+    padding: 15px;
+    background: #667eea;
+    color: white;
+    border: none;
+    border-radius: 5px;
+    font-size: 16px;
+    cursor: pointer;
+    transition: background 0.3s;
+}
+button:hover {
+    background: #764ba2;
+}
+.btn-register {
+    margin-top: 10px;
+    background: #48bb78;
+}
+.btn-register:hover {
+    background: #38a169;
+}
+.auth-error {
+    color: #feb2b2;
+    margin-bottom: 20px;
+}
+""")
+
+MANAGER_CSS = register_asset('manager.css', 'text/css; charset=utf-8', """
+* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+body {
+    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+    background: #1a202c;
+    color: #e2e8f0;
+    line-height: 1.6;
+}
+.header {
+    background: #2d3748;
+    color: white;
+    padding: 20px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
+}
+.header h1 {
+    margin-bottom: 15px;
+    font-size: 24px;
+}
+.header-controls {
+    display: flex;
+    gap: 10px;
+    flex-wrap: wrap;
+}
+.header button {
+    padding: 10px 20px;
+    border: none;
+    border-radius: 5px;
+    cursor: pointer;
+    font-size: 14px;
+    font-weight: 500;
+    transition: all 0.3s;
+}
+.btn-home { background: #48bb78; color: white; }
+.btn-back { background: #ed8936; color: white; }
+.btn-logout { background: #f56565; color: white; }
+.btn-home:hover { background: #38a169; }
+.btn-back:hover { background: #dd6b20; }
+.btn-logout:hover { background: #e53e3e; }
+.account {
+    align-self: center;
+    color: #cbd5e0;
+    white-space: nowrap;
+}
+.search-input {
+    flex: 1;
+    min-width: 200px;
+    padding: 10px 15px;
+    border: 1px solid #4a5568;
+    border-radius: 5px;
+    background: #1a202c;
+    color: #e2e8f0;
+    font-size: 14px;
+}
+.btn-grep { background: #4299e1; color: white; }
+.btn-grep:hover { background: #3182ce; }
+.search-results { display: none; }
+.grep-match {
+    padding: 10px 15px;
+    border-bottom: 1px solid #4a5568;
+}
+.jobs { margin: 0 20px; }
+.job {
+    background: #2d3748;
+    margin-top: 10px;
+    padding: 10px 15px;
+    border-radius: 10px;
+    font-size: 14px;
+}
+.job-progress {
+    height: 6px;
+    margin-top: 6px;
+    background: #4a5568;
+    border-radius: 3px;
+    overflow: hidden;
+}
+.job-progress div { height: 100%; background: #48bb78; }
+.job button {
+    float: right;
+    padding: 2px 10px;
+    border: none;
+    border-radius: 4px;
+    background: #f56565;
+    color: white;
+    cursor: pointer;
+}
+.size-item {
+    display: flex;
+    gap: 10px;
+    padding: 8px 15px;
+    border-bottom: 1px solid #4a5568;
+}
+.size-item a { flex: 1; word-break: break-all; }
+.size-bar {
+    width: 120px;
+    height: 8px;
+    margin-top: 9px;
+    background: #4a5568;
+    border-radius: 4px;
+    overflow: hidden;
+}
+.size-bar div { height: 100%; background: #38b2ac; }
+.grep-match pre {
+    margin-top: 5px;
+    color: #cbd5e0;
+    white-space: pre-wrap;
+    word-break: break-all;
+}
+.file-item.changed { animation: changed 2s ease-out; }
+@keyframes changed {
+    from { background: #2c5282; }
+}
+.search-results.active { display: block; }
+
+.current-path {
+    background: #2d3748;
+    margin: 20px;
+    padding: 15px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
+    font-family: monospace;
+    color: #cbd5e0;
+    word-break: break-all;
+}
+
+.file-list {
+    background: #2d3748;
+    margin: 20px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
+    overflow: hidden;
+}
+.file-header {
+    display: flex;
+    background: #4a5568;
+    padding: 12px 15px;
+    font-weight: bold;
+    border-bottom: 2px solid #718096;
+    align-items: center;
+}
+.file-header > * {
+    padding: 0 5px;
+}
+.file-header a {
+    color: inherit;
+    text-decoration: none;
+}
+.list-status {
+    padding: 12px 15px;
+    color: #a0aec0;
+    font-size: 14px;
+    text-align: center;
+}
+.file-item {
+    display: flex;
+    align-items: center;
+    padding: 10px 15px;
+    border-bottom: 1px solid #4a5568;
+    transition: background 0.2s;
+}
+.file-item:hover {
+    background: #4a5568;
+}
+.hidden-file {
+    background: #744210;
+}
+.file-checkbox {
+    width: 20px;
+    margin-right: 10px;
+}
+.file-icon {
+    width: 30px;
+    font-size: 18px;
+    text-align: center;
+    margin-right: 10px;
+}
+.file-icon:has(.thumb) {
+    width: 48px;
+}
+.thumb {
+    width: 48px;
+    height: 48px;
+    object-fit: cover;
+    border-radius: 4px;
+    vertical-align: middle;
+}
+.file-name {
+    flex: 3;
+    min-width: 200px;
+    color: #e2e8f0;
+    font-weight: 500;
+}
+.file-name a {
+    color: #e2e8f0;
+    text-decoration: none;
+}
+.file-name a:hover {
+    color: #90cdf4;
+    text-decoration: underline;
+}
+.file-size {
+    flex: 1;
+    min-width: 100px;
+    color: #cbd5e0;
+    font-size: 14px;
+    text-align: right;
+    font-weight: bold;
+}
+.file-modified {
+    flex: 1;
+    min-width: 150px;
+    color: #cbd5e0;
+    font-size: 14px;
+    text-align: right;
+    font-weight: bold;
+}
+.file-actions {
+    flex: 1;
+    min-width: 120px;
+    text-align: right;
+}
+.open-web {
+    color: #90cdf4;
+    text-decoration: none;
+    font-size: 13px;
+    padding: 4px 8px;
+    background: #4a5568;
+    border-radius: 3px;
+    margin-left: 5px;
+    font-weight: bold;
+}
+.open-web:hover {
+    background: #5a6578;
+    text-decoration: none;
+}
+
+.actions {
+    background: #2d3748;
+    margin: 20px;
+    padding: 20px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
+    display: flex;
+    gap: 10px;
+    flex-wrap: wrap;
+}
+.actions button {
+    padding: 12px 20px;
+    border: none;
+    border-radius: 6px;
+    cursor: pointer;
+    font-size: 14px;
+    font-weight: 500;
+    transition: all 0.3s;
+    min-width: 120px;
+}
+.btn-create { background: #48bb78; color: white; }
+.btn-folder { background: #4299e1; color: white; }
+.btn-rename { background: #ed8936; color: white; }
+.btn-delete { background: #f56565; color: white; }
+.btn-clone { background: #9f7aea; color: white; }
+.btn-download { background: #667eea; color: white; }
+.btn-upload { background: #ed64a6; color: white; }
+.btn-sizes { background: #38b2ac; color: white; }
+
+.btn-create:hover { background: #38a169; }
+.btn-folder:hover { background: #3182ce; }
+.btn-rename:hover { background: #dd6b20; }
+.btn-delete:hover { background: #e53e3e; }
+.btn-clone:hover { background: #805ad5; }
+.btn-download:hover { background: #5a67d8; }
+.btn-upload:hover { background: #d53f8c; }
+.btn-sizes:hover { background: #319795; }
+
+/* Стили для модальных окон */
+.modal {
+    display: none;
+    position: fixed;
+    z-index: 1000;
+    left: 0;
+    top: 0;
+    width: 100%;
+    height: 100%;
+    background-color: rgba(0,0,0,0.7);
+}
+.modal-content {
+    background-color: #2d3748;
+    margin: 15% auto;
+    padding: 30px;
+    border-radius: 10px;
+    width: 400px;
+    box-shadow: 0 4px 20px rgba(0,0,0,0.5);
+}
+.modal-header {
+    margin-bottom: 20px;
+    color: white;
+    font-size: 18px;
+    font-weight: bold;
+}
+.modal-input {
+    width: 100%;
+    padding: 12px;
+    background: #4a5568;
+    border: 2px solid #718096;
+    border-radius: 5px;
+    color: white;
+    font-size: 16px;
+    margin-bottom: 20px;
+    box-sizing: border-box;
+}
+.modal-input:focus {
+    outline: none;
+    border-color: #90cdf4;
+}
+.modal-actions {
+    display: flex;
+    gap: 10px;
+    justify-content: flex-end;
+}
+.modal-btn {
+    padding: 10px 20px;
+    border: none;
+    border-radius: 5px;
+    cursor: pointer;
+    font-size: 14px;
+    font-weight: 500;
+}
+.modal-confirm { background: #48bb78; color: white; }
+.modal-cancel { background: #718096; color: white; }
+.modal-confirm:hover { background: #38a169; }
+.modal-cancel:hover { background: #5a6578; }
+""")
+
+# Данные конкретной страницы скрипт берёт из объекта PAGE
+MANAGER_JS = register_asset('manager.js', 'text/javascript; charset=utf-8', """
+let selectedFiles = [];
+let currentRenamePath = '';
+
+// Остальные строки листинга подгружаются порциями при прокрутке
+const listParams = new URLSearchParams(PAGE.listParams);
+let nextCursor = PAGE.nextCursor;
+let loadedRows = PAGE.loadedRows;
+let loadingRows = false;
+const listSentinel = document.getElementById('listSentinel');
+
+async function loadMoreRows() {
+    if (loadingRows || !nextCursor) return;
+    loadingRows = true;
+    try {
+        listParams.set('cursor', nextCursor);
+        const response = await fetch('?' + listParams);
+        const page = await response.json();
+        listSentinel.insertAdjacentHTML('beforebegin', page.html);
+        loadedRows += page.count;
+        listSentinel.textContent = loadedRows + ' / ' + page.total;
+        nextCursor = page.next;
+    } finally {
+        loadingRows = false;
+    }
+    // Если экран всё ещё не заполнен, грузим дальше
+    if (nextCursor && listSentinel.getBoundingClientRect().top < window.innerHeight + 800) loadMoreRows();
+}
+
+new IntersectionObserver(entries => {
+    if (entries[0].isIntersecting) loadMoreRows();
+}, { rootMargin: '800px' }).observe(listSentinel);
+
+// Поиск по индексу файлов всего дерева
+let searchTimer = null;
+let searchSeq = 0;
+const searchResults = document.getElementById('searchResults');
+
+function searchFiles(text) {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(async () => {
+        const seq = ++searchSeq;
+        if (!text.trim()) {
+            searchResults.classList.remove('active');
+            searchResults.innerHTML = '';
+            return;
+        }
+        const params = new URLSearchParams({ search: text, format: 'html', limit: 100 });
+        const response = await fetch('?' + params);
+        const page = await response.json();
+        // Ответ на устаревший запрос не показываем
+        if (seq !== searchSeq) return;
+        const status = page.error ? page.error
+            : page.count + ' found in ' + page.took_ms + ' ms' + (page.ready ? '' : ' (indexing...)');
+        searchResults.innerHTML = (page.html || '') + '<div class="list-status"></div>';
+        searchResults.lastChild.textContent = '🔍 ' + status;
+        searchResults.classList.add('active');
+    }, 200);
+}
+
+// Изменения в директории приходят с сервера, страница обновляет только свои строки
+function listingRow(path) {
+    const checkbox = document.querySelector(
+        '.file-list:not(.search-results) .file-checkbox[data-path="' + CSS.escape(path) + '"]');
+    return checkbox ? checkbox.closest('.file-item') : null;
+}
+
+function applyChange(change) {
+    if (change.event === 'reset') return location.reload();
+    if (change.event === 'gone') return goBack();
+    if (change.from_path) {
+        const old = listingRow(change.from_path);
+        if (old) old.remove();
+    }
+    const row = listingRow(change.path);
+    if (change.event === 'delete') {
+        if (row) row.remove();
+        return;
+    }
+    const template = document.createElement('template');
+    template.innerHTML = change.html.trim();
+    const item = template.content.firstElementChild;
+    item.classList.add('changed');
+    if (row) row.replaceWith(item);
+    else document.querySelector('.file-header').after(item);
+}
+
+if (window.EventSource) {
+    const changes = new EventSource('?' + new URLSearchParams({ events: PAGE.currentDir }));
+    changes.addEventListener('change', e => applyChange(JSON.parse(e.data)));
+}
+
+// Поиск по содержимому файлов: результаты приходят потоком NDJSON
+let grepController = null;
+
+async function grepFiles() {
+    const text = document.getElementById('searchInput').value;
+    if (!text) return;
+    if (grepController) grepController.abort();
+    const controller = grepController = new AbortController();
+    searchSeq++;
+    clearTimeout(searchTimer);
+    searchResults.innerHTML = '<div class="list-status"></div>';
+    searchResults.classList.add('active');
+    const status = searchResults.firstChild;
+    status.textContent = '📄 Searching...';
+    const params = new URLSearchParams({ grep: text, scope: PAGE.currentDir });
+    try {
+        const response = await fetch('?' + params, { signal: controller.signal });
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (line) showGrepEvent(JSON.parse(line), status, controller);
+            }
+        }
+    } catch (e) {
+        if (e.name !== 'AbortError') throw e;
+        status.textContent = '⏹️ Stopped';
+    }
+}
+
+function showGrepEvent(event, status, controller) {
+    if (event.type === 'match') {
+        const item = document.createElement('div');
+        item.className = 'grep-match';
+        const link = document.createElement('a');
+        link.href = '?view=' + encodeURIComponent(event.path);
+        link.textContent = event.path + ':' + event.line;
+        const lines = document.createElement('pre');
+        lines.textContent = [...event.before, event.text, ...event.after].join('\\n');
+        item.append(link, lines);
+        status.before(item);
+        return;
+    }
+    if (event.type === 'start') return;
+    const mb = (event.bytes / 1048576).toFixed(1);
+    status.textContent = (event.type === 'done' ? '📄 ' : '📄 Searching... ')
+        + event.matches + ' matches, ' + event.files + ' files, ' + mb + ' MB'
+        + (event.truncated ? ' (limit reached)' : '');
+    if (event.type === 'progress') {
+        const stop = document.createElement('button');
+        stop.textContent = '⏹️ Stop';
+        stop.onclick = () => controller.abort();
+        status.append(' ', stop);
+    }
+}
+
+// Размеры папок с учётом вложенных и крупнейшие элементы
+function formatSize(size) {
+    if (size === 0) return '0 B';
+    for (const unit of ['B', 'KB', 'MB', 'GB']) {
+        if (size < 1024) return size.toFixed(1) + ' ' + unit;
+        size /= 1024;
+    }
+    return size.toFixed(1) + ' TB';
+}
+
+function sizeItem(path, size, total, isDir) {
+    const item = document.createElement('div');
+    item.className = 'size-item';
+    const bar = document.createElement('div');
+    bar.className = 'size-bar';
+    bar.appendChild(document.createElement('div')).style.width = (total ? size / total * 100 : 0) + '%';
+    const link = document.createElement('a');
+    link.href = (isDir ? '?dir=' : '?view=') + encodeURIComponent(path);
+    link.textContent = (isDir ? '📁 ' : '📄 ') + path;
+    const label = document.createElement('span');
+    label.textContent = formatSize(size);
+    item.append(bar, link, label);
+    return item;
+}
+
+async function showSizes() {
+    searchResults.innerHTML = '<div class="list-status">📊 Calculating...</div>';
+    searchResults.classList.add('active');
+    const response = await fetch('?' + new URLSearchParams({ du: PAGE.currentDir, limit: 2000 }));
+    const usage = await response.json();
+    const status = searchResults.firstChild;
+    if (usage.error) {
+        status.textContent = '⚠️ ' + usage.error;
+        return;
+    }
+    // Размеры папок прямо в листинге
+    for (const item of usage.items) {
+        const row = item.is_dir && listingRow(item.path);
+        if (row) row.querySelector('.file-size').textContent = formatSize(item.size);
+    }
+    status.textContent = '📊 ' + formatSize(usage.size) + ' in ' + usage.files + ' files, '
+        + usage.dirs + ' folders (' + usage.seconds + ' s). Largest items:';
+    for (const item of usage.items.slice(0, 20)) {
+        searchResults.appendChild(sizeItem(item.path, item.size, usage.size, item.is_dir));
+    }
+    const files = document.createElement('div');
+    files.className = 'list-status';
+    files.textContent = '📄 Largest files:';
+    searchResults.appendChild(files);
+    for (const file of usage.largest_files.slice(0, 20)) {
+        searchResults.appendChild(sizeItem(file.path, file.size, usage.size, false));
+    }
+}
+
+function getSelectedFiles() {
+    const checkboxes = document.querySelectorAll('.file-checkbox:checked');
+    return Array.from(checkboxes).map(cb => cb.dataset.path);
+}
+
+function toggleAll(source) {
+    const checkboxes = document.querySelectorAll('.file-checkbox');
+    checkboxes.forEach(cb => cb.checked = source.checked);
+}
+
+function goHome() {
+    location.href = '/';
+}
+
+function goBack() {
+    const currentDir = PAGE.currentDir;
+    const parentDir = currentDir.split('/').slice(0, -1).join('/');
+    if (parentDir && parentDir !== '') {
+        location.href = '?dir=' + encodeURIComponent(parentDir);
+    } else {
+        location.href = '/';
+    }
+}
+
+function logout() {
+    // Cookie сессии недоступна из JS (HttpOnly), её удаляет сервер
+    const form = document.createElement('form');
+    form.method = 'post';
+    form.innerHTML = '<input type="hidden" name="action" value="logout">';
+    document.body.appendChild(form);
+    form.submit();
+}
+
+function showModal(modalType) {
+    const modals = {
+        'createFile': 'createFileModal',
+        'createFolder': 'createFolderModal',
+        'rename': 'renameModal',
+        'download': 'downloadModal'
+    };
+    document.getElementById(modals[modalType]).style.display = 'block';
+}
+
+function hideModal(modalId) {
+    document.getElementById(modalId).style.display = 'none';
+}
+
+function createFile() {
+    const name = document.getElementById('fileName').value.trim();
+    if (name) {
+        const form = document.createElement('form');
+        form.method = 'post';
+        form.innerHTML = `
+            <input type="hidden" name="action" value="create_file">
+            <input type="hidden" name="name" value="${name}">
+            <input type="hidden" name="current_dir" value="${PAGE.currentDir}">
+        `;
+        document.body.appendChild(form);
+        form.submit();
+    }
+    hideModal('createFileModal');
+}
+
+function createFolder() {
+    const name = document.getElementById('folderName').value.trim();
+    if (name) {
+        const form = document.createElement('form');
+        form.method = 'post';
+        form.innerHTML = `
+            <input type="hidden" name="action" value="create_folder">
+            <input type="hidden" name="name" value="${name}">
+            <input type="hidden" name="current_dir" value="${PAGE.currentDir}">
+        `;
+        document.body.appendChild(form);
+        form.submit();
+    }
+    hideModal('createFolderModal');
+}
+
+function renameFile() {
+    const files = getSelectedFiles();
+    if (files.length === 1) {
+        currentRenamePath = files[0];
+        const currentName = currentRenamePath.split('/').pop();
+        document.getElementById('newFileName').value = currentName;
+        showModal('rename');
+    } else alert('Please select exactly one file or folder to rename.');
+}
+
+function performRename() {
+    const newName = document.getElementById('newFileName').value.trim();
+    if (newName && currentRenamePath) {
+        const form = document.createElement('form');
+        form.method = 'post';
+        form.innerHTML = `
+            <input type="hidden" name="action" value="rename">
+            <input type="hidden" name="path" value="${currentRenamePath}">
+            <input type="hidden" name="new_name" value="${newName}">
+        `;
+        document.body.appendChild(form);
+        form.submit();
+    }
+    hideModal('renameModal');
+}
+
+function deleteFiles() {
+    const files = getSelectedFiles();
+    if (files.length > 0 && confirm('Are you sure you want to delete selected items?')) {
+        startJob('delete', files);
+    }
+}
+
+function cloneFiles() {
+    const files = getSelectedFiles();
+    if (files.length > 0) {
+        startJob('clone', files);
+    }
+}
+
+function downloadFiles() {
+    if (getSelectedFiles().length > 0) showModal('download');
+    else alert('Please select files or folders to download.');
+}
+
+function performDownload() {
+    // Обычная отправка формы: браузер сам сохранит поток архива в файл
+    const form = document.createElement('form');
+    form.method = 'post';
+    const fields = [['action', 'download'], ['format', document.getElementById('archiveFormat').value]];
+    getSelectedFiles().forEach(path => fields.push(['path', path]));
+    for (const [name, value] of fields) {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = name;
+        input.value = value;
+        form.appendChild(input);
+    }
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+    hideModal('downloadModal');
+}
+
+// Удаление и копирование идут фоновыми заданиями, страница показывает их прогресс
+const JOB_TITLES = { delete: '🗑️ Delete', clone: '📋 Clone', extract: '📤 Extract' };
+let jobsTimer = null;
+
+async function startJob(action, files) {
+    const params = new URLSearchParams({ action, format: 'json', current_dir: PAGE.currentDir });
+    files.forEach(path => params.append('path', path));
+    await postAction(params);
+    pollJobs();
+}
+
+async function cancelJob(id) {
+    await postAction({ action: 'job_cancel', id });
+    pollJobs();
+}
+
+async function pollJobs() {
+    clearTimeout(jobsTimer);
+    const response = await fetch('?jobs=1');
+    const page = await response.json();
+    const panel = document.getElementById('jobs');
+    panel.innerHTML = '';
+    let active = false;
+    for (const job of page.jobs) {
+        const running = job.status === 'queued' || job.status === 'running';
+        // Завершённые показываем ещё полминуты
+        if (!running && page.now - job.finished > 30) continue;
+        active = active || running;
+        panel.appendChild(renderJob(job, running));
+    }
+    if (active) jobsTimer = setTimeout(pollJobs, 1000);
+}
+
+function renderJob(job, running) {
+    const item = document.createElement('div');
+    item.className = 'job';
+    let text = JOB_TITLES[job.kind] + ' ' + job.paths.length + ' item(s): ' + job.status;
+    if (job.files_total !== null) {
+        text += ' — ' + job.files_done + ' / ' + job.files_total + ' files, '
+            + formatSize(job.bytes_done) + ' / ' + formatSize(job.bytes_total);
+    }
+    if (job.error) text += ' — ' + job.error;
+    item.textContent = text;
+    if (running) {
+        const cancel = document.createElement('button');
+        cancel.textContent = 'Cancel';
+        cancel.onclick = () => cancelJob(job.id);
+        item.prepend(cancel);
+    }
+    const progress = document.createElement('div');
+    progress.className = 'job-progress';
+    const done = job.bytes_total ? job.bytes_done / job.bytes_total
+        : job.files_total ? job.files_done / job.files_total : (running ? 0 : 1);
+    progress.appendChild(document.createElement('div')).style.width = (done * 100) + '%';
+    item.appendChild(progress);
+    return item;
+}
+
+pollJobs();
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+async function postAction(params) {
+    const response = await fetch('', { method: 'POST', body: new URLSearchParams(params) });
+    if (!response.ok) throw new Error(await response.text());
+    return response.json();
+}
+
+// Большие файлы грузятся кусками; при обрыве связи или перезагрузке
+// страницы загрузка продолжается с уже полученных сервером кусков
+async function resumableUpload(file) {
+    const key = ['upload', PAGE.currentDir, file.name, file.size, file.lastModified].join(':');
+    let info = null;
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const response = await fetch('?upload=' + savedId);
+        if (response.ok) info = await response.json();
+    }
+    if (!info) {
+        info = await postAction({
+            action: 'upload_init', name: file.name, size: file.size, current_dir: PAGE.currentDir
+        });
+        localStorage.setItem(key, info.id);
+    }
+    const received = new Set(info.received);
+    for (let n = 0; n < info.chunks; n++) {
+        if (received.has(n)) continue;
+        const chunk = file.slice(n * info.chunk_size, (n + 1) * info.chunk_size);
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const response = await fetch(`?upload=${info.id}&chunk=${n}`, { method: 'PUT', body: chunk });
+                if (response.ok) break;
+                if (response.status < 500) throw new Error(await response.text());
+            } catch (e) {
+                if (attempt >= 10) throw e;
+            }
+            await sleep(Math.min(30000, 1000 * 2 ** attempt));
+        }
+    }
+    await postAction({ action: 'upload_finish', id: info.id });
+    localStorage.removeItem(key);
+}
+
+function uploadFile() {
+    const input = document.createElement('input');
+    input.type = 'file';
+    input.multiple = true;
+    input.onchange = async function() {
+        // Каждый файл - отдельный запрос, до PAGE.uploadParallel одновременно
+        const queue = Array.from(input.files);
+        const worker = async () => {
+            while (queue.length) {
+                const file = queue.shift();
+                if (file.size > PAGE.uploadChunkSize) {
+                    try {
+                        await resumableUpload(file);
+                    } catch (e) {
+                        alert('Upload of ' + file.name + ' failed: ' + e.message);
+                    }
+                    continue;
+                }
+                const form = new FormData();
+                form.append('action', 'upload');
+                form.append('current_dir', PAGE.currentDir);
+                form.append('files', file);
+                const response = await fetch('', { method: 'POST', body: form });
+                // Например, 507 - не хватает квоты
+                if (!response.ok) alert('Upload of ' + file.name + ' failed: ' + response.statusText);
+            }
+        };
+        await Promise.all(Array.from({length: PAGE.uploadParallel}, worker));
+        location.reload();
+    };
+    input.click();
+}
+
+// Закрытие модальных окон при клике вне их
+window.onclick = function(event) {
+    if (event.target.classList.contains('modal')) {
+        event.target.style.display = 'none';
+    }
+}
+
+// Обработка Enter в модальных окнах
+document.addEventListener('keydown', function(event) {
+    if (event.key === 'Enter') {
+        if (document.getElementById('createFileModal').style.display === 'block') {
+            createFile();
+        } else if (document.getElementById('createFolderModal').style.display === 'block') {
+            createFolder();
+        } else if (document.getElementById('renameModal').style.display === 'block') {
+            performRename();
+        }
+    } else if (event.key === 'Escape') {
+        hideModal('createFileModal');
+        hideModal('createFolderModal');
+        hideModal('renameModal');
+    }
+});
+""")
+
+ARCHIVE_JS = register_asset('archive.js', 'text/javascript; charset=utf-8', """
+const ARCHIVE = document.getElementById('archive').dataset;
+
+function toggleAll(source) {
+    document.querySelectorAll('.file-checkbox').forEach(cb => cb.checked = source.checked);
+}
+
+function goBack() {
+    location.href = ARCHIVE.back;
+}
+
+// Распаковка идёт фоновым заданием, его прогресс видно в папке назначения
+async function extractFiles(all) {
+    const members = all ? [] : Array.from(document.querySelectorAll('.file-checkbox:checked'))
+        .map(cb => cb.dataset.member);
+    if (!all && members.length === 0) {
+        alert('Please select files or folders to extract.');
+        return;
+    }
+    const dest = prompt('Extract to folder:', ARCHIVE.dest);
+    if (!dest) return;
+    const params = new URLSearchParams({
+        action: 'extract', format: 'json', path: ARCHIVE.path, inner: ARCHIVE.inner, dest
+    });
+    members.forEach(member => params.append('member', member));
+    const response = await fetch('/', { method: 'POST', body: params });
+    const result = await response.json();
+    if (result.error) alert(result.error);
+    else location.href = '?' + new URLSearchParams({ dir: dest });
+}
+""")
+
+EDITOR_CSS = register_asset('editor.css', 'text/css; charset=utf-8', """
+body { 
+    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+    background: #1a202c;
+    margin: 0;
+    padding: 20px;
+    color: #e2e8f0;
+}
+.editor-container {
+    max-width: 1200px;
+    margin: 0 auto;
+    background: #2d3748;
+    border-radius: 10px;
+    box-shadow: 0 2px 20px rgba(0,0,0,0.3);
+    overflow: hidden;
+}
+.editor-header {
+    background: #4a5568;
+    color: white;
+    padding: 25px;
+}
+.editor-header h2 {
+    margin: 0;
+    font-size: 24px;
+}
+.editor-content {
+    padding: 25px;
+}
+textarea {
+    width: 100%;
+    height: 700px;
+    font-family: 'Consolas', 'Monaco', monospace;
+    font-size: 14px;
+    padding: 20px;
+    background: #1a202c;
+    color: #e2e8f0;
+    border: 2px solid #4a5568;
+    border-radius: 8px;
+    resize: vertical;
+    line-height: 1.5;
+}
+.editor-actions {
+    margin-top: 25px;
+    display: flex;
+    gap: 15px;
+    justify-content: center;
+}
+.editor-actions button {
+    padding: 15px 30px;
+    border: none;
+    border-radius: 8px;
+    cursor: pointer;
+    font-size: 16px;
+    font-weight: 600;
+    min-width: 160px;
+    transition: all 0.3s;
+}
+.btn-save { 
+    background: #48bb78; 
+    color: white; 
+}
+.btn-cancel { 
+    background: #718096; 
+    color: white; 
+}
+.btn-save:hover { 
+    background: #38a169;
+    transform: translateY(-2px);
+}
+.btn-cancel:hover { 
+    background: #5a6268;
+    transform: translateY(-2px);
+}
+.editor-actions button:disabled {
+    opacity: 0.5;
+    cursor: default;
+    transform: none;
+}
+.editor-nav {
+    display: flex;
+    flex-wrap: wrap;
+    gap: 8px;
+    align-items: center;
+    margin-top: 15px;
+}
+.editor-nav button,
+.editor-nav input[type=number] {
+    padding: 8px 14px;
+    border: none;
+    border-radius: 6px;
+    background: #2d3748;
+    color: #e2e8f0;
+    font-size: 14px;
+}
+.editor-nav button {
+    cursor: pointer;
+}
+.editor-nav button:hover {
+    background: #1a202c;
+}
+.editor-nav input[type=number] {
+    width: 110px;
+}
+.editor-status {
+    margin-top: 12px;
+    font-size: 14px;
+    color: #cbd5e0;
+}
+textarea[readonly] {
+    border-color: #2d3748;
+}
+""")
+
+EDITOR_JS = register_asset('editor.js', 'text/javascript; charset=utf-8', """
+var editor = document.getElementById('editor');
+var area = document.getElementById('window');
+var statusLine = document.getElementById('status');
+var saveButton = document.getElementById('saveButton');
+var filePath = editor.dataset.path;
+var windowLines = parseInt(editor.dataset.lines, 10);
+var followInterval = parseInt(editor.dataset.interval, 10);
+var windowStart = 0, windowCount = 0, windowOffset = 0, windowEnd = 0;
+var fileEtag = '', fileInode = 0;
+var dirty = false, following = false, followTimer = null;
+
+area.addEventListener('input', function() {
+    dirty = true;
+});
+
+function linesUrl(params) {
+    return '?lines=' + encodeURIComponent(filePath) + '&' + params;
+}
+
+function confirmDiscard() {
+    return !dirty || confirm('Discard unsaved changes in these lines?');
+}
+
+function describe(data) {
+    var first = data.count ? data.start + 1 : data.start;
+    var text = 'Lines ' + first + '–' + (data.start + data.count) + ' of ' + data.lines;
+    if (data.truncated) text += ' • line is too long, read only';
+    statusLine.textContent = text;
+}
+
+function loadWindow(start) {
+    if (!confirmDiscard()) return Promise.resolve();
+    return fetch(linesUrl('start=' + start + '&count=' + windowLines))
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            if (data.error) {
+                statusLine.textContent = '❌ ' + data.error;
+                return;
+            }
+            windowStart = data.start;
+            windowCount = data.count;
+            windowOffset = data.offset;
+            windowEnd = data.end;
+            fileEtag = data.etag;
+            fileInode = data.inode;
+            area.value = data.text;
+            area.readOnly = data.truncated || following;
+            saveButton.disabled = area.readOnly;
+            dirty = false;
+            describe(data);
+            if (following) area.scrollTop = area.scrollHeight;
+        });
+}
+
+function prevWindow() {
+    loadWindow(Math.max(windowStart - windowLines, 0));
+}
+
+function nextWindow() {
+    loadWindow(windowStart + Math.max(windowCount, 1));
+}
+
+function gotoLine() {
+    var line = parseInt(document.getElementById('gotoLine').value, 10);
+    if (line > 0) loadWindow(line - 1);
+}
+
+function saveWindow() {
+    // content идёт последним: остальные поля сервер читает до него
+    var body = new URLSearchParams();
+    body.append('action', 'patch');
+    body.append('path', filePath);
+    body.append('etag', fileEtag);
+    body.append('offset', windowOffset);
+    body.append('end', windowEnd);
+    body.append('content', area.value);
+    saveButton.disabled = true;
+    fetch('/', {method: 'POST', body: body})
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            saveButton.disabled = false;
+            if (data.error) {
+                statusLine.textContent = '❌ ' + data.error;
+                return;
+            }
+            dirty = false;
+            loadWindow(windowStart);
+        }, function() {
+            saveButton.disabled = false;
+            statusLine.textContent = '❌ Save failed';
+        });
+}
+
+function toggleFollow(on) {
+    clearTimeout(followTimer);
+    if (on && !confirmDiscard()) {
+        document.getElementById('follow').checked = false;
+        return;
+    }
+    dirty = false;
+    following = on;
+    if (on) {
+        loadWindow(-windowLines).then(pollTail);
+    } else {
+        loadWindow(windowStart);
+    }
+}
+
+function pollTail() {
+    if (!following) return;
+    fetch(linesUrl('since=' + windowEnd + '&inode=' + fileInode))
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            if (!following) return;
+            if (data.reset) {
+                // Файл заменили или обрезали - начинаем с нового хвоста
+                loadWindow(-windowLines).then(scheduleTail);
+                return;
+            }
+            if (data.text) {
+                // В окне остаются только последние windowLines строк
+                var lines = (area.value + data.text).split('\\n');
+                if (lines.length > windowLines + 1) lines = lines.slice(lines.length - windowLines - 1);
+                area.value = lines.join('\\n');
+                area.scrollTop = area.scrollHeight;
+                windowEnd = data.end;
+            }
+            statusLine.textContent = '📡 Following • ' + data.lines + ' lines';
+            scheduleTail();
+        }, scheduleTail);
+}
+
+function scheduleTail() {
+    if (following) followTimer = setTimeout(pollTail, followInterval);
+}
+
+loadWindow(0);
+""")
 
 class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
     
-    # Пароль для доступа
+    # Пароль для доступа по умолчанию (на сервере хранится только его хеш)
     PASSWORD = "pass123"
     
+    # Медленный клиент не должен занимать поток бесконечно
+    timeout = REQUEST_TIMEOUT
+    # Заголовки и тело уходят разными send(); без TCP_NODELAY в keep-alive
+    # соединении ответ ждёт delayed ACK клиента (~40 мс)
+    disable_nagle_algorithm = True
+    
+    # HTTP/1.1 нужен для chunked ответов
+    protocol_version = 'HTTP/1.1'
+    
     # Иконки для разных типов файлов
     ICONS = {
         'folder': '📁',
@@ -38,164 +4741,573 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
         'text': ['.txt', '.md', '.log']
     }
     
-    def get_file_icon(self, filename):
+    @classmethod
+    def attach(cls, request, client_address, server):
+        """Создаёт обработчик для соединения, не запуская цикл handle()"""
+        self = cls.__new__(cls)
+        self.directory = os.getcwd()
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+        return self
+    
+    def setup(self):
+        super().setup()
+        self.raw_wfile = self.wfile
+        self.requests_served = 0
+        # Долгий ответ (SSE), который сервер доведёт в своём потоке вне пула
+        self.detached = None
+    
+    def handle(self):
+        """Обслуживает соединение, пока клиент держит его открытым"""
+        self.handle_one_request()
+        while not self.close_connection:
+            # Между запросами ждём не дольше KEEPALIVE_TIMEOUT
+            self.connection.settimeout(KEEPALIVE_TIMEOUT)
+            try:
+                if not self.rfile.peek(1):
+                    break
+            except (TimeoutError, OSError):
+                break
+            self.connection.settimeout(self.timeout)
+            self.handle_one_request()
+    
+    def handle_one_request(self):
+        self.requests_served += 1
+        self.body_read = False
+        self.connection_header = None
+        self.session = None
+        self.user = None
+        self.root = None
+        super().handle_one_request()
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Тела в chunked кодировании не разбираем, после ответа соединение закрываем
+        if 'Transfer-Encoding' in self.headers:
+            self.close_connection = True
+        return True
+    
+    # Расширение -> тип файла. При повторах побеждает тип, идущий в FILE_TYPES раньше
+    EXTENSION_TYPES = {ext: file_type
+                       for file_type, extensions in reversed(FILE_TYPES.items())
+                       for ext in extensions}
+    # Уже сжатые форматы: в ZIP кладутся без повторного сжатия
+    PRECOMPRESSED = {ext for ext, file_type in EXTENSION_TYPES.items()
+                     if file_type in ('image', 'audio', 'video', 'archive', 'pdf')} - {'.bmp', '.svg', '.tar', '.wav'}
+    
+    @classmethod
+    def get_file_icon(cls, filename, is_dir=None):
         """Возвращает иконку для файла"""
-        if os.path.isdir(filename):
-            return self.ICONS['folder']
+        if is_dir is None:
+            is_dir = os.path.isdir(filename)
+        if is_dir:
+            return cls.ICONS['folder']
         
-        if filename.startswith('.'):
-            return self.ICONS['hidden']
+        name = os.path.basename(filename)
+        if name.startswith('.'):
+            return cls.ICONS['hidden']
         
-        ext = os.path.splitext(filename)[1].lower()
-        for file_type, extensions in self.FILE_TYPES.items():
-            if ext in extensions:
-                return self.ICONS[file_type]
-        return self.ICONS['default']
+        ext = os.path.splitext(name)[1].lower()
+        return cls.ICONS[cls.EXTENSION_TYPES.get(ext, 'default')]
+    
+    def session_token(self):
+        """Токен сессии из cookie"""
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+        return ''
+    
+    # Параметры GET с путями к файлам: вне корня пользователя - 403
+    PATH_PARAMS = ('archive', 'browse', 'member', 'thumb', 'lines', 'view', 'preview', 'scope')
     
     def check_auth(self):
-        """Проверяет авторизацию"""
-        if 'Cookie' in self.headers:
-            cookies = self.headers['Cookie'].split(';')
-            for cookie in cookies:
-                if 'filemanager_auth' in cookie:
-                    auth_value = cookie.split('=')[1].strip()
-                    return auth_value == self.PASSWORD
-        return False
+        """Проверяет авторизацию и определяет корень пользователя; результат запоминается до конца запроса"""
+        if self.session is None:
+            token = self.session_token()
+            session = (token and SESSIONS.check(token)) or False
+            # Сессия удалённого пользователя недействительна
+            if session and session[2] is not None and ACCOUNTS.get(session[2]) is None:
+                session = False
+            if session:
+                self.user = session[2]
+                self.root = ACCOUNTS.root(self.user)
+            self.session = session
+        return self.session is not False
+    
+    def in_root(self, path, follow=True, strict=False):
+        """Лежит ли путь в корне пользователя (после раскрытия симлинков и '..')"""
+        return RESOLVER.inside(path, self.root, follow, strict)
     
-    def send_auth_form(self):
-        """Отправляет форму ввода пароля"""
-        html_content = """
+    def jail(self, *paths):
+        """Проверяет, что все пути в корне пользователя, иначе OutsideRoot"""
+        for path in paths:
+            if not self.in_root(path):
+                raise OutsideRoot(path)
+    
+    def owns_job(self, job):
+        """Задание над файлами из корня пользователя"""
+        return all(map(self.in_root, job['paths']))
+    
+    def account_label(self):
+        """Имя и занятое место для шапки"""
+        if self.user is None:
+            return '👤 admin'
+        label = f'👤 {html.escape(self.user)}'
+        usage = QUOTAS.usage(self.root)
+        if usage is not None:
+            used, quota = usage
+            label += f' · 💾 {self.format_size(used)} / {self.format_size(quota)}'
+        return label
+    
+    AUTH_PAGE = PageTemplate("""
         <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>File Manager - Access</title>
-            <style>
-                body { 
-                    font-family: Arial, sans-serif; 
-                    background: #2d3748;
-                    height: 100vh;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    margin: 0;
-                }
-                .auth-container {
-                    background: #4a5568;
-                    padding: 40px;
-                    border-radius: 10px;
-                    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                    text-align: center;
-                    max-width: 400px;
-                    width: 90%;
-                }
-                h2 {
-                    color: white;
-                    margin-bottom: 30px;
-                }
-                .form-group {
-                    margin-bottom: 20px;
-                }
-                input[type="password"] {
-                    width: 100%;
-                    padding: 15px;
-                    background: #718096;
-                    border: 2px solid #a0aec0;
-                    border-radius: 5px;
-                    font-size: 16px;
-                    box-sizing: border-box;
-                    color: white;
-                }
-                input[type="password"]::placeholder {
-                    color: #cbd5e0;
-                }
-                button {
-                    width: 100%;
-                    padding: 15px;
-                    background: #667eea;
-                    color: white;
-                    border: none;
-                    border-radius: 5px;
-                    font-size: 16px;
-                    cursor: pointer;
-                    transition: background 0.3s;
-                }
-                button:hover {
-                    background: #764ba2;
-                }
-            </style>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>File Manager - Access</title>
+            <link rel="stylesheet" href="{{css}}">
         </head>
         <body>
             <div class="auth-container">
                 <h2>🔐 File Manager Access</h2>
                 <form method="post">
+                    <div class="form-group">
+                        <input type="text" name="username" placeholder="Username (empty for admin)"
+                               autocomplete="username">
+                    </div>
                     <div class="form-group">
                         <input type="password" name="password" placeholder="Enter password" required>
                     </div>
+                    {{message}}
                     <button type="submit">Access Files</button>
+                    {{register}}
                 </form>
             </div>
         </body>
         </html>
-        """
+        """, css=AUTH_CSS)
+    
+    REGISTER_BUTTON = '<button type="submit" name="action" value="register" class="btn-register">📝 Register</button>'
+    
+    def send_auth_form(self, message=''):
+        """Отправляет форму входа (и регистрации, если она разрешена)"""
+        body = self.AUTH_PAGE.render(
+            message=f'<p class="auth-error">{html.escape(message)}</p>' if message else '',
+            register=self.REGISTER_BUTTON if ACCOUNTS.registration else '',
+        )
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(html_content.encode())
+        self.wfile.write(body)
     
-    def send_file_manager(self, current_dir):
-        """Отправляет файловый менеджер"""
+    def send_asset(self, name):
+        """Отдаёт статический CSS/JS; URL содержит версию, поэтому кеш вечный"""
+        asset = ASSETS.get(name)
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        encoding = self.accepted_encoding()
+        etag = self.variant_etag(asset['etag'], encoding)
+        if self.not_modified(etag, ASSETS_MTIME):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        data = asset['variants'][encoding] if encoding else asset['data']
+        self.send_response(200)
+        self.send_header('Content-type', asset['type'])
+        self.send_header('Content-Length', str(len(data)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def accepted_encoding(self):
+        """Сжатие, которое понимает клиент, или None"""
+        return choose_encoding(self.headers.get('Accept-Encoding'))
+    
+    def variant_etag(self, etag, encoding):
+        """У сжатого варианта свой ETag"""
+        return f'{etag[:-1]}-{encoding}"' if encoding else etag
+    
+    def is_compressible(self, file_path, mime_type):
+        """Стоит ли сжимать файл: уже сжатые форматы пропускаем"""
+        ext = os.path.splitext(file_path)[1].lower()
+        file_type = self.EXTENSION_TYPES.get(ext)
+        if file_type in ('archive', 'video', 'audio'):
+            return False
+        if file_type == 'image':
+            return mime_type == 'image/svg+xml'
+        # У .log, .php и подобных может не быть mimetype, но это текст
+        if file_type in ('text', 'code'):
+            return True
+        return (mime_type.startswith('text/')
+                or mime_type in ('application/json', 'application/javascript', 'application/xml',
+                                 'application/x-sh', 'image/svg+xml'))
+    
+    def start_chunked(self, encoding=None):
+        """Завершает заголовки и переключает wfile на chunked кодирование (и сжатие)"""
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        if self.request_version >= 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile = ChunkedWriter(self.raw_wfile)
+        else:
+            # Клиент HTTP/1.0: тело идёт до закрытия соединения
+            self.send_header('Connection', 'close')
+            self.end_headers()
+        if encoding:
+            self.wfile = CompressingWriter(self.wfile, encoding)
+    
+    def end_chunked(self):
+        """Завершает chunked тело и возвращает обычный wfile"""
+        writer, self.wfile = self.wfile, self.raw_wfile
+        if isinstance(writer, CompressingWriter):
+            writer.close()
+            writer = writer.wfile
+        if isinstance(writer, ChunkedWriter):
+            writer.close()
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header = value
+        super().send_header(keyword, value)
+    
+    def end_headers(self):
+        if self.close_connection:
+            # Клиент должен знать, что соединение закроется после ответа
+            if self.connection_header is None:
+                self.send_header('Connection', 'close')
+        else:
+            if (self.requests_served >= KEEPALIVE_MAX_REQUESTS
+                    or not getattr(self.server, 'keepalive', True)):
+                self.send_header('Connection', 'close')
+            else:
+                self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT}, '
+                                 f'max={KEEPALIVE_MAX_REQUESTS - self.requests_served}')
+        super().end_headers()
+    
+    def body_pending(self):
+        """Осталось ли в соединении непрочитанное тело запроса"""
+        if self.body_read:
+            return False
+        if getattr(self, 'headers', None) is None or 'Transfer-Encoding' in self.headers:
+            return True
         try:
-            files = []
-            for item in os.listdir(current_dir):
-                item_path = os.path.join(current_dir, item)
+            return int(self.headers.get('Content-Length') or 0) > 0
+        except ValueError:
+            return True
+    
+    def send_error(self, code, message=None, explain=None):
+        """Страница ошибки с Content-Length. В отличие от http.server соединение
+        не закрывается, если тело запроса прочитано"""
+        if self.close_connection or self.body_pending():
+            self.close_connection = True
+            super().send_error(code, message, explain)
+            return
+        short, long = self.responses.get(code, ('???', '???'))
+        message = message or short
+        self.log_error("code %d, message %s", code, message)
+        body = (self.error_message_format % {
+            'code': code,
+            'message': html.escape(message, quote=False),
+            'explain': html.escape(explain or long, quote=False),
+        }).encode('UTF-8', 'replace')
+        self.send_response(code, message)
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def send_redirect(self, location, cookie=None):
+        """Перенаправление 302 с пустым телом"""
+        self.send_response(302)
+        self.send_header('Location', location)
+        if cookie:
+            self.send_header('Set-Cookie', cookie)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    @classmethod
+    def file_info(cls, path, name, stats):
+        """Запись листинга по результату stat"""
+        is_dir = stat.S_ISDIR(stats.st_mode)
+        return {
+            'name': name,
+            'path': path,
+            'is_dir': is_dir,
+            'size': stats.st_size,
+            'modified': stats.st_mtime,
+            'icon': cls.get_file_icon(name, is_dir),
+            'is_hidden': name.startswith('.')
+        }
+    
+    @classmethod
+    def read_directory(cls, current_dir):
+        """Читает содержимое директории, папки сначала"""
+        files = []
+        with os.scandir(current_dir) as entries:
+            for entry in entries:
+                # Один stat на запись: тип берём из него же
                 try:
-                    stats = os.stat(item_path)
-                    files.append({
-                        'name': item,
-                        'path': item_path,
-                        'is_dir': os.path.isdir(item_path),
-                        'size': stats.st_size,
-                        'modified': stats.st_mtime,
-                        'icon': self.get_file_icon(item_path),
-                        'is_hidden': item.startswith('.')
-                    })
-                except:
+                    stats = entry.stat()
+                except OSError:
                     continue
-            
-            # Сортируем: папки сначала, потом файлы
-            files.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
-            
-            html_content = self.generate_file_manager_html(files, current_dir)
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(html_content.encode())
+                files.append(cls.file_info(entry.path, entry.name, stats))
+        
+        # Сортируем: папки сначала, потом файлы
+        files.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+        return files
+    
+    def listing_order(self, query):
+        """Порядок сортировки из параметров запроса: (sort, desc, dirs_first)"""
+        sort = query.get('sort', ['name'])[0]
+        if sort not in SORT_KEYS:
+            sort = 'name'
+        desc = query.get('order', ['asc'])[0] == 'desc'
+        dirs_first = query.get('dirs_first', ['1'])[0] != '0'
+        return sort, desc, dirs_first
+    
+    def send_file_manager(self, current_dir, order=('name', False, True)):
+        """Отправляет файловый менеджер"""
+        try:
+            view = LISTING_CACHE.get_view(current_dir, self.read_directory, order)
+            files, next_cursor = view.page(None, LISTING_PAGE_SIZE)
         except Exception as e:
             self.send_error(500, f"Error reading directory: {str(e)}")
+            return
+        
+        # Шапка уходит сразу, строки - порциями по мере отрисовки
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.start_chunked(self.accepted_encoding())
+        try:
+            chunks = self.generate_file_manager_html(files, current_dir, order, next_cursor, len(view.files))
+            self.wfile.write(next(chunks))
+            self.wfile.flush()
+            for chunk in chunks:
+                self.wfile.write(chunk)
+            self.end_chunked()
+        except ConnectionError:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
     
-    def generate_file_manager_html(self, files, current_dir):
-        """Генерирует HTML файлового менеджера"""
-        files_html = ""
-        for file in files:
-            if file['is_dir']:
-                link = f'?dir={urllib.parse.quote(file["path"])}'
-                open_web = ''
-            else:
-                link = f'?view={urllib.parse.quote(file["path"])}'
-                # Кнопки для файла
-                open_web = f'''
-                <a href="?preview={urllib.parse.quote(file["path"])}" target="_blank" class="open-web">👁️ View</a>
-                <a href="/{file["path"]}" target="_blank" class="open-web">🌐 Open</a>
-                '''
-            
-            file_class = "hidden-file" if file['is_hidden'] else ""
-            
-            files_html += f"""
+    def send_listing_page(self, current_dir, query):
+        """JSON страница листинга: ?list=<dir>&sort=&order=&cursor=&limit=&format=html"""
+        try:
+            limit = min(max(int(query.get('limit', [LISTING_PAGE_SIZE])[0]), 1), LISTING_MAX_PAGE)
+            view = LISTING_CACHE.get_view(current_dir, self.read_directory, self.listing_order(query))
+            items, next_cursor = view.page(query.get('cursor', [None])[0], limit)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        except OSError as e:
+            self.send_json({'error': str(e)}, 404)
+            return
+        
+        page = {'total': len(view.files), 'count': len(items), 'next': next_cursor}
+        if query.get('format', [''])[0] == 'html':
+            page['html'] = ''.join(map(self.render_file_row, items))
+        else:
+            page['items'] = items
+        self.send_json(page)
+    
+    def send_search(self, query):
+        """Поиск по индексу файлов: ?search=<строка>&mode=auto|substring|prefix|glob&limit=&format=html"""
+        if FILE_INDEX.thread is None:
+            self.send_json({'error': 'File index is disabled'}, 503)
+            return
+        text = query['search'][0]
+        mode = query.get('mode', ['auto'])[0]
+        started = time.monotonic()
+        try:
+            limit = min(max(int(query.get('limit', [SEARCH_LIMIT])[0]), 1), SEARCH_MAX_LIMIT)
+            results = FILE_INDEX.search(text, mode, limit, None if self.user is None else self.root)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        except sqlite3.Error as e:
+            self.send_json({'error': str(e)}, 500)
+            return
+        
+        page = {
+            'query': text,
+            'ready': FILE_INDEX.ready,
+            'count': len(results),
+            'took_ms': round((time.monotonic() - started) * 1000, 2),
+        }
+        if query.get('format', [''])[0] == 'html':
+            for item in results:
+                item['icon'] = self.get_file_icon(item['name'], item['is_dir'])
+                item['is_hidden'] = item['name'].startswith('.')
+            page['html'] = ''.join(map(self.render_file_row, results))
+        else:
+            page['items'] = results
+        self.send_json(page)
+    
+    def send_events(self, current_dir):
+        """Поток изменений в директории (Server-Sent Events): ?events=<dir>"""
+        if not os.path.isdir(current_dir):
+            self.send_json({'error': 'Directory not found'}, 404)
+            return
+        if WATCHER.streams >= WATCH_MAX_STREAMS:
+            # Браузер переподключится сам через Retry-After
+            self.send_response(503)
+            self.send_header('Retry-After', '30')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        events = WATCHER.subscribe(current_dir)
+        if getattr(self.server, 'detach_streams', False):
+            # Поток событий не должен занимать поток пула
+            self.detached = lambda: self.stream_events(current_dir, events)
+        else:
+            self.stream_events(current_dir, events)
+    
+    def stream_events(self, current_dir, events):
+        """Отдаёт события подписки events, пока клиент не уйдёт"""
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.start_chunked()
+            self.wfile.write(b'retry: 3000\n\n')
+            self.wfile.flush()
+            while True:
+                try:
+                    event = events.get(timeout=WATCH_PING_INTERVAL)
+                except queue.Empty:
+                    # Комментарий SSE: заодно узнаём, что клиент ушёл
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+                    continue
+                data = json.dumps(self.change_event(current_dir, event))
+                self.wfile.write(f'event: change\ndata: {data}\n\n'.encode())
+                self.wfile.flush()
+        except OSError:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+        finally:
+            WATCHER.unsubscribe(current_dir, events)
+    
+    def send_usage(self, current_dir, query):
+        """Размеры содержимого директории с учётом вложенных: ?du=<dir>&limit="""
+        try:
+            limit = min(max(int(query.get('limit', [DU_TOP_FILES])[0]), 1), DU_MAX_ITEMS)
+            self.send_json(DIR_SIZES.usage(current_dir, limit))
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except OSError as e:
+            self.send_json({'error': str(e)}, 404)
+    
+    def send_grep(self, query):
+        """Поиск по содержимому файлов: ?grep=<строка>&scope=<dir>&regex=1&case=1&glob=&context=
+        
+        Ответ - NDJSON поток: start с id для отмены, match по мере нахождения,
+        progress и итоговый done.
+        """
+        text = query['grep'][0]
+        scope = query.get('scope', [self.root])[0]
+        flags = 0 if query.get('case', [''])[0] == '1' else re.IGNORECASE
+        pattern = text.encode() if query.get('regex', [''])[0] == '1' else re.escape(text.encode())
+        try:
+            re.compile(pattern, flags)
+            context = min(max(int(query.get('context', [1])[0]), 0), GREP_MAX_CONTEXT)
+        except (re.error, ValueError) as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        
+        job_id, cancelled = GREP.register()
+        events = GREP.search(scope, pattern, flags, context, cancelled, query.get('glob', [None])[0],
+                             self.in_root)
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'application/x-ndjson; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.start_chunked(self.accepted_encoding())
+            self.wfile.write(json.dumps({'type': 'start', 'id': job_id}).encode() + b'\n')
+            self.wfile.flush()
+            for event in events:
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+                # Совпадения одной пачки уходят вместе, прогресс - сразу
+                if event['type'] != 'match':
+                    self.wfile.flush()
+            self.end_chunked()
+        except OSError:
+            # Клиент ушёл - поиск больше не нужен
+            cancelled.set()
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+        finally:
+            events.close()
+            GREP.forget(job_id)
+    
+    def change_event(self, current_dir, event):
+        """Событие для страницы: путь как в строках листинга и новая строка"""
+        change = {'event': event['event']}
+        if 'name' not in event:
+            return change
+        path = os.path.join(current_dir, event['name'])
+        change['path'] = path
+        if 'from' in event:
+            change['from_path'] = os.path.join(current_dir, event['from'])
+        if event['event'] != 'delete':
+            try:
+                info = self.file_info(path, event['name'], os.stat(path))
+                change['html'] = self.render_file_row(info)
+            except OSError:
+                # Файл успел исчезнуть
+                change['event'] = 'delete'
+        return change
+    
+    def render_file_row(self, file):
+        """HTML строки листинга"""
+        if file['is_dir']:
+            link = f'?dir={urllib.parse.quote(file["path"])}'
+            open_web = ''
+        elif file['name'].lower().endswith(BROWSABLE_ARCHIVES):
+            # Архив открывается как директория
+            link = f'?browse={urllib.parse.quote(file["path"])}'
+            open_web = f'''
+            <a href="?preview={urllib.parse.quote(file["path"])}" target="_blank" class="open-web">👁️ View</a>
+            <a href="/{file["path"]}" target="_blank" class="open-web">🌐 Open</a>
+            '''
+        else:
+            link = f'?view={urllib.parse.quote(file["path"])}'
+            # Кнопки для файла
+            open_web = f'''
+            <a href="?preview={urllib.parse.quote(file["path"])}" target="_blank" class="open-web">👁️ View</a>
+            <a href="/{file["path"]}" target="_blank" class="open-web">🌐 Open</a>
+            '''
+        
+        file_class = "hidden-file" if file['is_hidden'] else ""
+        
+        icon = file['icon']
+        ext = os.path.splitext(file['name'])[1].lower()
+        if (not file['is_dir'] and not file['is_hidden'] and self.EXTENSION_TYPES.get(ext) == 'image'
+                and THUMBNAILS.supports(ext, file['size'])):
+            # Миниатюра грузится, только когда строка доходит до экрана
+            query = urllib.parse.urlencode({'thumb': file['path'], 'v': int(file['modified'])})
+            icon = (f'<img class="thumb" src="?{html.escape(query)}" loading="lazy" decoding="async" '
+                    f'alt="" onerror="this.replaceWith(\'{icon}\')">')
+        
+        return f"""
             <div class="file-item {file_class}">
                 <input type="checkbox" class="file-checkbox" data-path="{html.escape(file['path'])}">
-                <span class="file-icon">{file['icon']}</span>
+                <span class="file-icon">{icon}</span>
                 <span class="file-name">
                     <a href="{link}">{html.escape(file['name'])}</a>
                 </span>
@@ -206,251 +5318,27 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
                 </span>
             </div>
             """
-        
-        return f"""
+    
+    def sort_link(self, label, sort, current_dir, order):
+        """Заголовок колонки, переключающий сортировку"""
+        current_sort, desc, dirs_first = order
+        if sort == current_sort:
+            label += ' ▼' if desc else ' ▲'
+            next_order = 'asc' if desc else 'desc'
+        else:
+            next_order = 'asc'
+        query = urllib.parse.urlencode({'dir': current_dir, 'sort': sort, 'order': next_order,
+                                        'dirs_first': int(dirs_first)})
+        return f'<a href="?{html.escape(query)}">{label}</a>'
+    
+    MANAGER_HEAD = PageTemplate("""
         <!DOCTYPE html>
         <html>
         <head>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>File Manager - {current_dir}</title>
-            <style>
-                * {{
-                    margin: 0;
-                    padding: 0;
-                    box-sizing: border-box;
-                }}
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    background: #1a202c;
-                    color: #e2e8f0;
-                    line-height: 1.6;
-                }}
-                .header {{
-                    background: #2d3748;
-                    color: white;
-                    padding: 20px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-                }}
-                .header h1 {{
-                    margin-bottom: 15px;
-                    font-size: 24px;
-                }}
-                .header-controls {{
-                    display: flex;
-                    gap: 10px;
-                    flex-wrap: wrap;
-                }}
-                .header button {{
-                    padding: 10px 20px;
-                    border: none;
-                    border-radius: 5px;
-                    cursor: pointer;
-                    font-size: 14px;
-                    font-weight: 500;
-                    transition: all 0.3s;
-                }}
-                .btn-home {{ background: #48bb78; color: white; }}
-                .btn-back {{ background: #ed8936; color: white; }}
-                .btn-logout {{ background: #f56565; color: white; }}
-                .btn-home:hover {{ background: #38a169; }}
-                .btn-back:hover {{ background: #dd6b20; }}
-                .btn-logout:hover {{ background: #e53e3e; }}
-                
-                .current-path {{
-                    background: #2d3748;
-                    margin: 20px;
-                    padding: 15px;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-                    font-family: monospace;
-                    color: #cbd5e0;
-                    word-break: break-all;
-                }}
-                
-                .file-list {{
-                    background: #2d3748;
-                    margin: 20px;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-                    overflow: hidden;
-                }}
-                .file-header {{
-                    display: flex;
-                    background: #4a5568;
-                    padding: 12px 15px;
-                    font-weight: bold;
-                    border-bottom: 2px solid #718096;
-                    align-items: center;
-                }}
-                .file-header > * {{
-                    padding: 0 5px;
-                }}
-                .file-item {{
-                    display: flex;
-                    align-items: center;
-                    padding: 10px 15px;
-                    border-bottom: 1px solid #4a5568;
-                    transition: background 0.2s;
-                }}
-                .file-item:hover {{
-                    background: #4a5568;
-                }}
-                .hidden-file {{
-                    background: #744210;
-                }}
-                .file-checkbox {{
-                    width: 20px;
-                    margin-right: 10px;
-                }}
-                .file-icon {{
-                    width: 30px;
-                    font-size: 18px;
-                    text-align: center;
-                    margin-right: 10px;
-                }}
-                .file-name {{
-                    flex: 3;
-                    min-width: 200px;
-                    color: #e2e8f0;
-                    font-weight: 500;
-                }}
-                .file-name a {{
-                    color: #e2e8f0;
-                    text-decoration: none;
-                }}
-                .file-name a:hover {{
-                    color: #90cdf4;
-                    text-decoration: underline;
-                }}
-                .file-size {{
-                    flex: 1;
-                    min-width: 100px;
-                    color: #cbd5e0;
-                    font-size: 14px;
-                    text-align: right;
-                    font-weight: bold;
-                }}
-                .file-modified {{
-                    flex: 1;
-                    min-width: 150px;
-                    color: #cbd5e0;
-                    font-size: 14px;
-                    text-align: right;
-                    font-weight: bold;
-                }}
-                .file-actions {{
-                    flex: 1;
-                    min-width: 120px;
-                    text-align: right;
-                }}
-                .open-web {{
-                    color: #90cdf4;
-                    text-decoration: none;
-                    font-size: 13px;
-                    padding: 4px 8px;
-                    background: #4a5568;
-                    border-radius: 3px;
-                    margin-left: 5px;
-                    font-weight: bold;
-                }}
-                .open-web:hover {{
-                    background: #5a6578;
-                    text-decoration: none;
-                }}
-                
-                .actions {{
-                    background: #2d3748;
-                    margin: 20px;
-                    padding: 20px;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.3);
-                    display: flex;
-                    gap: 10px;
-                    flex-wrap: wrap;
-                }}
-                .actions button {{
-                    padding: 12px 20px;
-                    border: none;
-                    border-radius: 6px;
-                    cursor: pointer;
-                    font-size: 14px;
-                    font-weight: 500;
-                    transition: all 0.3s;
-                    min-width: 120px;
-                }}
-                .btn-create {{ background: #48bb78; color: white; }}
-                .btn-folder {{ background: #4299e1; color: white; }}
-                .btn-rename {{ background: #ed8936; color: white; }}
-                .btn-delete {{ background: #f56565; color: white; }}
-                .btn-clone {{ background: #9f7aea; color: white; }}
-                .btn-upload {{ background: #ed64a6; color: white; }}
-                
-                .btn-create:hover {{ background: #38a169; }}
-                .btn-folder:hover {{ background: #3182ce; }}
-                .btn-rename:hover {{ background: #dd6b20; }}
-                .btn-delete:hover {{ background: #e53e3e; }}
-                .btn-clone:hover {{ background: #805ad5; }}
-                .btn-upload:hover {{ background: #d53f8c; }}
-
-                /* Стили для модальных окон */
-                .modal {{
-                    display: none;
-                    position: fixed;
-                    z-index: 1000;
-                    left: 0;
-                    top: 0;
-                    width: 100%;
-                    height: 100%;
-                    background-color: rgba(0,0,0,0.7);
-                }}
-                .modal-content {{
-                    background-color: #2d3748;
-                    margin: 15% auto;
-                    padding: 30px;
-                    border-radius: 10px;
-                    width: 400px;
-                    box-shadow: 0 4px 20px rgba(0,0,0,0.5);
-                }}
-                .modal-header {{
-                    margin-bottom: 20px;
-                    color: white;
-                    font-size: 18px;
-                    font-weight: bold;
-                }}
-                .modal-input {{
-                    width: 100%;
-                    padding: 12px;
-                    background: #4a5568;
-                    border: 2px solid #718096;
-                    border-radius: 5px;
-                    color: white;
-                    font-size: 16px;
-                    margin-bottom: 20px;
-                    box-sizing: border-box;
-                }}
-                .modal-input:focus {{
-                    outline: none;
-                    border-color: #90cdf4;
-                }}
-                .modal-actions {{
-                    display: flex;
-                    gap: 10px;
-                    justify-content: flex-end;
-                }}
-                .modal-btn {{
-                    padding: 10px 20px;
-                    border: none;
-                    border-radius: 5px;
-                    cursor: pointer;
-                    font-size: 14px;
-                    font-weight: 500;
-                }}
-                .modal-confirm {{ background: #48bb78; color: white; }}
-                .modal-cancel {{ background: #718096; color: white; }}
-                .modal-confirm:hover {{ background: #38a169; }}
-                .modal-cancel:hover {{ background: #5a6578; }}
-            </style>
+            <title>File Manager - {{title}}</title>
+            <link rel="stylesheet" href="{{css}}">
         </head>
         <body>
             <div class="header">
@@ -459,34 +5347,47 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
                     <button class="btn-home" onclick="goHome()">🏠 Home</button>
                     <button class="btn-back" onclick="goBack()">⬅️ Back</button>
                     <button class="btn-logout" onclick="logout()">🚪 Logout</button>
+                    <span class="account">{{account}}</span>
+                    <input type="search" id="searchInput" class="search-input"
+                           placeholder="🔍 Search files (*.txt, name...)" oninput="searchFiles(this.value)">
+                    <button class="btn-grep" onclick="grepFiles()">📄 Search in files</button>
                 </div>
             </div>
             
             <div class="current-path">
-                📍 Current path: {html.escape(current_dir)}
+                📍 Current path: {{current_dir}}
             </div>
             
+            <div id="searchResults" class="file-list search-results"></div>
+            
             <div class="file-list">
                 <div class="file-header">
                     <div style="width: 20px; margin-right: 10px;">
                         <input type="checkbox" onchange="toggleAll(this)">
                     </div>
                     <div style="width: 30px; margin-right: 10px;">Icon</div>
-                    <div style="flex: 3; min-width: 200px;">Name</div>
-                    <div style="flex: 1; min-width: 100px; text-align: right;">Size</div>
-                    <div style="flex: 1; min-width: 150px; text-align: right;">Modified</div>
+                    <div style="flex: 3; min-width: 200px;">{{sort_name}}</div>
+                    <div style="flex: 1; min-width: 100px; text-align: right;">{{sort_size}}</div>
+                    <div style="flex: 1; min-width: 150px; text-align: right;">{{sort_mtime}}</div>
                     <div style="flex: 1; min-width: 120px; text-align: right;">Actions</div>
                 </div>
-                {files_html}
+                """, css=MANAGER_CSS)
+    
+    MANAGER_TAIL = PageTemplate("""
+                <div id="listSentinel" class="list-status">{{loaded}} / {{total}}</div>
             </div>
             
+            <div id="jobs" class="jobs"></div>
+            
             <div class="actions">
                 <button class="btn-create" onclick="showModal('createFile')">📄 New File</button>
                 <button class="btn-folder" onclick="showModal('createFolder')">📁 New Folder</button>
                 <button class="btn-rename" onclick="renameFile()">✏️ Rename</button>
                 <button class="btn-delete" onclick="deleteFiles()">🗑️ Delete</button>
                 <button class="btn-clone" onclick="cloneFiles()">📋 Clone</button>
+                <button class="btn-download" onclick="downloadFiles()">📦 Download</button>
                 <button class="btn-upload" onclick="uploadFile()">📤 Upload</button>
+                <button class="btn-sizes" onclick="showSizes()">📊 Sizes</button>
             </div>
 
             <!-- Модальное окно для создания файла -->
@@ -525,185 +5426,57 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
                 </div>
             </div>
             
-            <script>
-                let selectedFiles = [];
-                let currentRenamePath = '';
-
-                function getSelectedFiles() {{
-                    const checkboxes = document.querySelectorAll('.file-checkbox:checked');
-                    return Array.from(checkboxes).map(cb => cb.dataset.path);
-                }}
-                
-                function toggleAll(source) {{
-                    const checkboxes = document.querySelectorAll('.file-checkbox');
-                    checkboxes.forEach(cb => cb.checked = source.checked);
-                }}
-                
-                function goHome() {{
-                    location.href = '/';
-                }}
-                
-                function goBack() {{
-                    const currentDir = '{current_dir}';
-                    const parentDir = currentDir.split('/').slice(0, -1).join('/');
-                    if (parentDir && parentDir !== '') {{
-                        location.href = '?dir=' + encodeURIComponent(parentDir);
-                    }} else {{
-                        location.href = '/';
-                    }}
-                }}
-                
-                function logout() {{
-                    document.cookie = 'filemanager_auth=; expires=Thu, 01 Jan 1970 00:00:00 GMT; path=/';
-                    location.reload();
-                }}
-
-                function showModal(modalType) {{
-                    const modals = {{
-                        'createFile': 'createFileModal',
-                        'createFolder': 'createFolderModal',
-                        'rename': 'renameModal'
-                    }};
-                    document.getElementById(modals[modalType]).style.display = 'block';
-                }}
-
-                function hideModal(modalId) {{
-                    document.getElementById(modalId).style.display = 'none';
-                }}
-
-                function createFile() {{
-                    const name = document.getElementById('fileName').value.trim();
-                    if (name) {{
-                        const form = document.createElement('form');
-                        form.method = 'post';
-                        form.innerHTML = `
-                            <input type="hidden" name="action" value="create_file">
-                            <input type="hidden" name="name" value="${{name}}">
-                            <input type="hidden" name="current_dir" value="{current_dir}">
-                        `;
-                        document.body.appendChild(form);
-                        form.submit();
-                    }}
-                    hideModal('createFileModal');
-                }}
-
-                function createFolder() {{
-                    const name = document.getElementById('folderName').value.trim();
-                    if (name) {{
-                        const form = document.createElement('form');
-                        form.method = 'post';
-                        form.innerHTML = `
-                            <input type="hidden" name="action" value="create_folder">
-                            <input type="hidden" name="name" value="${{name}}">
-                            <input type="hidden" name="current_dir" value="{current_dir}">
-                        `;
-                        document.body.appendChild(form);
-                        form.submit();
-                    }}
-                    hideModal('createFolderModal');
-                }}
-
-                function renameFile() {{
-                    const files = getSelectedFiles();
-                    if (files.length === 1) {{
-                        currentRenamePath = files[0];
-                        const currentName = currentRenamePath.split('/').pop();
-                        document.getElementById('newFileName').value = currentName;
-                        showModal('rename');
-                    }} else alert('Please select exactly one file or folder to rename.');
-                }}
-
-                function performRename() {{
-                    const newName = document.getElementById('newFileName').value.trim();
-                    if (newName && currentRenamePath) {{
-                        const form = document.createElement('form');
-                        form.method = 'post';
-                        form.innerHTML = `
-                            <input type="hidden" name="action" value="rename">
-                            <input type="hidden" name="path" value="${{currentRenamePath}}">
-                            <input type="hidden" name="new_name" value="${{newName}}">
-                        `;
-                        document.body.appendChild(form);
-                        form.submit();
-                    }}
-                    hideModal('renameModal');
-                }}
-                
-                function deleteFiles() {{
-                    const files = getSelectedFiles();
-                    if (files.length > 0 && confirm('Are you sure you want to delete selected items?')) {{
-                        const form = document.createElement('form');
-                        form.method = 'post';
-                        files.forEach(path => {{
-                            form.innerHTML += `
-                                <input type="hidden" name="action" value="delete">
-                                <input type="hidden" name="path" value="${{path}}">
-                            `;
-                        }});
-                        document.body.appendChild(form);
-                        form.submit();
-                    }}
-                }}
-                
-                function cloneFiles() {{
-                    const files = getSelectedFiles();
-                    if (files.length > 0) {{
-                        const form = document.createElement('form');
-                        form.method = 'post';
-                        files.forEach(path => {{
-                            form.innerHTML += `
-                                <input type="hidden" name="action" value="clone">
-                                <input type="hidden" name="path" value="${{path}}">
-                            `;
-                        }});
-                        document.body.appendChild(form);
-                        form.submit();
-                    }}
-                }}
-                
-                function uploadFile() {{
-                    const input = document.createElement('input');
-                    input.type = 'file';
-                    input.multiple = true;
-                    input.onchange = function() {{
-                        const form = new FormData();
-                        form.append('action', 'upload');
-                        form.append('current_dir', '{current_dir}');
-                        for (let file of input.files) {{
-                            form.append('files', file);
-                        }}
-                        fetch('', {{ method: 'POST', body: form }}).then(() => location.reload());
-                    }};
-                    input.click();
-                }}
-
-                // Закрытие модальных окон при клике вне их
-                window.onclick = function(event) {{
-                    if (event.target.classList.contains('modal')) {{
-                        event.target.style.display = 'none';
-                    }}
-                }}
-
-                // Обработка Enter в модальных окнах
-                document.addEventListener('keydown', function(event) {{
-                    if (event.key === 'Enter') {{
-                        if (document.getElementById('createFileModal').style.display === 'block') {{
-                            createFile();
-                        }} else if (document.getElementById('createFolderModal').style.display === 'block') {{
-                            createFolder();
-                        }} else if (document.getElementById('renameModal').style.display === 'block') {{
-                            performRename();
-                        }}
-                    }} else if (event.key === 'Escape') {{
-                        hideModal('createFileModal');
-                        hideModal('createFolderModal');
-                        hideModal('renameModal');
-                    }}
-                }});
-            </script>
+            <!-- Модальное окно для скачивания архивом -->
+            <div id="downloadModal" class="modal">
+                <div class="modal-content">
+                    <div class="modal-header">📦 Download Selection</div>
+                    <select id="archiveFormat" class="modal-input">
+                        <option value="zip">ZIP</option>
+                        <option value="zip-store">ZIP without compression (fastest)</option>
+                        <option value="tar.gz">tar.gz (keeps symlinks)</option>
+                    </select>
+                    <div class="modal-actions">
+                        <button class="modal-btn modal-cancel" onclick="hideModal('downloadModal')">Cancel</button>
+                        <button class="modal-btn modal-confirm" onclick="performDownload()">Download</button>
+                    </div>
+                </div>
+            </div>
+            
+            <script>const PAGE = {{page}};</script>
+            <script src="{{js}}"></script>
         </body>
         </html>
-        """
+        """, js=MANAGER_JS)
+    
+    def generate_file_manager_html(self, files, current_dir, order=('name', False, True), next_cursor=None, total=None):
+        """Генерирует HTML файлового менеджера кусками байтов"""
+        if total is None:
+            total = len(files)
+        sort, desc, dirs_first = order
+        yield self.MANAGER_HEAD.render(
+            title=html.escape(current_dir),
+            current_dir=html.escape(current_dir),
+            account=self.account_label(),
+            sort_name=self.sort_link('Name', 'name', current_dir, order),
+            sort_size=self.sort_link('Size', 'size', current_dir, order),
+            sort_mtime=self.sort_link('Modified', 'mtime', current_dir, order),
+        )
+        for i in range(0, len(files), ROWS_PER_CHUNK):
+            yield ''.join(map(self.render_file_row, files[i:i + ROWS_PER_CHUNK])).encode()
+        page = {
+            'currentDir': current_dir,
+            'listParams': {'list': current_dir, 'sort': sort, 'order': 'desc' if desc else 'asc',
+                           'dirs_first': int(dirs_first), 'format': 'html'},
+            'nextCursor': next_cursor,
+            'loadedRows': len(files),
+            'uploadParallel': UPLOAD_PARALLEL,
+            'uploadChunkSize': UPLOAD_CHUNK_SIZE,
+        }
+        yield self.MANAGER_TAIL.render(
+            loaded=len(files),
+            total=total,
+            page=json.dumps(page).replace('<', '\\u003c'),
+        )
     
     def format_size(self, size):
         """Форматирует размер файла"""
@@ -715,119 +5488,430 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
             size /= 1024.0
         return f"{size:.1f} TB"
     
-    def show_editor(self, file_path):
-        """Показывает редактор файла"""
+    EDITOR_HEAD = PageTemplate("""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <title>Editing: {{name}}</title>
+            <link rel="stylesheet" href="{{css}}">
+        </head>
+        <body>
+            <div class="editor-container">
+                <div class="editor-header">
+                    <h2>✏️ Editing: {{name}}</h2>
+                </div>
+                <div class="editor-content">
+                    <form method="post">
+                        <!-- Служебные поля идут до content: сервер пишет его на диск потоком -->
+                        <input type="hidden" name="action" value="save">
+                        <input type="hidden" name="path" value="{{path}}">
+                        <input type="hidden" name="etag" value="{{etag}}">
+                        <textarea name="content" placeholder="File content...">""", css=EDITOR_CSS)
+    
+    EDITOR_TAIL = PageTemplate("""</textarea>
+                        <div class="editor-actions">
+                            <button type="submit" class="btn-save">💾 Save Changes</button>
+                            <button type="button" class="btn-cancel" onclick="history.back()">❌ Cancel</button>
+                        </div>
+                    </form>
+                </div>
+            </div>
+        </body>
+        </html>
+        """)
+    
+    PAGED_EDITOR = PageTemplate("""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <title>Editing: {{name}}</title>
+            <link rel="stylesheet" href="{{css}}">
+        </head>
+        <body>
+            <div class="editor-container" id="editor" data-path="{{path}}"
+                 data-lines="{{lines}}" data-interval="{{interval}}">
+                <div class="editor-header">
+                    <h2>✏️ Editing: {{name}} ({{size}})</h2>
+                    <div class="editor-nav">
+                        <button type="button" onclick="loadWindow(0)">⏮ Start</button>
+                        <button type="button" onclick="prevWindow()">◀ Prev</button>
+                        <input type="number" id="gotoLine" min="1" placeholder="Line">
+                        <button type="button" onclick="gotoLine()">Go</button>
+                        <button type="button" onclick="nextWindow()">Next ▶</button>
+                        <button type="button" onclick="loadWindow(-{{lines}})">End ⏭</button>
+                        <label><input type="checkbox" id="follow" onchange="toggleFollow(this.checked)"> 📡 Follow</label>
+                    </div>
+                    <div class="editor-status" id="status">Loading...</div>
+                </div>
+                <div class="editor-content">
+                    <textarea id="window" spellcheck="false" placeholder="File content..."></textarea>
+                    <div class="editor-actions">
+                        <button type="button" class="btn-save" id="saveButton" onclick="saveWindow()">💾 Save Lines</button>
+                        <button type="button" class="btn-cancel" onclick="history.back()">❌ Cancel</button>
+                    </div>
+                </div>
+            </div>
+            <script src="{{js}}"></script>
+        </body>
+        </html>
+        """, css=EDITOR_CSS, js=EDITOR_JS, lines=EDITOR_WINDOW_LINES,
+        interval=EDITOR_FOLLOW_INTERVAL * 1000)
+    
+    def show_paged_editor(self, file_path, size):
+        """Редактор большого файла: окна строк подгружаются через ?lines="""
+        body = self.PAGED_EDITOR.render(name=html.escape(os.path.basename(file_path)),
+                                         path=html.escape(file_path), size=self.format_size(size))
+        encoding = self.accepted_encoding()
+        if encoding:
+            body = compress_bytes(body, encoding)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_lines(self, query):
+        """Окно строк файла: ?lines=<file>&start=&count=
+        
+        Отрицательный start отсчитывается от конца файла. С since=<смещение>
+        и inode= отдаются только строки, дописанные после смещения (tail -f);
+        если файл заменили или обрезали, ответ - reset.
+        """
+        path = query['lines'][0]
+        try:
+            start = int(query.get('start', [0])[0])
+            count = min(max(int(query.get('count', [EDITOR_WINDOW_LINES])[0]), 1), EDITOR_MAX_WINDOW)
+            since = int(query['since'][0]) if 'since' in query else None
+            inode = int(query.get('inode', [0])[0])
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        try:
+            with open(path, 'rb') as f:
+                fd = f.fileno()
+                st = os.fstat(fd)
+                if not stat.S_ISREG(st.st_mode):
+                    self.send_json({'error': 'Not a regular file'}, 400)
+                    return
+                if since is not None and (st.st_ino != inode or st.st_size < since):
+                    self.send_json({'reset': True})
+                    return
+                index = LINE_INDEXES.get(path)
+                with index.lock:
+                    index.update(fd, st)
+                    if since is not None:
+                        window = index.read_since(fd, since)
+                    else:
+                        if start < 0:
+                            start = max(index.lines + start, 0)
+                        window = index.read_window(fd, start, count)
+        except OSError as e:
+            self.send_json({'error': str(e)}, 404)
+            return
+        window['etag'] = file_etag(st)
+        window['inode'] = st.st_ino
+        self.send_json(window)
+    
+    def show_editor(self, file_path):
+        """Показывает редактор файла"""
+        try:
+            st = os.stat(file_path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > EDITOR_INLINE_MAX:
+                # Большой файл целиком в textarea не помещаем
+                self.show_paged_editor(file_path, st.st_size)
+                return
+        except OSError:
+            pass
+        etag = ''
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                # ETag на момент открытия: по нему сохранение заметит чужие правки
+                etag = file_etag(os.fstat(f.fileno()))
+                content = f.read()
+        except:
+            content = ""
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.start_chunked(self.accepted_encoding())
+        try:
+            self.wfile.write(self.EDITOR_HEAD.render(name=html.escape(os.path.basename(file_path)),
+                                                     path=html.escape(file_path), etag=html.escape(etag)))
+            self.wfile.write(html.escape(content).encode())
+            self.wfile.write(self.EDITOR_TAIL.render())
+            self.end_chunked()
+        except ConnectionError:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+    
+    def send_archive(self, paths, fmt):
+        """Скачивание файлов и папок одним архивом (zip, zip-store, tar.gz).
+        
+        Архив собирается на лету прямо в chunked ответ: ни на диске, ни в
+        памяти его нет, сколько бы ни весили файлы. Если чтение оборвалось
+        посреди архива, соединение закрывается без завершающего куска,
+        и браузер видит незаконченную загрузку, а не битый файл.
+        """
+        paths = [path for path in paths if self.in_root(path) and os.path.lexists(path)]
+        if fmt not in ARCHIVE_FORMATS:
+            self.send_error(400, "Unknown archive format")
+            return
+        if not paths:
+            self.send_error(404, "File not found")
+            return
+        
+        first = os.path.normpath(os.path.abspath(paths[0]))
+        name = os.path.basename(first if len(paths) == 1 else os.path.dirname(first)) or 'download'
+        ext, content_type = ARCHIVE_FORMATS[fmt]
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Disposition', "attachment; filename*=UTF-8''" +
+                         urllib.parse.quote(name + ext))
+        self.start_chunked()
+        try:
+            stream = ArchiveStream(self.wfile)
+            if fmt == 'tar.gz':
+                compressed = CompressingWriter(stream, 'gzip')
+                write_tar(compressed, paths)
+                compressed.close()
+            else:
+                compression = zipfile.ZIP_STORED if fmt == 'zip-store' else zipfile.ZIP_DEFLATED
+                write_zip(stream, paths, compression, self.PRECOMPRESSED, self.in_root)
+            stream.flush()
+            self.end_chunked()
+        except Exception:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+    
+    ARCHIVE_HEAD = PageTemplate("""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>Archive - {{title}}</title>
+            <link rel="stylesheet" href="{{css}}">
+        </head>
+        <body>
+            <div class="header">
+                <h1>📦 Archive</h1>
+                <div class="header-controls">
+                    <button class="btn-home" onclick="location.href = '/'">🏠 Home</button>
+                    <button class="btn-back" onclick="goBack()">⬅️ Back</button>
+                </div>
+            </div>
+            
+            <div class="current-path">
+                📍 {{title}}
+            </div>
+            
+            <div class="file-list" id="archive" data-path="{{path}}" data-inner="{{inner}}"
+                 data-dest="{{dest}}" data-back="{{back}}">
+                <div class="file-header">
+                    <div style="width: 20px; margin-right: 10px;">
+                        <input type="checkbox" onchange="toggleAll(this)">
+                    </div>
+                    <div style="width: 30px; margin-right: 10px;">Icon</div>
+                    <div style="flex: 3; min-width: 200px;">Name</div>
+                    <div style="flex: 1; min-width: 100px; text-align: right;">Size</div>
+                    <div style="flex: 1; min-width: 150px; text-align: right;">Modified</div>
+                    <div style="flex: 1; min-width: 120px; text-align: right;">Actions</div>
+                </div>
+                """, css=MANAGER_CSS)
+    
+    ARCHIVE_TAIL = PageTemplate("""
+            </div>
+            
+            <div class="actions">
+                <button class="btn-folder" onclick="extractFiles(false)">📤 Extract Selected</button>
+                <button class="btn-create" onclick="extractFiles(true)">📤 Extract All</button>
+            </div>
+            
+            <script src="{{js}}"></script>
+        </body>
+        </html>
+        """, js=ARCHIVE_JS)
+    
+    def render_archive_row(self, archive, entry):
+        """HTML строки содержимого архива"""
+        if entry['is_dir']:
+            link = '?' + urllib.parse.urlencode({'browse': archive, 'inner': entry['path']})
+            actions = ''
+        else:
+            link = '?' + urllib.parse.urlencode({'member': archive, 'name': entry['path']})
+            actions = f'<a href="{html.escape(link)}&amp;download=1" class="open-web">⬇️ Download</a>'
+        return f"""
+            <div class="file-item">
+                <input type="checkbox" class="file-checkbox" data-member="{html.escape(entry['path'])}">
+                <span class="file-icon">{self.get_file_icon(entry['name'], entry['is_dir'])}</span>
+                <span class="file-name">
+                    <a href="{html.escape(link)}">{html.escape(entry['name'])}</a>
+                </span>
+                <span class="file-size">{'' if entry['is_dir'] else self.format_size(entry['size'])}</span>
+                <span class="file-modified">{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['modified']))}</span>
+                <span class="file-actions">
+                    {actions}
+                </span>
+            </div>
+            """
+    
+    @staticmethod
+    def extract_dest(path, index):
+        """Папка для распаковки по умолчанию: имя архива без расширения"""
+        if index.kind == 'gzip':
+            # Одиночный .gz распаковывается рядом с собой
+            return os.path.dirname(path)
+        for suffix in BROWSABLE_ARCHIVES:
+            if path.lower().endswith(suffix):
+                return path[:-len(suffix)]
+        return path + '_files'
+    
+    def send_archive_listing(self, archive, inner):
+        """Содержимое архива: ?browse=<архив>&inner=<директория в архиве>"""
+        inner = inner.strip('/')
+        try:
+            index = ARCHIVES.get(archive)
+            items = index.listing(inner)
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+            return
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            self.send_error(415, f"Cannot read archive: {e}")
+            return
+        
+        if inner:
+            back = '?' + urllib.parse.urlencode({'browse': archive, 'inner': inner.rpartition('/')[0]})
+        else:
+            back = '?' + urllib.parse.urlencode({'dir': os.path.dirname(archive)})
+        page = [self.ARCHIVE_HEAD.render(
+            title=html.escape(os.path.join(archive, inner)), path=html.escape(archive),
+            inner=html.escape(inner), back=html.escape(back),
+            dest=html.escape(self.extract_dest(archive, index)))]
+        page += [self.render_archive_row(archive, entry).encode() for entry in items]
+        page.append(self.ARCHIVE_TAIL.render())
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.start_chunked(self.accepted_encoding())
+        try:
+            for i in range(0, len(page), ROWS_PER_CHUNK):
+                self.wfile.write(b''.join(page[i:i + ROWS_PER_CHUNK]))
+            self.end_chunked()
+        except ConnectionError:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+    
+    def send_member(self, archive, name, download=False):
+        """Файл из архива потоком: ?member=<архив>&name=<путь в архиве>&download=1"""
+        try:
+            index = ARCHIVES.get(archive)
+            owner, f = open_member(index, name.strip('/'))
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+            return
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            self.send_error(415, f"Cannot read archive: {e}")
+            return
+        
+        try:
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            self.send_response(200)
+            self.send_header('Content-type', mime_type)
+            if download:
+                self.send_header('Content-Disposition', "attachment; filename*=UTF-8''" +
+                                 urllib.parse.quote(os.path.basename(name)))
+            if index.kind == 'gzip':
+                # Размер в трейлере gzip хранится по модулю 2**32
+                self.start_chunked()
+            else:
+                self.send_header('Content-Length', str(index.members[name.strip('/')][1]))
+                self.end_headers()
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+            if index.kind == 'gzip':
+                self.end_chunked()
+        except Exception:
+            # Битые данные посреди ответа: обрываем соединение, а не отдаём мусор
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+        finally:
+            f.close()
+            owner.close()
+    
+    def handle_extract(self, params):
+        """Распаковка выбранного из архива фоновым заданием"""
+        path = params.get('path', [''])[0]
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-        except:
-            content = ""
+            index = ARCHIVES.get(path)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            self.send_json({'error': f'Cannot read archive: {e}'}, 400)
+            return
+        dest = os.path.abspath(params.get('dest', [''])[0] or self.extract_dest(path, index))
+        if not self.in_root(path) or not self.in_root(dest):
+            self.send_json({'error': 'Path is outside of the root directory'}, 403)
+            return
+        job = JOBS.submit('extract', [path], run_extract(index, params.get('inner', [''])[0],
+                                                          params.get('member', []), dest))
+        if params.get('format', [''])[0] == 'json':
+            self.send_json({'job': job})
+        else:
+            self.send_redirect(f'?dir={urllib.parse.quote(dest)}')
+    
+    def send_thumbnail(self, file_path):
+        """Миниатюра картинки: ?thumb=<file>&v=<mtime>"""
+        ext = os.path.splitext(file_path)[1].lower()
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode) or self.EXTENSION_TYPES.get(ext) != 'image':
+            self.send_error(404, "File not found")
+            return
+        if ext == '.svg' or not THUMBNAILS.enabled:
+            if st.st_size <= THUMB_PASSTHROUGH:
+                self.serve_file_preview(file_path)
+            else:
+                self.send_error(404, "No thumbnail")
+            return
         
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>Editing: {os.path.basename(file_path)}</title>
-            <style>
-                body {{ 
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    background: #1a202c;
-                    margin: 0;
-                    padding: 20px;
-                    color: #e2e8f0;
-                }}
-                .editor-container {{
-                    max-width: 1200px;
-                    margin: 0 auto;
-                    background: #2d3748;
-                    border-radius: 10px;
-                    box-shadow: 0 2px 20px rgba(0,0,0,0.3);
-                    overflow: hidden;
-                }}
-                .editor-header {{
-                    background: #4a5568;
-                    color: white;
-                    padding: 25px;
-                }}
-                .editor-header h2 {{
-                    margin: 0;
-                    font-size: 24px;
-                }}
-                .editor-content {{
-                    padding: 25px;
-                }}
-                textarea {{
-                    width: 100%;
-                    height: 700px;
-                    font-family: 'Consolas', 'Monaco', monospace;
-                    font-size: 14px;
-                    padding: 20px;
-                    background: #1a202c;
-                    color: #e2e8f0;
-                    border: 2px solid #4a5568;
-                    border-radius: 8px;
-                    resize: vertical;
-                    line-height: 1.5;
-                }}
-                .editor-actions {{
-                    margin-top: 25px;
-                    display: flex;
-                    gap: 15px;
-                    justify-content: center;
-                }}
-                .editor-actions button {{
-                    padding: 15px 30px;
-                    border: none;
-                    border-radius: 8px;
-                    cursor: pointer;
-                    font-size: 16px;
-                    font-weight: 600;
-                    min-width: 160px;
-                    transition: all 0.3s;
-                }}
-                .btn-save {{ 
-                    background: #48bb78; 
-                    color: white; 
-                }}
-                .btn-cancel {{ 
-                    background: #718096; 
-                    color: white; 
-                }}
-                .btn-save:hover {{ 
-                    background: #38a169;
-                    transform: translateY(-2px);
-                }}
-                .btn-cancel:hover {{ 
-                    background: #5a6268;
-                    transform: translateY(-2px);
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="editor-container">
-                <div class="editor-header">
-                    <h2>✏️ Editing: {html.escape(os.path.basename(file_path))}</h2>
-                </div>
-                <div class="editor-content">
-                    <form method="post">
-                        <textarea name="content" placeholder="File content...">{html.escape(content)}</textarea>
-                        <div class="editor-actions">
-                            <input type="hidden" name="action" value="save">
-                            <input type="hidden" name="path" value="{file_path}">
-                            <button type="submit" class="btn-save">💾 Save Changes</button>
-                            <button type="button" class="btn-cancel" onclick="history.back()">❌ Cancel</button>
-                        </div>
-                    </form>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        for _ in range(2):
+            try:
+                cached = THUMBNAILS.get(os.path.realpath(file_path), st)
+                with open(cached, 'rb') as f:
+                    data = f.read()
+                break
+            except FileNotFoundError:
+                # Миниатюру успели вытеснить - строим ещё раз
+                continue
+            except Exception as e:
+                self.send_error(415, f"Cannot make a thumbnail: {e}")
+                return
+        else:
+            self.send_error(503, "Thumbnail cache is busy")
+            return
+        
+        etag = f'"{os.path.basename(cached).partition(".")[0]}"'
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', THUMBNAILS.content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        # В URL есть mtime картинки, поэтому миниатюру можно кешировать надолго
+        self.send_header('Cache-Control', 'private, max-age=604800')
         self.end_headers()
-        self.wfile.write(html_content.encode())
+        self.wfile.write(data)
     
     def serve_file_preview(self, file_path):
         """Показывает файл для просмотра"""
@@ -841,36 +5925,325 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
             mime_type = 'application/octet-stream'
         
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-type', mime_type)
-            self.send_header('Content-Length', str(len(content)))
-            self.end_headers()
-            self.wfile.write(content)
+            f = open(file_path, 'rb')
         except Exception as e:
             self.send_error(500, f"Error reading file: {str(e)}")
+            return
+        
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            
+            # Запросы диапазонов отдаём без сжатия: Range относится к исходным байтам
+            encoding = None
+            if ('Range' not in self.headers and size >= COMPRESS_MIN_SIZE
+                    and self.is_compressible(file_path, mime_type)):
+                encoding = self.accepted_encoding()
+            etag = self.variant_etag(file_etag(st), encoding)
+            
+            if self.not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_validators(etag, st.st_mtime)
+                if encoding:
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.end_headers()
+                return
+            
+            if encoding:
+                self.send_compressed_file(f, st, etag, encoding, mime_type)
+                return
+            
+            ranges = self.requested_ranges(size, etag, st.st_mtime)
+            if ranges is None:
+                self.send_response(200)
+                self.send_header('Content-type', mime_type)
+                self.send_header('Content-Length', str(size))
+                self.send_validators(etag, st.st_mtime)
+                self.end_headers()
+                self.send_file_range(f, 0, size)
+            elif not ranges:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-type', mime_type)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_validators(etag, st.st_mtime)
+                self.end_headers()
+                self.send_file_range(f, start, end - start + 1)
+            else:
+                self.send_multiple_ranges(f, ranges, size, mime_type, etag, st.st_mtime)
+    
+    def send_compressed_file(self, f, st, etag, encoding, mime_type):
+        """Отдаёт сжатый файл: небольшие - из кеша, крупные - сжимая потоком"""
+        self.send_response(200)
+        self.send_header('Content-type', mime_type)
+        self.send_validators(etag, st.st_mtime)
+        if st.st_size <= COMPRESS_CACHE_MAX_FILE:
+            data = COMPRESSION_CACHE.get(st, encoding, f.read)
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        
+        self.start_chunked(encoding)
+        try:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+            self.end_chunked()
+        except ConnectionError:
+            self.wfile = self.raw_wfile
+            self.close_connection = True
+    
+    def send_validators(self, etag, mtime):
+        """Заголовки для кеша браузера и докачки"""
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+        self.send_header('Cache-Control', 'private, no-cache')
+    
+    def not_modified(self, etag, mtime):
+        """Проверяет If-None-Match / If-Modified-Since"""
+        if self.command not in ('GET', 'HEAD'):
+            return False
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            # Слабое сравнение: W/"x" совпадает с "x"
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since
+        return False
+    
+    def requested_ranges(self, size, etag, mtime):
+        """Разбирает заголовок Range.
+        
+        None - отдать файл целиком, [] - диапазон не удовлетворим,
+        иначе список (start, end) включительно.
+        """
+        header = self.headers.get('Range')
+        if not header or self.command != 'GET':
+            return None
+        
+        if_range = self.headers.get('If-Range')
+        if if_range:
+            if_range = if_range.strip()
+            if if_range.startswith('"'):
+                if if_range != etag:
+                    return None
+            elif if_range != email.utils.formatdate(mtime, usegmt=True):
+                return None
+        
+        unit, _, spec = header.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        
+        ranges = []
+        for part in spec.split(','):
+            first, dash, last = part.strip().partition('-')
+            if not dash:
+                return None
+            try:
+                if first:
+                    start = int(first)
+                    end = int(last) if last else size - 1
+                    if last and end < start:
+                        return None
+                else:
+                    # bytes=-N: последние N байт
+                    suffix = int(last)
+                    start = max(size - suffix, 0)
+                    end = size - 1
+                    if suffix == 0:
+                        continue
+            except ValueError:
+                return None
+            if start >= size:
+                continue
+            ranges.append((start, min(end, size - 1)))
+        
+        # Сливаем пересекающиеся диапазоны, чтобы не отдавать одно и то же дважды
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        if len(merged) > MAX_RANGES:
+            return None
+        return merged
+    
+    def send_multiple_ranges(self, f, ranges, size, mime_type, etag, mtime):
+        """Отдаёт несколько диапазонов как multipart/byteranges"""
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            head = (f'\r\n--{boundary}\r\n'
+                    f'Content-Type: {mime_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+            parts.append((head, start, end - start + 1))
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        length = sum(len(head) + count for head, _, count in parts) + len(tail)
+        
+        self.send_response(206)
+        self.send_header('Content-type', f'multipart/byteranges; boundary={boundary}')
+        self.send_header('Content-Length', str(length))
+        self.send_validators(etag, mtime)
+        self.end_headers()
+        try:
+            for head, start, count in parts:
+                self.wfile.write(head)
+                if not self.send_file_range(f, start, count):
+                    return
+            self.wfile.write(tail)
+        except ConnectionError:
+            self.close_connection = True
+    
+    def send_file_range(self, f, offset, count):
+        """Отправляет count байт файла с позиции offset, не читая файл в память"""
+        try:
+            self.wfile.flush()
+            if self.wfile is self.raw_wfile:
+                # socket.sendfile сам откатится на send() кусками, если sendfile недоступен
+                self.connection.sendfile(f, offset, count)
+                return True
+            f.seek(offset)
+            buf = bytearray(CHUNK_SIZE)
+            view = memoryview(buf)
+            while count > 0:
+                n = f.readinto(view[:min(count, CHUNK_SIZE)])
+                if not n:
+                    break
+                self.wfile.write(view[:n])
+                count -= n
+            return True
+        except (ConnectionError, socket.timeout):
+            # Клиент закрыл соединение посреди загрузки
+            self.close_connection = True
+            return False
     
     def do_GET(self):
         """Обрабатывает GET запросы"""
+        parsed = urllib.parse.urlparse(self.path)
+        
+        # Стили и скрипты доступны и без авторизации (нужны форме входа)
+        if parsed.path.startswith('/__assets/'):
+            self.send_asset(parsed.path[len('/__assets/'):])
+            return
+        
         # Проверяем авторизацию
         if not self.check_auth():
             self.send_auth_form()
             return
         
         # Обрабатываем пути
-        parsed = urllib.parse.urlparse(self.path)
         query = urllib.parse.parse_qs(parsed.query)
         
-        if 'dir' in query:
+        # Файлы из запроса должны лежать в корне пользователя
+        if not all(map(self.in_root, (path for key in self.PATH_PARAMS for path in query.get(key, ())))):
+            self.send_error(403, "Path is outside of your root directory")
+            return
+        
+        if 'stats' in query and self.user is not None:
+            # Общие счётчики выдают чужие сессии и квоты, пользователю - только его квота
+            usage = QUOTAS.usage(self.root)
+            self.send_json({'quota': None if usage is None else {'used': usage[0], 'quota': usage[1]}})
+        elif 'stats' in query:
+            # Счётчики кешей
+            self.send_json({
+                'listing_cache': LISTING_CACHE.stats(),
+                'compression_cache': COMPRESSION_CACHE.stats(),
+                'file_index': FILE_INDEX.stats() if FILE_INDEX.thread else None,
+                'watcher': WATCHER.stats(),
+                'grep': GREP.stats(),
+                'dir_sizes': DIR_SIZES.stats(),
+                'jobs': JOBS.stats(),
+                'line_indexes': LINE_INDEXES.stats(),
+                'thumbnails': THUMBNAILS.stats(),
+                'archives': ARCHIVES.stats(),
+                'sessions': SESSIONS.stats(),
+                'accounts': ACCOUNTS.stats(),
+                'quotas': QUOTAS.stats(),
+                'paths': RESOLVER.stats(),
+            })
+        elif 'jobs' in query:
+            # Фоновые задания
+            self.send_json({'now': time.time(), 'jobs': [job for job in JOBS.list() if self.owns_job(job)]})
+        elif 'job' in query:
+            job = JOBS.get(query['job'][0])
+            if job is None or not self.owns_job(job):
+                self.send_json({'error': 'Job not found'}, 404)
+            else:
+                self.send_json(job)
+        elif 'du' in query:
+            # Размеры директорий и крупнейшие файлы
+            current_dir = query['du'][0]
+            if not self.in_root(current_dir):
+                current_dir = self.root
+            self.send_usage(current_dir, query)
+        elif 'grep' in query:
+            # Поиск по содержимому файлов
+            self.send_grep(query)
+        elif 'events' in query:
+            # Изменения в открытой директории
+            current_dir = query['events'][0]
+            if not self.in_root(current_dir):
+                current_dir = self.root
+            self.send_events(current_dir)
+        elif 'search' in query:
+            # Поиск файлов по имени во всём дереве
+            self.send_search(query)
+        elif 'upload' in query:
+            # Состояние докачиваемой загрузки
+            session = UPLOADS.get(query['upload'][0])
+            if session is None or not self.in_root(session['directory']):
+                self.send_json({'error': 'Upload not found'}, 404)
+            else:
+                self.send_json(UPLOADS.status(session))
+        elif 'list' in query:
+            # Порция листинга для подгрузки при прокрутке
+            current_dir = query['list'][0]
+            if not self.in_root(current_dir):
+                current_dir = self.root
+            self.send_listing_page(current_dir, query)
+        elif 'dir' in query:
             # Показываем директорию
             current_dir = query['dir'][0]
             # Защита от выхода за пределы корневой директории
-            root_dir = os.getcwd()
-            if not os.path.abspath(current_dir).startswith(root_dir):
-                current_dir = root_dir
-            self.send_file_manager(current_dir)
+            if not self.in_root(current_dir):
+                current_dir = self.root
+            self.send_file_manager(current_dir, self.listing_order(query))
+        elif 'archive' in query:
+            # Скачивание папок и выбранных файлов архивом
+            self.send_archive(query['archive'], query.get('format', ['zip'])[0])
+        elif 'browse' in query:
+            # Содержимое архива как директория
+            self.send_archive_listing(query['browse'][0], query.get('inner', [''])[0])
+        elif 'member' in query:
+            # Файл из архива без распаковки остальных
+            self.send_member(query['member'][0], query.get('name', [''])[0],
+                             query.get('download', [''])[0] == '1')
+        elif 'thumb' in query:
+            # Миниатюра картинки для листинга
+            self.send_thumbnail(query['thumb'][0])
+        elif 'lines' in query:
+            # Окно строк для постраничного редактора
+            self.send_lines(query)
         elif 'view' in query:
             # Показываем редактор файла
             self.show_editor(query['view'][0])
@@ -878,104 +6251,811 @@ class FileManagerHandler(http.server.SimpleHTTPRequestHandler):
             # Показываем файл для просмотра
             self.serve_file_preview(query['preview'][0])
         elif parsed.path == '/':
-            # Корневая директория (где запущен скрипт)
-            current_dir = os.getcwd()
-            self.send_file_manager(current_dir)
+            # Корневая директория пользователя (у администратора - где запущен скрипт)
+            self.send_file_manager(self.root, self.listing_order(query))
         else:
-            # Статические файлы
-            file_path = parsed.path[1:]  # Убираем первый слеш
-            if os.path.isfile(file_path):
+            # Статические файлы из корня пользователя
+            file_path = os.path.join(self.root, urllib.parse.unquote(parsed.path[1:]))
+            if self.in_root(file_path) and os.path.isfile(file_path):
                 self.serve_file_preview(file_path)
             else:
                 self.send_error(404, "File not found")
     
+    def do_HEAD(self):
+        """Заголовки статического файла из корня пользователя, как у GET без тела.
+        
+        Остальные маршруты строят тело на лету (листинги, архивы, sendfile
+        диапазонов), поэтому HEAD для них не поддерживается: 405.
+        """
+        parsed = urllib.parse.urlparse(self.path)
+        if not self.check_auth():
+            self.send_error(403, "Not authorized")
+            return
+        if parsed.query or parsed.path == '/' or parsed.path.startswith('/__assets/'):
+            self.send_response(405)
+            self.send_header('Allow', 'GET, HEAD, POST, PUT')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        file_path = os.path.join(self.root, urllib.parse.unquote(parsed.path[1:]))
+        try:
+            st = os.stat(file_path) if self.in_root(file_path) else None
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.send_error(404, "File not found")
+            return
+        etag = file_etag(st)
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(st.st_size))
+        self.send_validators(etag, st.st_mtime)
+        self.end_headers()
+    
     def do_POST(self):
         """Обрабатывает POST запросы"""
-        content_length = int(self.headers.get('Content-Length', 0))
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        post_params = urllib.parse.parse_qs(post_data)
+        if self.headers.get('Content-Type', '').startswith('multipart/form-data'):
+            # Загрузка файлов: тело не буферизуем, а разбираем потоком
+            if not self.check_auth():
+                # Непрочитанное тело нельзя оставлять в соединении
+                self.close_connection = True
+                self.send_auth_form()
+                return
+            self.handle_upload()
+            return
+        
+        try:
+            post_params, content = self.read_form(self.check_auth())
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, str(e))
+            return
+        self.body_read = True
+        try:
+            self.handle_form(post_params, content)
+        finally:
+            if content is not None:
+                content.close()
+    
+    def read_form(self, authorized):
+        """Читает urlencoded тело потоком.
+        
+        Содержимое из редактора (поле content) пишется сразу во временный
+        файл рядом с сохраняемым, если action и path пришли раньше него,
+        путь в корне пользователя и квота вмещает всё тело, иначе - во
+        временный файл на диске. Возвращает (params, content).
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        form = FormReader(self.rfile, length)
+        params = {}
+        content = None
+        try:
+            while (name := form.next_name()) is not None:
+                if name == 'content' and authorized:
+                    if content is not None:
+                        content.close()
+                    content = None
+                    if (params.get('action') == ['save'] and params.get('path')
+                            and self.in_root(params['path'][0])):
+                        directory = os.path.dirname(os.path.realpath(params['path'][0]))
+                        try:
+                            # Раскодированное содержимое не длиннее тела
+                            QUOTAS.charge(directory, length)
+                        except QuotaExceeded:
+                            # Превышение квоты покажет само сохранение
+                            pass
+                        else:
+                            try:
+                                content = AtomicWriter(directory, length)
+                            except OSError:
+                                # Ошибку записи покажет само сохранение
+                                QUOTAS.release(directory, length)
+                    if content is None:
+                        content = tempfile.SpooledTemporaryFile(MAX_FIELD_SIZE)
+                    for chunk in form.iter_value():
+                        content.write(chunk)
+                    continue
+                value = form.read_value()
+                # Пустые значения отбрасываем, как parse_qs
+                if value:
+                    params.setdefault(name, []).append(value)
+        except BaseException:
+            if content is not None:
+                content.close()
+            raise
+        return params, content
+    
+    def handle_form(self, post_params, content):
+        """Выполняет действие из urlencoded формы"""
+        action = post_params.get('action', [''])[0]
+        username = post_params.get('username', [''])[0] or None
+        if action == 'register':
+            self.handle_register(username, post_params.get('password', [''])[0])
+            return
         
         # Проверка пароля
         if 'password' in post_params:
-            password = post_params['password'][0]
-            if password == self.PASSWORD:
-                self.send_response(302)
-                self.send_header('Location', '/')
-                self.send_header('Set-Cookie', f'filemanager_auth={self.PASSWORD}; Path=/')
-                self.end_headers()
-                return
-            else:
-                self.send_auth_form()
-                return
+            self.handle_login(post_params['password'][0], username)
+            return
         
         # Проверяем авторизацию для других действий
         if not self.check_auth():
             self.send_auth_form()
             return
         
-        action = post_params.get('action', [''])[0]
-        self.handle_file_actions(action, post_params)
+        # Все пути действия должны лежать в корне пользователя. Удаляется и
+        # переименовывается сама ссылка, а не её цель, и не сам корень
+        link_action = action in ('delete', 'rename')
+        allowed = all(self.in_root(path, follow=not link_action, strict=link_action)
+                      for path in post_params.get('path', ()))
+        if not allowed or not all(self.in_root(path) for key in ('current_dir', 'dest')
+                                  for path in post_params.get(key, ())):
+            self.send_error(403, "Path is outside of your root directory")
+            return
+        
+        if action == 'logout':
+            SESSIONS.logout(self.session_token())
+            self.send_redirect('/', SESSIONS.cookie(''))
+            return
+        if action.startswith('upload_'):
+            self.handle_upload_session(action, post_params)
+            return
+        if action == 'extract':
+            self.handle_extract(post_params)
+            return
+        if action == 'download':
+            self.send_archive(post_params.get('path', []), post_params.get('format', ['zip'])[0])
+            return
+        if action == 'patch':
+            self.handle_patch(post_params, content)
+            return
+        if action == 'job_cancel':
+            job = JOBS.get(post_params.get('id', [''])[0])
+            self.send_json({'cancelled': job is not None and self.owns_job(job) and JOBS.cancel(job['id'])})
+            return
+        if action == 'grep_cancel':
+            self.send_json({'cancelled': GREP.cancel(post_params.get('id', [''])[0])})
+            return
+        self.handle_file_actions(action, post_params, content)
+    
+    def throttle_login(self):
+        """Отвечает 429, если с адреса клиента слишком много попыток входа"""
+        retry = SESSIONS.retry_after(self.client_address[0])
+        if not retry:
+            return False
+        body = f'Too many login attempts, try again in {retry} s'.encode()
+        self.send_response(429)
+        self.send_header('Retry-After', str(retry))
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+    
+    def handle_login(self, password, username=None):
+        """Вход по паролю: новая сессия или снова форма входа"""
+        if self.throttle_login():
+            return
+        token = SESSIONS.login(password, self.client_address[0], username)
+        if token:
+            self.send_redirect('/', SESSIONS.cookie(token))
+        else:
+            self.send_auth_form("Incorrect username or password")
+    
+    def handle_register(self, username, password):
+        """Регистрация пользователя с собственным корнем, как в index.php"""
+        if not ACCOUNTS.registration:
+            self.send_error(403, "Registration is disabled")
+            return
+        if self.throttle_login():
+            return
+        # Регистрации с адреса ограничиваются вместе с попытками входа
+        SESSIONS.attempt(self.client_address[0])
+        try:
+            ACCOUNTS.create(username, password)
+        except ValueError as e:
+            self.send_auth_form(str(e))
+            return
+        self.send_redirect('/', SESSIONS.cookie(SESSIONS.issue(username)))
+    
+    def do_PUT(self):
+        """Принимает кусок докачиваемой загрузки: PUT ?upload=<id>&chunk=<n>"""
+        if not self.check_auth():
+            self.close_connection = True
+            self.send_error(403, "Not authorized")
+            return
+        
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        session = UPLOADS.get(query.get('upload', [''])[0])
+        if session is None or not self.in_root(session['directory']):
+            self.close_connection = True
+            self.send_json({'error': 'Upload not found'}, 404)
+            return
+        
+        try:
+            index = int(query.get('chunk', [''])[0])
+            length = int(self.headers.get('Content-Length', ''))
+            UPLOADS.write_chunk(session, index, self.rfile, length)
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json({'error': str(e)}, 400)
+            return
+        except OSError as e:
+            self.close_connection = True
+            self.send_json({'error': str(e)}, 500)
+            return
+        self.send_json({'chunk': index, 'received': len(session['received'])})
+    
+    def send_json(self, data, status=200):
+        """Отправляет JSON ответ"""
+        body = json.dumps(data).encode()
+        encoding = self.accepted_encoding() if len(body) >= COMPRESS_MIN_SIZE else None
+        if encoding:
+            body = compress_bytes(body, encoding)
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def handle_upload_session(self, action, params):
+        """Обрабатывает начало, завершение и отмену докачиваемой загрузки"""
+        try:
+            if action == 'upload_init':
+                current_dir = params.get('current_dir', [self.root])[0]
+                name = os.path.basename(params.get('name', [''])[0].replace('\\', '/'))
+                size = int(params.get('size', [''])[0])
+                if name in ('', '.', '..') or size < 0:
+                    raise ValueError("Bad file name or size")
+                self.send_json(UPLOADS.status(UPLOADS.create(current_dir, name, size)))
+                return
+            
+            session = UPLOADS.get(params.get('id', [''])[0])
+            if session is None or not self.in_root(session['directory']):
+                self.send_json({'error': 'Upload not found'}, 404)
+            elif action == 'upload_finish':
+                path = UPLOADS.finish(session)
+                paths_changed(path)
+                self.send_json({'path': path})
+            elif action == 'upload_abort':
+                UPLOADS.abort(session)
+                self.send_json({'aborted': session['id']})
+            else:
+                self.send_json({'error': f'Unknown action {action}'}, 400)
+        except QuotaExceeded as e:
+            self.send_json({'error': str(e)}, 507)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except OSError as e:
+            self.send_json({'error': str(e)}, 500)
+    
+    def handle_upload(self):
+        """Принимает файлы из multipart/form-data, записывая каждый сразу на диск"""
+        params = header_params(self.headers.get('Content-Type', ''))
+        boundary = params.get('boundary')
+        length = self.headers.get('Content-Length')
+        if not boundary or not length:
+            self.close_connection = True
+            self.send_error(400, "Bad upload request")
+            return
+        
+        fields = {}
+        # Квота резервируется по Content-Length (тело не меньше файлов в нём),
+        # после загрузки лишнее возвращается
+        reserved = grown = 0
+        current_dir = self.root
+        try:
+            reader = MultipartReader(self.rfile, boundary.encode('latin-1'), int(length))
+            for part in reader.parts():
+                if part.filename is None:
+                    fields.setdefault(part.name, []).append(part.read_value())
+                    continue
+                name = os.path.basename(part.filename.replace('\\', '/'))
+                if name in ('', '.', '..'):
+                    continue
+                # current_dir приходит в форме раньше файлов
+                if not reserved:
+                    current_dir = fields.get('current_dir', [self.root])[0]
+                    self.jail(current_dir)
+                    QUOTAS.charge(current_dir, int(length))
+                    reserved = int(length)
+                grown += self.save_upload(part, current_dir, name)
+        except OutsideRoot:
+            self.close_connection = True
+            self.send_error(403, "Path is outside of your root directory")
+            return
+        except QuotaExceeded as e:
+            self.close_connection = True
+            self.send_error(507, f"Upload error: {str(e)}")
+            return
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, f"Upload error: {str(e)}")
+            return
+        except OSError as e:
+            self.close_connection = True
+            self.send_error(500, f"Upload error: {str(e)}")
+            return
+        finally:
+            QUOTAS.release(current_dir, reserved - grown)
+        
+        current_dir = fields.get('current_dir', [self.root])[0]
+        self.send_redirect(f'?dir={urllib.parse.quote(current_dir)}')
+    
+    def save_upload(self, part, directory, name):
+        """Пишет файл рядом с целевым и атомарно переименовывает; возвращает прирост занятого места"""
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in part.iter_chunks():
+                    f.write(chunk)
+                size = f.tell()
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+            try:
+                replaced = os.lstat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, os.path.join(directory, name))
+            paths_changed(os.path.join(directory, name))
+            return size - replaced
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def handle_patch(self, params, content):
+        """Сохраняет окно постраничного редактора: байты [offset, end) версии etag"""
+        path = params.get('path', [''])[0]
+        try:
+            offset = int(params.get('offset', [''])[0])
+            end = int(params.get('end', [''])[0])
+            grown = (content.seek(0, os.SEEK_END) if content is not None else 0) - (end - offset)
+            QUOTAS.charge(path, grown)
+            try:
+                new_end = patch_file(path, offset, end, content,
+                                     params.get('etag', [''])[0] or self.headers.get('If-Match'))
+            except BaseException:
+                # Правка не применилась - учёт возвращается как был
+                QUOTAS.undo(path, grown)
+                raise
+        except QuotaExceeded as e:
+            self.send_json({'error': str(e)}, 507)
+            return
+        except SaveConflict as e:
+            self.send_json({'error': str(e)}, 409)
+            return
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        except OSError as e:
+            self.send_json({'error': str(e)}, 500)
+            return
+        paths_changed(path)
+        st = os.stat(os.path.realpath(path))
+        self.send_json({'etag': file_etag(st), 'end': new_end, 'size': st.st_size})
+    
+    def save_file(self, path, content, expected_etag=None):
+        """Атомарно заменяет содержимое файла: временный файл, fsync, os.replace"""
+        # Сохранение через симлинк меняет файл, на который он указывает
+        target = os.path.realpath(path)
+        directory = os.path.dirname(target)
+        if isinstance(content, AtomicWriter) and content.directory == directory:
+            writer = content
+        else:
+            # Квота резервируется до того, как данные попадут в директорию
+            size = content.seek(0, os.SEEK_END) if content is not None else 0
+            QUOTAS.charge(directory, size)
+            try:
+                writer = AtomicWriter(directory, size)
+            except BaseException:
+                QUOTAS.release(directory, size)
+                raise
+            if content is not None:
+                content.seek(0)
+                shutil.copyfileobj(content, writer.file, CHUNK_SIZE)
+        try:
+            with SAVE_LOCK:
+                try:
+                    st = os.stat(target)
+                except FileNotFoundError:
+                    st = None
+                if expected_etag and (st is None or file_etag(st) != expected_etag):
+                    raise SaveConflict("File was changed after it was opened, reload it before saving")
+                grown = writer.file.seek(0, os.SEEK_END) - (st.st_size if st else 0)
+                # Резерв по длине тела заменяется настоящим приростом
+                QUOTAS.release(directory, writer.reserved)
+                writer.reserved = 0
+                QUOTAS.charge(target, grown)
+                try:
+                    writer.commit(target, st)
+                except BaseException:
+                    QUOTAS.undo(target, grown)
+                    raise
+        finally:
+            writer.discard()
     
-    def handle_file_actions(self, action, params):
+    def handle_file_actions(self, action, params, content=None):
         """Обрабатывает действия с файлами"""
+        # Пути, листинги которых нужно сбросить после действия
+        touched = []
+        job = None
         try:
-            current_dir = params.get('current_dir', [os.getcwd()])[0]
+            current_dir = params.get('current_dir', [self.root])[0]
             
             if action == 'create_file':
                 name = params.get('name', [''])[0]
                 file_path = os.path.join(current_dir, name)
+                self.jail(file_path)
+                touched.append(file_path)
                 with open(file_path, 'w') as f:
                     f.write('')
             
             elif action == 'create_folder':
                 name = params.get('name', [''])[0]
                 folder_path = os.path.join(current_dir, name)
+                self.jail(folder_path)
+                touched.append(folder_path)
                 os.makedirs(folder_path, exist_ok=True)
             
             elif action == 'rename':
                 path = params.get('path', [''])[0]
                 new_name = params.get('new_name', [''])[0]
                 new_path = os.path.join(os.path.dirname(path), new_name)
+                self.jail(new_path)
+                touched += [path, new_path]
                 os.rename(path, new_path)
+                QUOTAS.moved(path, new_path)
             
-            elif action == 'delete':
-                paths = params.get('path', [])
-                for path in paths:
-                    if os.path.isdir(path):
-                        import shutil
-                        shutil.rmtree(path)
-                    else:
-                        os.remove(path)
-            
-            elif action == 'clone':
-                paths = params.get('path', [])
-                for path in paths:
-                    if os.path.isdir(path):
-                        new_path = path + '_copy'
-                        import shutil
-                        shutil.copytree(path, new_path)
-                    else:
-                        new_path = path + '_copy'
-                        with open(path, 'rb') as fsrc, open(new_path, 'wb') as fdst:
-                            fdst.write(fsrc.read())
+            elif action in ('delete', 'clone'):
+                # Долгие операции выполняются фоновым заданием
+                job = JOBS.submit(action, params.get('path', []),
+                                  run_delete if action == 'delete' else run_clone)
             
             elif action == 'save':
                 path = params.get('path', [''])[0]
-                content = params.get('content', [''])[0]
-                with open(path, 'w', encoding='utf-8') as f:
-                    f.write(content)
+                touched.append(path)
+                self.save_file(path, content, params.get('etag', [''])[0] or self.headers.get('If-Match'))
             
+            paths_changed(*touched)
+            if params.get('format', [''])[0] == 'json':
+                self.send_json({'job': job})
+                return
             # Перенаправляем обратно
-            self.send_response(302)
-            self.send_header('Location', f'?dir={urllib.parse.quote(current_dir)}')
-            self.end_headers()
+            self.send_redirect(f'?dir={urllib.parse.quote(current_dir)}')
             
+        except OutsideRoot:
+            self.send_error(403, "Path is outside of your root directory")
+        except SaveConflict as e:
+            self.send_error(409, str(e))
+        except QuotaExceeded as e:
+            self.send_error(507, str(e))
         except Exception as e:
+            # Часть изменений могла успеть примениться
+            paths_changed(*touched)
             self.send_error(500, f"Error: {str(e)}")
 
+def start_detached(handler, close):
+    """Доводит долгий ответ handler.detached в отдельном потоке, затем close(handler)"""
+    def run():
+        try:
+            handler.detached()
+        except Exception:
+            handler.server.handle_error(handler.request, handler.client_address)
+        finally:
+            close(handler)
+    threading.Thread(target=run, name='fm-stream', daemon=True).start()
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """TCP сервер, обрабатывающий запросы в ограниченном пуле потоков.
+    
+    Поток пула занят только на время запроса: между запросами соединение
+    ждёт в selector отдельного потока и возвращается в пул, когда клиент
+    прислал следующий. Потоки событий (SSE) живут вне пула.
+    """
+    
+    detach_streams = True
+    
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fm-worker')
+        # Не больше max_workers + max_pending соединений одновременно,
+        # остальные ждут в backlog ядра
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.wakeup_send = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        # Очередь на парковку и число простаивающих соединений, которые
+        # нужно закрыть ради новых; разбирает поток парковки
+        self.park_lock = threading.Lock()
+        self.incoming = []
+        self.evict = 0
+        self.closing = False
+        self.parked = 0
+        super().__init__(server_address, RequestHandlerClass)
+        self.parker = threading.Thread(target=self.park_loop, name='fm-keepalive', daemon=True)
+        self.parker.start()
+    
+    def process_request(self, request, client_address):
+        """Ставит новое соединение ждать первого запроса"""
+        if not self.slots.acquire(blocking=False):
+            # Мест нет: закрываем самое давнее простаивающее соединение
+            # вместо того, чтобы новый клиент ждал его KEEPALIVE_TIMEOUT
+            with self.park_lock:
+                self.evict += 1
+            self.wake()
+            self.slots.acquire()
+        try:
+            handler = self.RequestHandlerClass.attach(request, client_address, self)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.park(handler)
+    
+    def serve_connection(self, handler):
+        """Обрабатывает в потоке пула пришедшие запросы соединения и паркует его"""
+        try:
+            while True:
+                handler.handle_one_request()
+                if handler.close_connection or handler.detached is not None:
+                    break
+                # Следующий запрос мог прийти вместе с этим (pipelining)
+                if not self.request_buffered(handler):
+                    break
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            handler.close_connection = True
+        if handler.detached is not None:
+            start_detached(handler, self.close_connection)
+        elif handler.close_connection:
+            self.close_connection(handler)
+        else:
+            self.park(handler)
+    
+    @staticmethod
+    def request_buffered(handler):
+        """Есть ли уже прочитанные данные следующего запроса, не блокируясь"""
+        conn = handler.connection
+        timeout = conn.gettimeout()
+        conn.settimeout(0)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            conn.settimeout(timeout)
+    
+    def close_connection(self, handler):
+        """Закрывает соединение и освобождает его место"""
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+        self.slots.release()
+    
+    def park(self, handler):
+        """Отдаёт соединение потоку парковки до следующего запроса"""
+        if self.request_buffered(handler):
+            self.dispatch(handler)
+            return
+        with self.park_lock:
+            self.incoming.append(handler)
+        self.wake()
+    
+    def dispatch(self, handler):
+        """Передаёт соединение с пришедшим запросом в пул"""
+        try:
+            self.executor.submit(self.serve_connection, handler)
+        except RuntimeError:
+            # Пул уже остановлен
+            self.close_connection(handler)
+    
+    def wake(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+    
+    def park_loop(self):
+        """Ждёт запросов в простаивающих соединениях и закрывает просроченные"""
+        # Куча (срок, номер, обработчик); записи вернувшихся в пул соединений
+        # остаются в ней и пропускаются по несовпадению срока
+        deadlines = []
+        order = itertools.count()
+        while True:
+            timeout = max(deadlines[0][0] - time.monotonic(), 0) if deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wakeup:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                handler = key.data
+                self.selector.unregister(key.fileobj)
+                handler.parked_until = None
+                self.parked -= 1
+                self.dispatch(handler)
+            now = time.monotonic()
+            with self.park_lock:
+                incoming, self.incoming = self.incoming, []
+                evict, self.evict = self.evict, 0
+                closing = self.closing
+            for handler in incoming:
+                # Первого запроса ждём как обычного чтения, следующих - KEEPALIVE_TIMEOUT
+                wait = KEEPALIVE_TIMEOUT if handler.requests_served else (handler.timeout or KEEPALIVE_TIMEOUT)
+                handler.parked_until = now + wait
+                try:
+                    self.selector.register(handler.connection, selectors.EVENT_READ, handler)
+                except (ValueError, OSError):
+                    self.close_connection(handler)
+                    continue
+                self.parked += 1
+                heapq.heappush(deadlines, (handler.parked_until, next(order), handler))
+            while deadlines and (closing or evict or deadlines[0][0] <= now):
+                deadline, _, handler = heapq.heappop(deadlines)
+                if handler.parked_until != deadline:
+                    continue
+                if deadline > now and not closing:
+                    evict -= 1
+                self.selector.unregister(handler.connection)
+                handler.parked_until = None
+                self.parked -= 1
+                self.close_connection(handler)
+            if closing:
+                return
+    
+    def server_close(self):
+        super().server_close()
+        with self.park_lock:
+            self.closing = True
+        self.wake()
+        self.parker.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class AsyncHTTPServer:
+    """Сервер на asyncio: приём соединений и ожидание запросов идут в event loop,
+    а сам запрос обрабатывается FileManagerHandler в ограниченном пуле потоков.
+    Простаивающее соединение не занимает поток, поток событий (SSE) живёт вне пула."""
+    
+    detach_streams = True
+    
+    def __init__(self, server_address, RequestHandlerClass, max_workers=MAX_WORKERS):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fm-async')
+        self.socket = socket.create_server(server_address, backlog=MAX_PENDING)
+        self.server_address = self.socket.getsockname()
+        self.loop = None
+        self.stopped = None
+        self.done = threading.Event()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.server_close()
+    
+    def serve_forever(self):
+        """Запускает event loop до вызова shutdown()"""
+        self.done.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.done.set()
+    
+    def shutdown(self):
+        """Останавливает serve_forever() из другого потока"""
+        if self.loop is not None and not self.done.is_set():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.done.wait()
+    
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    # Трассировка в stderr, как у серверов socketserver
+    handle_error = socketserver.BaseServer.handle_error
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.socket.setblocking(False)
+        connections = set()
+        
+        async def accept_loop():
+            while True:
+                conn, addr = await self.loop.sock_accept(self.socket)
+                task = asyncio.create_task(self.serve_connection(conn, addr))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+        
+        acceptor = asyncio.create_task(accept_loop())
+        try:
+            await self.stopped.wait()
+        finally:
+            acceptor.cancel()
+            for task in list(connections):
+                task.cancel()
+            await asyncio.gather(acceptor, *connections, return_exceptions=True)
+    
+    async def serve_connection(self, conn, addr):
+        """Обслуживает одно соединение: ждёт запрос в loop, обрабатывает в пуле"""
+        conn.setblocking(True)
+        handler = None
+        try:
+            handler = self.RequestHandlerClass.attach(conn, addr, self)
+            while True:
+                if not await self.wait_request(conn, handler):
+                    break
+                await self.loop.run_in_executor(self.executor, handler.handle_one_request)
+                if handler.detached is not None:
+                    start_detached(handler, lambda handler: self.close(handler.connection, handler))
+                    break
+                if handler.close_connection:
+                    break
+        except (OSError, asyncio.CancelledError):
+            pass
+        except Exception:
+            self.handle_error(conn, addr)
+        finally:
+            # Соединение с долгим ответом закроет поток, который его доводит
+            if handler is None or handler.detached is None:
+                self.close(conn, handler)
+    
+    @staticmethod
+    def close(conn, handler=None):
+        """Закрывает соединение, дописав ответ"""
+        try:
+            if handler is not None:
+                handler.finish()
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
+    
+    async def wait_request(self, conn, handler):
+        """Ждёт начала следующего запроса, не занимая поток"""
+        timeout = conn.gettimeout()
+        conn.settimeout(0)
+        try:
+            # Данные могли уже попасть в буфер rfile
+            if handler.rfile.peek(1):
+                return True
+            ready = self.loop.create_future()
+            self.loop.add_reader(conn.fileno(), lambda: ready.done() or ready.set_result(True))
+            try:
+                return await asyncio.wait_for(ready, KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.loop.remove_reader(conn.fileno())
+        finally:
+            conn.settimeout(timeout)
+
+class SingleHTTPServer(socketserver.TCPServer):
+    """Последовательный сервер. Keep-alive выключен: одно простаивающее
+    соединение иначе блокировало бы всех остальных клиентов"""
+    keepalive = False
+
+SERVER_ENGINES = {
+    'threaded': ThreadPoolHTTPServer,
+    'asyncio': AsyncHTTPServer,
+    'single': SingleHTTPServer,
+}
+
 def is_port_in_use(host, port):
     """Проверяет, занят ли порт"""
-    import socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
             s.bind((host, port))
@@ -984,8 +7064,41 @@ def is_port_in_use(host, port):
             return True
 
 def main():
-    host = 'YOU IP SERVER'
-    start_port = 3000 
+    parser = argparse.ArgumentParser(description='File Manager')
+    parser.add_argument('--host', default='YOU IP SERVER')
+    parser.add_argument('--port', type=int, default=3000, help='Первый проверяемый порт')
+    parser.add_argument('--engine', choices=sorted(SERVER_ENGINES), default=SERVER_ENGINE)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--no-index', action='store_true', help='Не индексировать файлы для поиска')
+    parser.add_argument('--password', default=FileManagerHandler.PASSWORD)
+    parser.add_argument('--password-hash', help='Хеш пароля из --hash-password вместо самого пароля')
+    parser.add_argument('--hash-password', metavar='PASSWORD', help='Вывести хеш пароля и выйти')
+    parser.add_argument('--allow-register', action='store_true', help='Разрешить регистрацию из формы входа')
+    parser.add_argument('--add-user', metavar='NAME', help='Завести пользователя (пароль спросит) и выйти')
+    parser.add_argument('--set-quota', metavar='NAME', help='Сменить квоту пользователя на --quota и выйти')
+    parser.add_argument('--quota', type=int, default=DEFAULT_QUOTA // 2**20, help='Квота, МБ (0 - без ограничения)')
+    args = parser.parse_args()
+    if args.hash_password is not None:
+        print(hash_password(args.hash_password))
+        return
+    ACCOUNTS.load()
+    if args.add_user or args.set_quota:
+        try:
+            if args.add_user:
+                ACCOUNTS.create(args.add_user, getpass.getpass(f"Пароль для {args.add_user}: "), args.quota * 2**20)
+                print(f"✅ Пользователь {args.add_user}: {ACCOUNTS.root(args.add_user)}")
+            elif ACCOUNTS.get(args.set_quota) is None:
+                raise ValueError(f"No such user: {args.set_quota}")
+            else:
+                ACCOUNTS.set_quota(args.set_quota, args.quota * 2**20)
+                print(f"✅ Квота {args.set_quota}: {args.quota} МБ")
+        except ValueError as e:
+            print(f"❌ {e}")
+        return
+    ACCOUNTS.registration = args.allow_register or ALLOW_REGISTRATION
+    SESSIONS.set_password(args.password, args.password_hash)
+    host = args.host
+    start_port = args.port
     
     print(f"🔍 Поиск свободного порта на {host}...")
     
@@ -993,10 +7106,20 @@ def main():
         if not is_port_in_use(host, port):
             print(f"✅ Порт {port} свободен")
             print(f"🚀 Запуск файлового менеджера на http://{host}:{port}")
-            print(f"🔐 Пароль: pass123")
+            print(f"🔐 Пароль: {'задан хешем' if args.password_hash else args.password}")
             print(f"📁 Корневая директория: {os.getcwd()}")
+            print(f"👥 Пользователей: {len(ACCOUNTS.users)} в {USER_ROOTS_DIR}"
+                  f"{', регистрация открыта' if ACCOUNTS.registration else ''}")
+            print(f"⚙️  Движок: {args.engine}")
+            if not args.no_index:
+                FILE_INDEX.start()
+                print(f"🔎 Индекс файлов: {FILE_INDEX.db_path}")
             
-            with socketserver.TCPServer((host, port), FileManagerHandler) as httpd:
+            if args.engine == 'single':
+                httpd = SingleHTTPServer((host, port), FileManagerHandler)
+            else:
+                httpd = SERVER_ENGINES[args.engine]((host, port), FileManagerHandler, max_workers=args.workers)
+            with httpd:
                 print(f"✅ Сервер запущен!")
                 print("⏹️  Ctrl+C для остановки")
                 try: